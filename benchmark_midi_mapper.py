@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks the stages of the mapping pipeline on synthetic presets.
+
+The results are written as JSON, so they can be compared across commits:
+
+    python benchmark_midi_mapper.py --targets 50 --cells 64 -o bench.json
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import zipfile
+
+from lxml import etree
+
+from midi_mapper import MidiMapper
+from preset_generator import generate_preset
+from tenten_zip_utils import (
+    zip_files_to_memory,
+    zip_files_to_spooled_file,
+    zip_folder_to_memory,
+    map_zip_to_memory,
+)
+from models import (
+    TenTenDevice,
+    ModSources,
+    BlackboxSettings,
+    BlackboxPadParam,
+    BlackboxNoteseqParam,
+    GeneralMidiSettings,
+    TENTEN_EXTENSIONS,
+    PROJECT_FILENAMES,
+)
+
+
+class StageTimer:
+    def __init__(self):
+        self.timings = {}
+
+    def add(self, stage, seconds):
+        self.timings.setdefault(stage, []).append(seconds)
+
+    def time(self, stage, func, *args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.add(stage, time.perf_counter() - start)
+        return result
+
+    def summary(self):
+        summary = {}
+        for stage, timings in self.timings.items():
+            summary[stage] = {
+                "count": len(timings),
+                "total_s": sum(timings),
+                "mean_s": sum(timings) / len(timings),
+                "min_s": min(timings),
+                "max_s": max(timings),
+            }
+        return summary
+
+
+def device_settings(tenten_device):
+    if tenten_device == TenTenDevice.BLACKBOX:
+        return BlackboxSettings(
+            pad_params=[p for p in BlackboxPadParam],
+            noteseq_params=[p for p in BlackboxNoteseqParam],
+        )
+    return None
+
+
+def project_filename(tenten_device):
+    return PROJECT_FILENAMES.get(
+        tenten_device, f"preset.{TENTEN_EXTENSIONS[tenten_device]}"
+    )
+
+
+def write_presets(folder, tenten_device, args):
+    """
+    Writes a template and the targets, each into its own project folder.
+    """
+    filename = project_filename(tenten_device)
+    paths = []
+    for index in range(args.targets + 1):
+        project_folder = os.path.join(folder, f"project_{index:05d}")
+        os.makedirs(project_folder)
+        path = os.path.join(project_folder, filename)
+        with open(path, "wb") as f:
+            f.write(
+                generate_preset(
+                    tenten_device,
+                    num_cells=args.cells,
+                    modsources_per_cell=args.modsources,
+                    num_mapitems=args.mapitems,
+                    seed=index,
+                )
+            )
+        paths.append(path)
+    return paths[0], paths[1:]
+
+
+def benchmark_device(tenten_device, args):
+    timer = StageTimer()
+    folder = tempfile.mkdtemp(prefix="tenten_bench_")
+    try:
+        infile, outfiles = write_presets(folder, tenten_device, args)
+        input_bytes = sum(os.path.getsize(f) for f in outfiles)
+
+        for _ in range(args.repeat):
+            mm = MidiMapper(
+                infile=infile,
+                outfiles=list(outfiles),
+                tenten_device=tenten_device,
+                device_settings=device_settings(tenten_device),
+                general_midi_settings=GeneralMidiSettings(
+                    mod_sources=[m for m in ModSources]
+                ),
+                overwrite_files=False,
+            )
+            mm.outfiles = mm.filter_outfiles(mm.outfiles)
+            mm.check_settings()
+            timer.time("parse_template", mm.read_preset_file, infile)
+            timer.time("filter", mm.extract_template_data)
+            mm.outfile_subfolder = mm.get_output_folder()
+
+            result_files = []
+            for outfile in mm.outfiles:
+                root = timer.time("parse", mm.read_xml_file, outfile)
+                start = time.perf_counter()
+                mm.wipe_modsources(root)
+                timer.add("wipe", time.perf_counter() - start)
+                start = time.perf_counter()
+                cell_index = mm.build_cell_index(root)
+                mm.insert_modsources(root, cell_index)
+                mm.insert_map_items(root)
+                mm.insert_pad_params(root, cell_index)
+                mm.insert_noteseq_params(root, cell_index)
+                timer.add("insert", time.perf_counter() - start)
+                # the same work in a single visit of every cell
+                patched_root = mm.read_xml_file(outfile)
+                timer.time("patch", mm.patch_root, patched_root)
+                result_files.append(
+                    timer.time("write", mm.write_xml_file, outfile, root)
+                )
+            shutil.rmtree(mm.outfile_subfolder)
+
+            # the whole run, as the CLI does it
+            mm = MidiMapper(
+                infile=infile,
+                outfiles=list(outfiles),
+                tenten_device=tenten_device,
+                device_settings=device_settings(tenten_device),
+                general_midi_settings=GeneralMidiSettings(
+                    mod_sources=[m for m in ModSources]
+                ),
+                overwrite_files=False,
+            )
+            result_files = timer.time("run", mm.run, jobs=args.jobs)
+
+            timer.time(
+                "zip_files_to_memory", zip_files_to_memory, result_files, cleanup=False
+            )
+            timer.time(
+                "zip_files_to_memory_level1",
+                zip_files_to_memory,
+                result_files,
+                compresslevel=1,
+            )
+            timer.time(
+                "zip_files_to_spooled_file",
+                zip_files_to_spooled_file,
+                result_files,
+                spool_threshold=1,
+            )
+            timer.time("zip_folder_to_memory", zip_folder_to_memory, folder)
+            shutil.rmtree(mm.outfile_subfolder)
+
+            zip_buffer = io.BytesIO()
+            with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zipf:
+                for outfile in outfiles:
+                    zipf.write(outfile, os.path.relpath(outfile, folder))
+            zip_buffer.seek(0)
+            mm = MidiMapper(
+                infile=infile,
+                tenten_device=tenten_device,
+                device_settings=device_settings(tenten_device),
+                general_midi_settings=GeneralMidiSettings(
+                    mod_sources=[m for m in ModSources]
+                ),
+            )
+            timer.time(
+                "map_zip_to_memory",
+                map_zip_to_memory,
+                zip_buffer,
+                mm,
+                project_filename(tenten_device),
+            )
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    return {
+        "device": tenten_device.value,
+        "targets": len(outfiles),
+        "input_bytes": input_bytes,
+        "stages": timer.summary(),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the MIDI Mapper.")
+    parser.add_argument(
+        "-d",
+        "--device",
+        action="append",
+        choices=[t.value for t in TenTenDevice],
+        help="Device layout to benchmark, can be given multiple times (default: all)",
+    )
+    parser.add_argument("--cells", type=int, default=64, help="Cells per preset")
+    parser.add_argument("--modsources", type=int, default=6, help="Modsources per cell")
+    parser.add_argument("--mapitems", type=int, default=32, help="Mapitems per preset")
+    parser.add_argument("--targets", type=int, default=20, help="Number of targets")
+    parser.add_argument("--repeat", type=int, default=3, help="Repetitions")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1, help="Worker processes for the run"
+    )
+    parser.add_argument("-o", "--output", help="JSON output file (default: stdout)")
+    args = parser.parse_args()
+
+    devices = [TenTenDevice(d) for d in args.device or [t.value for t in TenTenDevice]]
+    results = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "lxml": ".".join(str(v) for v in etree.LXML_VERSION),
+        "parameters": {
+            "cells": args.cells,
+            "modsources": args.modsources,
+            "mapitems": args.mapitems,
+            "targets": args.targets,
+            "repeat": args.repeat,
+            "jobs": args.jobs,
+        },
+        "results": [benchmark_device(device, args) for device in devices],
+    }
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
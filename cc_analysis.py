@@ -0,0 +1,483 @@
+#!/usr/bin/env python3
+
+"""
+Predicts what a template would do to a preset library before it is mapped,
+without changing any file:
+
+- which existing midicc modsources and mapitems use a CC of the template for
+  something else (CC collisions)
+- how many slots of the touched cell destinations are taken (slot pressure)
+- which existing modsources would be replaced, because all slots are taken
+  (evictions, including the ones at `DEFAULT_SLOT`)
+
+    python cc_analysis.py -i template/preset.xml -t blackbox ./presets
+
+The modsources, mapitems and cells of all presets are loaded into NumPy arrays
+and every prediction is computed on the whole library at once.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+from cell_index import cell_coordinates, cell_key
+from mapping_index import find_presets
+from midi_mapper import MidiMapper, DEFAULT_SLOT
+from mod_source_list import NUM_SLOTS, SLOT_BITS
+from xml_parser import parse_xml
+from models import TenTenDevice, ModSources, GeneralMidiSettings
+
+# a CC is encoded as mchan * CC_NUMBERS + ccnum, -1 if there is none
+CC_NUMBERS = 128
+# number of taken slots for every slot bitmap
+POPCOUNT = np.array([bin(i).count("1") for i in range(1 << NUM_SLOTS)], dtype=np.int64)
+
+MODSOURCE_COLUMNS = {
+    "file": np.int64,
+    "cell": np.int64,
+    "dest": np.int64,
+    "slot": np.int64,
+    "cc": np.int64,
+    "midicc": bool,
+    "selected": bool,
+    "source_order": np.int64,
+    "first_cell": bool,
+}
+MAPITEM_COLUMNS = {"file": np.int64, "target": np.int64, "cc": np.int64}
+CELL_COLUMNS = {"file": np.int64, "cell": np.int64}
+
+
+class Vocabulary:
+    """
+    Gives every distinct value a consecutive id, so that keys can be compared
+    as integers.
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.values = []
+
+    def __call__(self, value) -> int:
+        index = self.ids.get(value)
+        if index is None:
+            index = self.ids[value] = len(self.values)
+            self.values.append(value)
+        return index
+
+    def __len__(self):
+        return len(self.values)
+
+
+def to_int(value) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return -1
+
+
+def cc_code(elem) -> int:
+    mchan = to_int(elem.get("mchan"))
+    ccnum = to_int(elem.get("ccnum"))
+    if mchan < 0 or ccnum < 0:
+        return -1
+    return mchan * CC_NUMBERS + ccnum
+
+
+class PresetArrays:
+    """
+    The modsources, mapitems and cells of one or more presets as columns of
+    NumPy arrays, one row per element.
+
+    Cells, destinations and mapitem targets are stored as ids of vocabularies,
+    which are shared with the other `PresetArrays` of the same analysis.
+    """
+
+    def __init__(self, mapper: MidiMapper, cells, dests, targets):
+        self.mapper = mapper
+        self.coordinates = cell_coordinates(mapper.tenten_device)
+        # `MidiMapper.filter_midi_modsources` returns the modsources ordered
+        # by the selected mod sources first and by document order second
+        self.mod_sources = {}
+        for m in mapper.general_midi_settings.mod_sources:
+            self.mod_sources.setdefault(getattr(m, "value", m), len(self.mod_sources))
+        self.cells = cells
+        self.dests = dests
+        self.targets = targets
+        self.paths = []
+        self.modsources = {name: [] for name in MODSOURCE_COLUMNS}
+        self.mapitems = {name: [] for name in MAPITEM_COLUMNS}
+        self.cell_rows = {name: [] for name in CELL_COLUMNS}
+
+    def add_file(self, path):
+        with open(path, "rb") as f:
+            self.add_root(parse_xml(f.read())[0], path)
+
+    def add_root(self, root, path=None):
+        file = len(self.paths)
+        self.paths.append(path)
+        modsources = self.modsources
+        seen = set()
+        for cell in root.iter("cell"):
+            if self.coordinates is None:
+                break
+            try:
+                key = cell_key(cell.attrib, self.coordinates)
+            except KeyError:
+                continue
+            # like `CellIndex` only the first cell with a key gets the template
+            first_cell = key not in seen
+            seen.add(key)
+            cell_id = self.cells(key)
+            if first_cell:
+                self.cell_rows["file"].append(file)
+                self.cell_rows["cell"].append(cell_id)
+            for modsource in cell.iterchildren("modsource"):
+                src = modsource.get("src")
+                slot = modsource.get("slot")
+                modsources["file"].append(file)
+                modsources["cell"].append(cell_id)
+                modsources["dest"].append(self.dests(modsource.get("dest")))
+                modsources["slot"].append(int(slot) if slot in SLOT_BITS else -1)
+                modsources["cc"].append(cc_code(modsource) if src == "midicc" else -1)
+                modsources["midicc"].append(src == "midicc")
+                modsources["selected"].append(src in self.mod_sources)
+                modsources["source_order"].append(self.mod_sources.get(src, -1))
+                modsources["first_cell"].append(first_cell)
+        for mapitem in self.mapper.filter_map_items(root):
+            self.mapitems["file"].append(file)
+            self.mapitems["target"].append(
+                self.targets((mapitem.get("target"), mapitem.get("dest")))
+            )
+            self.mapitems["cc"].append(cc_code(mapitem))
+
+    def finish(self):
+        # the lists are replaced by arrays once all presets are added
+        for rows, columns in (
+            (self.modsources, MODSOURCE_COLUMNS),
+            (self.mapitems, MAPITEM_COLUMNS),
+            (self.cell_rows, CELL_COLUMNS),
+        ):
+            for name, dtype in columns.items():
+                rows[name] = np.asarray(rows[name], dtype=dtype)
+        return self
+
+
+class CCAnalysis:
+    """
+    Compares a template with a set of targets, like `MidiMapper` would map
+    them with the same settings, but only reads the files.
+    """
+
+    def __init__(
+        self,
+        tenten_device: TenTenDevice,
+        general_midi_settings: GeneralMidiSettings,
+        wipe_existing_mappings: bool = True,
+    ):
+        self.mapper = MidiMapper(
+            tenten_device=tenten_device,
+            general_midi_settings=general_midi_settings,
+        )
+        self.wipe_existing_mappings = wipe_existing_mappings
+        self.cells = Vocabulary()
+        self.dests = Vocabulary()
+        self.targets = Vocabulary()
+        self.template = self.new_arrays()
+        self.presets = self.new_arrays()
+
+    def new_arrays(self) -> PresetArrays:
+        return PresetArrays(self.mapper, self.cells, self.dests, self.targets)
+
+    def load(self, template_path, paths):
+        self.template.add_file(template_path)
+        for path in paths:
+            try:
+                self.presets.add_file(path)
+            except Exception as e:
+                print(f"Error reading file {path}: {e}")
+        self.template.finish()
+        self.presets.finish()
+        return self
+
+    def template_ccs(self):
+        # the CCs the template maps with modsources or mapitems
+        t = self.template
+        ccs = np.concatenate(
+            [t.modsources["cc"][t.modsources["selected"]], t.mapitems["cc"]]
+        )
+        return np.unique(ccs[ccs >= 0])
+
+    def cc_collisions(self) -> dict:
+        """
+        Returns masks over the modsources and the mapitems of the presets, which
+        use a CC of the template for another cell destination or target, and
+        which of them are still there after mapping.
+        """
+        t, p = self.template, self.presets
+        ccs = self.template_ccs()
+        space = max(int(ccs.max()) + 1 if len(ccs) else 1, 1)
+
+        def mapping_key(cells, dests, cc):
+            return (cells * len(self.dests) + dests) * space + cc
+
+        tm = t.modsources
+        selected = tm["selected"] & (tm["cc"] >= 0)
+        template_modsources = mapping_key(
+            tm["cell"][selected], tm["dest"][selected], tm["cc"][selected]
+        )
+        pm = p.modsources
+        modsources = pm["midicc"] & np.isin(pm["cc"], ccs)
+        modsources &= ~np.isin(
+            mapping_key(pm["cell"], pm["dest"], np.clip(pm["cc"], 0, space - 1)),
+            template_modsources,
+        )
+        template_mapitems = t.mapitems["target"] * space + t.mapitems["cc"]
+        pi = p.mapitems
+        mapitems = np.isin(pi["cc"], ccs) & (pi["cc"] >= 0)
+        mapitems &= ~np.isin(
+            pi["target"] * space + np.clip(pi["cc"], 0, space - 1), template_mapitems
+        )
+        if self.wipe_existing_mappings:
+            # wiped modsources are gone and `MidimapMerge` removes the mapitems
+            # of the template controllers
+            modsources_left = modsources & ~pm["selected"]
+            mapitems_left = np.zeros_like(mapitems)
+        else:
+            modsources_left = modsources
+            mapitems_left = mapitems
+        return {
+            "modsources": modsources,
+            "mapitems": mapitems,
+            "modsources_left": modsources_left,
+            "mapitems_left": mapitems_left,
+        }
+
+    def slot_groups(self) -> dict:
+        """
+        Returns one row for every cell destination of a preset, which receives
+        template modsources, with its slot bitmap after wiping, the number of
+        new modsources and the predicted evictions.
+
+        Like `SlotPlanner` new modsources take the free slots first, then
+        replace the first midicc modsource and if there is none the one at
+        `DEFAULT_SLOT`. The existing modsources come before the new ones, so
+        the existing midicc modsources are replaced first and the first
+        replacement at the default slot hits an existing modsource there.
+        The placement is simulated for all cell destinations of all presets at
+        once, one new modsource (in the order of `filter_midi_modsources`) at a
+        time.
+        """
+        t, p = self.template, self.presets
+        ndests = len(self.dests)
+        per_file = len(self.cells) * ndests
+
+        # template groups: (cell, dest) with the new modsources as rows of a
+        # matrix, padded with False
+        tm = t.modsources
+        inserted = tm["selected"]
+        template_keys = tm["cell"][inserted] * ndests + tm["dest"][inserted]
+        keys, inverse, new = np.unique(
+            template_keys, return_inverse=True, return_counts=True
+        )
+        order = np.lexsort(
+            (np.arange(len(inverse)), tm["source_order"][inserted], inverse)
+        )
+        sorted_inverse = inverse[order]
+        rank = np.arange(len(order)) - np.searchsorted(sorted_inverse, sorted_inverse)
+        new_midicc = np.zeros((len(keys), new.max() if len(new) else 0), dtype=bool)
+        new_midicc[sorted_inverse, rank] = tm["midicc"][inserted][order]
+
+        # the template groups of the cells which exist in each preset
+        presence = np.zeros((len(p.paths), len(self.cells)), dtype=bool)
+        presence[p.cell_rows["file"], p.cell_rows["cell"]] = True
+        # np.nonzero returns them sorted by file and template key
+        files, groups = np.nonzero(presence[:, keys // ndests])
+        group_keys = files * per_file + keys[groups]
+        new = new[groups]
+
+        # the existing modsources, which survive the wipe, of those groups
+        pm = p.modsources
+        survives = pm["first_cell"].copy()
+        if self.wipe_existing_mappings:
+            survives &= ~pm["selected"]
+        existing_keys = pm["file"] * per_file + pm["cell"] * ndests + pm["dest"]
+        position = np.searchsorted(group_keys, existing_keys)
+        position = np.minimum(position, max(len(group_keys) - 1, 0))
+        in_group = survives & (len(group_keys) > 0)
+        if len(group_keys):
+            in_group &= group_keys[position] == existing_keys
+
+        occupied = np.zeros(len(group_keys), dtype=np.int64)
+        has_slot = in_group & (pm["slot"] >= 0)
+        np.bitwise_or.at(
+            occupied, position[has_slot], np.left_shift(1, pm["slot"][has_slot])
+        )
+        existing_midicc = np.bincount(
+            position[in_group & pm["midicc"]], minlength=len(group_keys)
+        )
+        default_other = np.zeros(len(group_keys), dtype=bool)
+        default_other[
+            position[in_group & ~pm["midicc"] & (pm["slot"] == int(DEFAULT_SLOT))]
+        ] = True
+
+        free_left = NUM_SLOTS - POPCOUNT[occupied]
+        # number of midicc modsources in the cell destination
+        midicc = existing_midicc.copy()
+        midicc_replacements = np.zeros(len(group_keys), dtype=np.int64)
+        default_replaced = np.zeros(len(group_keys), dtype=bool)
+        for step in range(new_midicc.shape[1]):
+            placing = step < new
+            is_midicc = new_midicc[groups, step] & placing
+            full = placing & (free_left <= 0)
+            free_left -= placing & ~full
+            by_midicc = full & (midicc > 0)
+            midicc_replacements += by_midicc
+            default_replaced |= full & ~by_midicc
+            midicc += is_midicc.astype(np.int64) - by_midicc
+        midicc_evictions = np.minimum(midicc_replacements, existing_midicc)
+        default_evictions = default_replaced & default_other
+        return {
+            "file": files,
+            "cell": keys[groups] // ndests,
+            "dest": keys[groups] % ndests,
+            "occupied": POPCOUNT[occupied],
+            "new": new,
+            "midicc_evictions": midicc_evictions,
+            "default_evictions": default_evictions,
+        }
+
+    def slot_pressure(self, groups=None) -> dict:
+        """
+        Returns histograms over the cell destinations, which receive template
+        modsources: of the slots taken before and of the slots needed after
+        mapping, the last bin counts the ones with more than `NUM_SLOTS`.
+        """
+        groups = groups or self.slot_groups()
+        demand = groups["occupied"] + groups["new"]
+        return {
+            "occupied": np.bincount(
+                groups["occupied"], minlength=NUM_SLOTS + 1
+            ).tolist(),
+            "needed": np.bincount(
+                np.minimum(demand, NUM_SLOTS + 1), minlength=NUM_SLOTS + 2
+            ).tolist(),
+        }
+
+    def summary(self) -> dict:
+        p = self.presets
+        nfiles = len(p.paths)
+        collisions = self.cc_collisions()
+        groups = self.slot_groups()
+        pm, pi = p.modsources, p.mapitems
+
+        def per_file(files, mask):
+            return np.bincount(files[mask], minlength=nfiles)
+
+        found = per_file(pm["file"], collisions["modsources"]) + per_file(
+            pi["file"], collisions["mapitems"]
+        )
+        left = per_file(pm["file"], collisions["modsources_left"]) + per_file(
+            pi["file"], collisions["mapitems_left"]
+        )
+        evictions = np.bincount(
+            groups["file"],
+            weights=groups["midicc_evictions"] + groups["default_evictions"],
+            minlength=nfiles,
+        ).astype(np.int64)
+        presets = []
+        for file, path in enumerate(p.paths):
+            presets.append(
+                {
+                    "path": path,
+                    "cc_collisions": int(found[file]),
+                    "cc_collisions_left": int(left[file]),
+                    "colliding_ccs": self.colliding_ccs(file, collisions),
+                    "evicted_modsources": int(evictions[file]),
+                    "default_slot_evictions": [],
+                }
+            )
+        for index in np.nonzero(groups["default_evictions"])[0]:
+            presets[groups["file"][index]]["default_slot_evictions"].append(
+                {
+                    "cell": dict(
+                        zip(
+                            self.presets.coordinates,
+                            self.cells.values[groups["cell"][index]],
+                        )
+                    ),
+                    "dest": self.dests.values[groups["dest"][index]],
+                }
+            )
+        return {
+            "presets": presets,
+            "slot_pressure": self.slot_pressure(groups),
+        }
+
+    def colliding_ccs(self, file, collisions) -> list:
+        p = self.presets
+        ccs = np.concatenate(
+            [
+                p.modsources["cc"][
+                    collisions["modsources"] & (p.modsources["file"] == file)
+                ],
+                p.mapitems["cc"][collisions["mapitems"] & (p.mapitems["file"] == file)],
+            ]
+        )
+        return [[int(cc // CC_NUMBERS), int(cc % CC_NUMBERS)] for cc in np.unique(ccs)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Predict CC collisions and slot evictions of a template."
+    )
+    parser.add_argument("-i", "--infile", required=True, help="Template file path")
+    parser.add_argument("folder", help="Folder with the presets to analyse")
+    parser.add_argument(
+        "-t",
+        "--tenten_device",
+        required=True,
+        choices=[d.value for d in TenTenDevice],
+        help="TenTen device type",
+    )
+    parser.add_argument(
+        "--keep-existing",
+        action="store_true",
+        help="Predict a run, which doesn't wipe the existing mappings",
+    )
+    parser.add_argument("-o", "--output", help="JSON output file (default: summary)")
+
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.infile):
+        print(f"Error: Infile '{args.infile}' does not exist.")
+        sys.exit(1)
+    if not os.path.isdir(args.folder):
+        print(f"Error: Folder '{args.folder}' does not exist.")
+        sys.exit(1)
+
+    device = TenTenDevice(args.tenten_device)
+    analysis = CCAnalysis(
+        device,
+        GeneralMidiSettings(mod_sources=[m for m in ModSources]),
+        wipe_existing_mappings=not args.keep_existing,
+    )
+    infile = os.path.abspath(args.infile)
+    paths = [path for path in find_presets(args.folder, device) if path != infile]
+    summary = analysis.load(infile, paths).summary()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+    for preset in summary["presets"]:
+        if preset["cc_collisions"] or preset["evicted_modsources"]:
+            print(
+                f"{preset['path']}: {preset['cc_collisions']} CC collisions "
+                + f"({preset['cc_collisions_left']} left after mapping), "
+                + f"{preset['evicted_modsources']} modsources evicted "
+                + f"({len(preset['default_slot_evictions'])} at the default slot)"
+            )
+    print(f"Slots taken before mapping: {summary['slot_pressure']['occupied']}")
+    print(f"Slots needed after mapping: {summary['slot_pressure']['needed']}")
@@ -0,0 +1,77 @@
+from lxml.etree import Element
+
+from models import (
+    TENTEN_ROW_COLUMN_LAYER,
+    TENTEN_ROW_COLUMN_SYNTH,
+    TENTEN_ROW_COLUMN,
+    TENTEN_ROW_LAYER,
+)
+
+PAD_PARAM_COORDINATES = ("row", "column", "layer")
+NOTESEQ_PARAM_COORDINATES = ("row", "column", "layer", "seqsublayer")
+
+
+def cell_coordinates(tenten_device) -> tuple:
+    """
+    Returns the attribute names, which identify a cell for the given device.
+    """
+    if tenten_device in TENTEN_ROW_COLUMN_LAYER:
+        return ("row", "column", "layer")
+    if tenten_device in TENTEN_ROW_COLUMN_SYNTH:
+        return ("row", "column", "synth")
+    if tenten_device in TENTEN_ROW_COLUMN:
+        return ("row", "column")
+    if tenten_device in TENTEN_ROW_LAYER:
+        return ("row", "layer")
+    return None
+
+
+def cell_key(attrib, coordinates) -> tuple:
+    # raises a KeyError if one of the coordinates is missing
+    return tuple(attrib[c] for c in coordinates)
+
+
+class CellIndex:
+    """
+    Index of all cells of a preset, built in a single pass over the tree.
+
+    Only the first cell (in document order) is kept for each key, which is the
+    same cell an XPath lookup with `[0]` would return.
+    """
+
+    def __init__(self, root: Element, coordinates: tuple):
+        self.coordinates = coordinates
+        self.cells = {}
+        self.pad_params = {}
+        self.noteseq_params = {}
+        self.build(root)
+
+    def build(self, root: Element):
+        for cell in root.iter("cell"):
+            attrib = cell.attrib
+            if self.coordinates is not None:
+                try:
+                    self.cells.setdefault(cell_key(attrib, self.coordinates), cell)
+                except KeyError:
+                    pass
+            params = cell.find("params")
+            if params is None:
+                continue
+            try:
+                key = cell_key(attrib, PAD_PARAM_COORDINATES)
+            except KeyError:
+                continue
+            self.pad_params.setdefault(key, params)
+            if "seqsublayer" in attrib:
+                self.noteseq_params.setdefault(key + (attrib["seqsublayer"],), params)
+
+    def get_cell(self, attrib) -> Element:
+        if self.coordinates is None:
+            return None
+        return self.cells.get(cell_key(attrib, self.coordinates))
+
+    def get_pad_params(self, attrib) -> Element:
+        return self.pad_params.get(cell_key(attrib, PAD_PARAM_COORDINATES))
+
+    def get_noteseq_params(self, attrib) -> Element:
+        return self.noteseq_params.get(cell_key(attrib, NOTESEQ_PARAM_COORDINATES))
@@ -0,0 +1,283 @@
+from lxml import etree
+
+from cell_index import (
+    CellIndex,
+    PAD_PARAM_COORDINATES,
+    NOTESEQ_PARAM_COORDINATES,
+    cell_coordinates,
+    cell_key,
+)
+from midimap_merge import MidimapMerge
+from models import (
+    TENTEN_MIDIMAP_ITEMS,
+    PADPARAM_DEVICES,
+    NOTESEQ_PARAM_DEVICES,
+)
+
+
+def noteseq_cell_keys(cells, wanted_keys) -> set:
+    """
+    Returns the keys of the noteseq cells (with a seqsublayer) with params,
+    which are in `wanted_keys`. Stops as soon as all of them are found.
+    """
+    keys = set()
+    if not wanted_keys:
+        return keys
+    for cell in cells:
+        if "seqsublayer" in cell.attrib and cell.find("params") is not None:
+            try:
+                key = cell_key(cell.attrib, NOTESEQ_PARAM_COORDINATES)
+            except KeyError:
+                continue
+            if key in wanted_keys:
+                keys.add(key)
+                if len(keys) == len(wanted_keys):
+                    break
+    return keys
+
+
+class CellVisitor:
+    """
+    Applies the template of a `MidiMapper` to a target by visiting every child
+    of the session (usually a `cell`) exactly once. In that visit the stale
+    modsources are removed, the template modsources are put into their slots
+    and the pad and noteseq params are copied.
+
+    The result is the same as the one of the separate wipe and insert steps of
+    `MidiMapper`: the first cell in document order with matching coordinates
+    receives the template data.
+    """
+
+    def __init__(self, mapper):
+        self.mapper = mapper
+        self.coordinates = cell_coordinates(mapper.tenten_device)
+        self.mod_sources = set(
+            getattr(m, "value", m) for m in mapper.general_midi_settings.mod_sources
+        )
+        self.modsources = {}
+        self.pad_params = {}
+        self.noteseq_params = []
+        self.midimap_merge = MidimapMerge(mapper.mapitems_infile)
+        self.group_template_data()
+
+    def group_template_data(self):
+        mm = self.mapper
+        if self.coordinates is not None:
+            for mod_infile in mm.modsources_infile:
+                key = cell_key(mod_infile.getparent().attrib, self.coordinates)
+                self.modsources.setdefault(key, []).append(mod_infile)
+        if mm.tenten_device in PADPARAM_DEVICES:
+            for params in mm.pad_params_infile:
+                key = cell_key(params.getparent().attrib, PAD_PARAM_COORDINATES)
+                self.pad_params.setdefault(key, []).append(params)
+        if mm.tenten_device in NOTESEQ_PARAM_DEVICES:
+            for params in mm.noteseq_params_infile:
+                attrib = params.getparent().attrib
+                self.noteseq_params.append(
+                    (
+                        cell_key(attrib, NOTESEQ_PARAM_COORDINATES),
+                        cell_key(attrib, PAD_PARAM_COORDINATES),
+                        params,
+                    )
+                )
+
+    def wanted_noteseq_keys(self) -> set:
+        return {noteseq_key for noteseq_key, _, _ in self.noteseq_params}
+
+    def start(self, noteseq_keys):
+        """
+        Resets the state for a new target.
+
+        A noteseq cell falls back to the cell without seqsublayer only if no
+        matching cell exists anywhere in the target, so the keys of the noteseq
+        cells with params (see `noteseq_cell_keys`) have to be known up front.
+        Only the keys of the visited cells are kept, not the cells.
+        """
+        self.noteseq_keys = noteseq_keys
+        self.claimed_cells = set()
+        self.pad_targets = set()
+        self.noteseq_targets = set()
+        self.applied_noteseq_params = set()
+        self.midimap_merged = False
+
+    def visit_tree(self, root):
+        """
+        Patches a whole parsed target in place.
+        """
+        self.start(noteseq_cell_keys(root.iter("cell"), self.wanted_noteseq_keys()))
+        session = None
+        for container in root:
+            if not isinstance(container.tag, str):
+                continue
+            if container.tag == "session" and session is None:
+                session = container
+            for unit in list(container):
+                if not isinstance(unit.tag, str):
+                    continue
+                if not self.visit_unit(unit):
+                    container.remove(unit)
+        if self.needs_midimap():
+            if session is None:
+                raise IndexError("No session found in outfile.")
+            session.append(self.new_midimap())
+        self.report_missing_cells()
+
+    def visit_unit(self, unit) -> bool:
+        """
+        Patches a single child of the session in place.
+        Returns False, if the unit has to be removed from the target.
+        """
+        mm = self.mapper
+        if unit.tag == "midimap" and self.needs_midimap():
+            # like `MidiMapper.insert_map_items` the template is merged into
+            # the first midimap
+            self.merge_midimap(unit)
+        if not self.wipe_modsources(unit):
+            return False
+        cell_index = CellIndex(unit, self.coordinates)
+
+        for key, cell in cell_index.cells.items():
+            if key in self.claimed_cells:
+                continue
+            self.claimed_cells.add(key)
+            if key in self.modsources:
+                mm.insert_cell_modsources(self.modsources[key], cell)
+
+        pad_targets = {}
+        for key, params in cell_index.pad_params.items():
+            if key not in self.pad_targets:
+                pad_targets[key] = params
+        for key, params_outfile in pad_targets.items():
+            for params in self.pad_params.get(key, []):
+                mm.copy_params(params, params_outfile, mm.device_settings.pad_params)
+
+        noteseq_targets = {}
+        for key, params in cell_index.noteseq_params.items():
+            if key not in self.noteseq_targets:
+                noteseq_targets[key] = params
+        self.pad_targets.update(pad_targets)
+        self.noteseq_targets.update(noteseq_targets)
+
+        # the targets of this unit are complete now, so the params are copied
+        # right away and the unit isn't referenced after the visit
+        self.copy_noteseq_params(noteseq_targets, pad_targets)
+        return True
+
+    def wipe_modsources(self, unit) -> bool:
+        # one pass over the modsources of the unit instead of one XPath query
+        # per selected source
+        mm = self.mapper
+        if not mm.wipe_existing_mappings or not self.mod_sources:
+            return True
+        if unit.tag == "modsource" and unit.get("src") in self.mod_sources:
+            mm.count("nodes_removed")
+            return False
+        for modsource in list(unit.iter("modsource")):
+            if modsource.get("src") in self.mod_sources:
+                mm.delete_node(modsource)
+        return True
+
+    def copy_noteseq_params(self, noteseq_targets, pad_targets):
+        mm = self.mapper
+        for index, (noteseq_key, pad_key, params) in enumerate(self.noteseq_params):
+            # it might be that the sequence hasn't been initialized yet and in that case
+            # the seqsublayer is empty
+            if noteseq_key in self.noteseq_keys:
+                params_outfile = noteseq_targets.get(noteseq_key)
+            else:
+                params_outfile = pad_targets.get(pad_key)
+            if params_outfile is None:
+                continue
+            mm.copy_params(params, params_outfile, mm.device_settings.noteseq_params)
+            self.applied_noteseq_params.add(index)
+
+    def needs_midimap(self) -> bool:
+        # the midimap is created at the end of the session, like
+        # `MidiMapper.insert_map_items` does, if there is none to merge into
+        return (
+            self.mapper.tenten_device in TENTEN_MIDIMAP_ITEMS
+            and not self.midimap_merged
+        )
+
+    def merge_midimap(self, midimap):
+        self.midimap_merge.merge(
+            midimap, self.mapper, self.mapper.wipe_existing_mappings
+        )
+        self.midimap_merged = True
+
+    def new_midimap(self):
+        midimap = etree.Element("midimap")
+        self.merge_midimap(midimap)
+        return midimap
+
+    def report_missing_cells(self):
+        missing = []
+        for key, modsources in self.modsources.items():
+            if key not in self.claimed_cells:
+                missing.append(modsources[0].getparent().attrib)
+        for key, params in self.pad_params.items():
+            if key not in self.pad_targets:
+                missing.append(params[0].getparent().attrib)
+        for index, (_, _, params) in enumerate(self.noteseq_params):
+            if index not in self.applied_noteseq_params:
+                missing.append(params.getparent().attrib)
+        for attrib in missing:
+            print(
+                f"Cell not found in outfile for row {attrib['row']} and column {attrib['column']}"
+            )
+
+
+class LayeredCellVisitor(CellVisitor):
+    """
+    Applies the templates of several mappers (see `MidiMapper.add_template`)
+    to a target in a single visit.
+
+    The modsources of all selected sources of all templates are wiped once,
+    then every unit is visited by the `CellVisitor` of each template in their
+    order, which only inserts. So the modsources of the templates don't wipe
+    each other, they are placed into the slots of their destination one after
+    another. Where two templates set the same param or map the same controller
+    or parameter in the midimap, the later one wins.
+    """
+
+    def __init__(self, mappers):
+        self.mapper = mappers[0]
+        self.visitors = [CellVisitor(mapper) for mapper in mappers]
+        self.mod_sources = set()
+        for visitor in self.visitors:
+            self.mod_sources.update(visitor.mod_sources)
+            # the layers only insert, see `visit_unit`
+            visitor.mod_sources = set()
+        self.noteseq_params = [
+            params for visitor in self.visitors for params in visitor.noteseq_params
+        ]
+
+    def start(self, noteseq_keys):
+        for visitor in self.visitors:
+            visitor.start(noteseq_keys)
+
+    def visit_unit(self, unit) -> bool:
+        if not self.wipe_modsources(unit):
+            return False
+        for visitor in self.visitors:
+            visitor.visit_unit(unit)
+        return True
+
+    def needs_midimap(self) -> bool:
+        return any(visitor.needs_midimap() for visitor in self.visitors)
+
+    def new_midimap(self):
+        # the first template creates the midimap, the others merge into it
+        midimap = None
+        for visitor in self.visitors:
+            if not visitor.needs_midimap():
+                continue
+            if midimap is None:
+                midimap = visitor.new_midimap()
+            else:
+                visitor.merge_midimap(midimap)
+        return midimap
+
+    def report_missing_cells(self):
+        for visitor in self.visitors:
+            visitor.report_missing_cells()
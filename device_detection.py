@@ -0,0 +1,254 @@
+"""
+Detects the TenTen device of a preset from the first few KB of the file and
+finds the presets of every device in a library:
+
+    python device_detection.py /path/to/library/
+
+Only the head of a file is parsed. The root has to be a `document` with a
+`session`. The extension selects the candidate devices and the coordinate
+attributes of the cells (see `cell_coordinates`) tell them apart.
+"""
+
+import argparse
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from lxml import etree
+
+from cell_index import cell_coordinates
+from models import (
+    NOTESEQ_PARAM_DEVICES,
+    PROJECT_FILENAMES,
+    TENTEN_EXTENSIONS,
+    TenTenDevice,
+)
+
+# bytes of a file, which are parsed to detect its device
+SNIFF_SIZE = 16 * 1024
+PRESET_EXTENSIONS = tuple(sorted({"." + e for e in TENTEN_EXTENSIONS.values()}))
+
+
+def extension_devices(path: str) -> list:
+    """
+    Returns the devices, which use the extension of the file.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    return [d for d in TenTenDevice if "." + TENTEN_EXTENSIONS[d.value] == extension]
+
+
+def cell_devices(cells: list, devices: list) -> list:
+    """
+    Returns the devices, whose coordinate attributes (see `cell_coordinates`)
+    all cells have. The devices with the most coordinates come first, as the
+    cells of a Blackbox also have the coordinates of a Bluebox.
+    """
+    names = set.intersection(*(set(attrib) for attrib in cells))
+    if any("seqsublayer" in attrib for attrib in cells):
+        # only the sequences of these devices have sub layers
+        devices = [d for d in devices if d in NOTESEQ_PARAM_DEVICES]
+    matches = [
+        d
+        for d in devices
+        if cell_coordinates(d) is not None and set(cell_coordinates(d)) <= names
+    ]
+    return sorted(matches, key=lambda d: -len(cell_coordinates(d)))
+
+
+def sniff_cells(head: bytes):
+    """
+    Parses the head of a preset and returns the attributes of its cells, None
+    if it isn't a preset.
+    """
+    parser = etree.XMLPullParser(events=("start",), resolve_entities=False)
+    try:
+        parser.feed(head)
+    except etree.XMLSyntaxError:
+        # the head of a preset may end anywhere and some presets have junk
+        # after their root, the elements before the error are still read
+        pass
+    cells = []
+    path = []
+    for _, element in parser.read_events():
+        if not path and element.tag != "document":
+            return None
+        path.append(element.tag)
+        if element.tag == "cell":
+            cells.append(dict(element.attrib))
+    if "session" not in path:
+        return None
+    return cells
+
+
+def detect_devices(path: str, sniff_size: int = SNIFF_SIZE) -> list:
+    """
+    Returns the devices the preset could belong to, the most likely first.
+
+    Blackbox and Tangerine presets have the same cell coordinates and the same
+    extension, a preset, which can't be told apart, belongs to both.
+
+    Args:
+        path (str): The preset file.
+        sniff_size (int): The number of bytes, which are parsed.
+
+    Returns:
+        list: The candidate devices, empty if the file isn't a TenTen preset.
+    """
+    devices = extension_devices(path)
+    if not devices:
+        return []
+    try:
+        with open(path, "rb") as f:
+            head = f.read(sniff_size)
+    except OSError:
+        return []
+    cells = sniff_cells(head)
+    if cells is None:
+        return []
+    if not cells:
+        # the cells come later in the file, only the extension tells
+        return devices
+    return cell_devices(cells, devices)
+
+
+def detect_device(path: str, sniff_size: int = SNIFF_SIZE):
+    """
+    Returns the most likely device of the preset, None if it isn't one.
+    """
+    devices = detect_devices(path, sniff_size)
+    return devices[0] if devices else None
+
+
+def preset_matcher(tenten_device=None, project_filename=None):
+    """
+    Returns a function, which checks whether a file name is a preset of the
+    device: the project file name for devices with project folders and the
+    extension for all others. Without a device, the files with the extension
+    of any device match.
+    """
+    if project_filename is None and tenten_device is not None:
+        project_filename = PROJECT_FILENAMES.get(tenten_device)
+    if project_filename is not None:
+        return lambda name: name == project_filename
+    if tenten_device is None:
+        return lambda name: name.lower().endswith(PRESET_EXTENSIONS)
+    extension = "." + TENTEN_EXTENSIONS[tenten_device.value]
+    return lambda name: name.lower().endswith(extension)
+
+
+def scan_folder(folder: str, matches=None):
+    # returns the subfolders and the files, which might be presets, as
+    # `os.DirEntry`, hidden entries and the folders macOS adds to zips are skipped
+    if matches is None:
+        matches = preset_matcher()
+    folders = []
+    files = []
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.name == "__MACOSX" or entry.name.startswith("."):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                folders.append(entry)
+            elif matches(entry.name) and entry.is_file():
+                files.append(entry)
+    return folders, files
+
+
+def walk_library(root_folder: str, matches=None):
+    """
+    Walks the library like `discover_presets`, but in this thread and without
+    the detection. The tools, which look for presets, all use one of the two,
+    so they agree on which files are presets.
+
+    Args:
+        root_folder (str): Folder with the presets.
+        matches: Function, which checks a file name, see `preset_matcher`.
+
+    Yields:
+        tuple: The path relative to the root folder (with "/" as separator)
+            and the `os.DirEntry` of every preset, in no particular order.
+    """
+    folders = [(root_folder, "")]
+    while folders:
+        folder, prefix = folders.pop()
+        try:
+            subfolders, files = scan_folder(folder, matches)
+        except OSError as e:
+            print(f"Error reading folder: {e}")
+            continue
+        for entry in subfolders:
+            folders.append((entry.path, prefix + entry.name + "/"))
+        for entry in files:
+            yield prefix + entry.name, entry
+
+
+def discover_presets(root_folder: str, tenten_devices=None, max_workers=None):
+    """
+    Walks the library and detects the device of every preset in parallel.
+
+    The presets are yielded as soon as they are detected, so the mapping can
+    start before the walk of a large library is finished. The order is not
+    deterministic.
+
+    Args:
+        root_folder (str): Folder with the presets.
+        tenten_devices (list): Only yield the presets of these devices.
+        max_workers (int): Number of threads for the walk and the detection.
+
+    Yields:
+        tuple: The path and the candidate devices of every preset.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {executor.submit(scan_folder, root_folder): "folder"}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                kind = pending.pop(future)
+                if kind == "folder":
+                    try:
+                        folders, files = future.result()
+                    except OSError as e:
+                        print(f"Error reading folder: {e}")
+                        continue
+                    for entry in folders:
+                        pending[executor.submit(scan_folder, entry.path)] = "folder"
+                    for entry in files:
+                        pending[executor.submit(detect_devices, entry.path)] = (
+                            entry.path
+                        )
+                    continue
+                devices = future.result()
+                if tenten_devices is not None:
+                    devices = [d for d in devices if d in tenten_devices]
+                if devices:
+                    yield kind, devices
+
+
+def group_presets(root_folder: str, tenten_devices=None, max_workers=None) -> dict:
+    """
+    Returns the sorted presets of the library per device. A preset of several
+    candidate devices is only listed under the first one of `tenten_devices`
+    (or the most likely one).
+    """
+    groups = {}
+    for path, devices in discover_presets(root_folder, tenten_devices, max_workers):
+        if tenten_devices is not None:
+            devices = [d for d in tenten_devices if d in devices]
+        groups.setdefault(devices[0], []).append(path)
+    return {device: sorted(paths) for device, paths in groups.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="List the presets of a library per TenTen device."
+    )
+    parser.add_argument("folder", help="Folder with the presets")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=None, help="Number of threads"
+    )
+
+    args = parser.parse_args()
+
+    for device, paths in group_presets(args.folder, max_workers=args.jobs).items():
+        print(f"{device.value}: {len(paths)} presets")
+        for path in paths:
+            print(f"  {path}")
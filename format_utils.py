@@ -0,0 +1,2 @@
+def format_size(nbytes: int) -> str:
+    return f"{nbytes / (1024 * 1024):.1f} MB"
@@ -0,0 +1,515 @@
+#!/usr/bin/env python3
+
+"""
+Indexes the mappings of a whole preset library in a SQLite database, so that
+questions like "which presets map CC 74 on channel 1" don't need to parse every
+preset again:
+
+    python mapping_index.py -d library.db index -t blackbox ./presets
+    python mapping_index.py -d library.db cc --ccnum 74 --mchan 1
+    python mapping_index.py -d library.db param --name outputbus --value 3
+    python mapping_index.py -d library.db missing -t blackbox -i template/preset.xml
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import time
+
+from device_detection import preset_matcher, walk_library
+from mapping_plan import file_hash
+from midi_mapper import MidiMapper
+from xml_parser import parse_xml
+from models import (
+    TenTenDevice,
+    ModSources,
+    BlackboxSettings,
+    BlackboxPadParam,
+    BlackboxNoteseqParam,
+    GeneralMidiSettings,
+    TENTEN_EXTENSIONS,
+    PROJECT_FILENAMES,
+    PADPARAM_DEVICES,
+    NOTESEQ_PARAM_DEVICES,
+)
+
+INDEX_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    device TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    recovered INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS modsources (
+    file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    cell_row TEXT,
+    cell_column TEXT,
+    cell_layer TEXT,
+    cell_synth TEXT,
+    src TEXT,
+    dest TEXT,
+    slot TEXT,
+    mchan TEXT,
+    ccnum TEXT
+);
+CREATE TABLE IF NOT EXISTS mapitems (
+    file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    mchan TEXT,
+    ccnum TEXT,
+    target TEXT,
+    dest TEXT
+);
+CREATE TABLE IF NOT EXISTS params (
+    file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    kind TEXT NOT NULL,
+    cell_row TEXT,
+    cell_column TEXT,
+    cell_layer TEXT,
+    name TEXT NOT NULL,
+    value TEXT
+);
+CREATE INDEX IF NOT EXISTS modsources_file ON modsources(file_id, src, dest);
+CREATE INDEX IF NOT EXISTS modsources_cc ON modsources(ccnum, mchan);
+CREATE INDEX IF NOT EXISTS modsources_src ON modsources(src);
+CREATE INDEX IF NOT EXISTS mapitems_file ON mapitems(file_id, ccnum);
+CREATE INDEX IF NOT EXISTS mapitems_cc ON mapitems(ccnum, mchan);
+CREATE INDEX IF NOT EXISTS params_file ON params(file_id, kind, name);
+CREATE INDEX IF NOT EXISTS params_value ON params(name, value);
+"""
+
+MODSOURCE_COLUMNS = (
+    "cell_row",
+    "cell_column",
+    "cell_layer",
+    "cell_synth",
+    "src",
+    "dest",
+    "slot",
+    "mchan",
+    "ccnum",
+)
+MAPITEM_COLUMNS = ("mchan", "ccnum", "target", "dest")
+PARAM_COLUMNS = ("kind", "cell_row", "cell_column", "cell_layer", "name", "value")
+TABLE_COLUMNS = {
+    "modsources": MODSOURCE_COLUMNS,
+    "mapitems": MAPITEM_COLUMNS,
+    "params": PARAM_COLUMNS,
+}
+
+# the columns, which have to match for a template mapping to be present in a
+# target, the slot of a modsource may differ
+MISSING_COLUMNS = {
+    "modsources": (
+        "cell_row",
+        "cell_column",
+        "cell_layer",
+        "cell_synth",
+        "src",
+        "dest",
+        "mchan",
+        "ccnum",
+    ),
+    "mapitems": MAPITEM_COLUMNS,
+    "params": PARAM_COLUMNS,
+}
+
+
+def find_presets(folder: str, tenten_device: TenTenDevice) -> list:
+    """
+    Returns the paths of all presets of the device in the folder and its
+    subfolders, sorted by path.
+    """
+    matches = preset_matcher(tenten_device)
+    return sorted(
+        os.path.abspath(entry.path) for _, entry in walk_library(folder, matches)
+    )
+
+
+def index_mapper(tenten_device: TenTenDevice) -> MidiMapper:
+    # a mapper with every mod source and param selected, only its extractors
+    # are used
+    device_settings = None
+    if tenten_device in PADPARAM_DEVICES or tenten_device in NOTESEQ_PARAM_DEVICES:
+        device_settings = BlackboxSettings(
+            pad_params=[p for p in BlackboxPadParam],
+            noteseq_params=[p for p in BlackboxNoteseqParam],
+        )
+    return MidiMapper(
+        tenten_device=tenten_device,
+        device_settings=device_settings,
+        general_midi_settings=GeneralMidiSettings(mod_sources=[m for m in ModSources]),
+    )
+
+
+def extract_rows(mapper: MidiMapper, root) -> dict:
+    """
+    Returns the rows of the modsources, mapitems and selected params of a
+    parsed preset, keyed by table.
+    """
+    modsources = []
+    for modsource in mapper.filter_midi_modsources(root):
+        cell = modsource.getparent().attrib
+        modsources.append(
+            (
+                cell.get("row"),
+                cell.get("column"),
+                cell.get("layer"),
+                cell.get("synth"),
+                modsource.get("src"),
+                modsource.get("dest"),
+                modsource.get("slot"),
+                modsource.get("mchan"),
+                modsource.get("ccnum"),
+            )
+        )
+    mapitems = [
+        tuple(mapitem.get(name) for name in MAPITEM_COLUMNS)
+        for mapitem in mapper.filter_map_items(root)
+    ]
+    params = []
+    if mapper.tenten_device in PADPARAM_DEVICES:
+        params += param_rows(
+            "pad",
+            mapper.filter_pad_params(root),
+            mapper.device_settings.pad_params,
+        )
+    if mapper.tenten_device in NOTESEQ_PARAM_DEVICES:
+        params += param_rows(
+            "noteseq",
+            mapper.filter_noteseq_params(root),
+            mapper.device_settings.noteseq_params,
+        )
+    return {"modsources": modsources, "mapitems": mapitems, "params": params}
+
+
+def param_rows(kind, params_list, names) -> list:
+    rows = []
+    for params in params_list:
+        cell = params.getparent().attrib
+        for name in names:
+            name = getattr(name, "value", name)
+            value = params.get(name)
+            if value is None:
+                continue
+            rows.append(
+                (
+                    kind,
+                    cell.get("row"),
+                    cell.get("column"),
+                    cell.get("layer"),
+                    name,
+                    value,
+                )
+            )
+    return rows
+
+
+class MappingIndex:
+    """
+    SQLite index of the modsources, mapitems and selected params of a preset
+    library.
+
+    Every preset is stored with its mtime, size and content hash. A re-index
+    only parses presets whose mtime or size changed and whose hash differs, and
+    removes the presets which no longer exist.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.db = sqlite3.connect(db_path)
+        self.db.execute("PRAGMA foreign_keys = ON")
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.create_schema()
+
+    def create_schema(self):
+        row = None
+        try:
+            row = self.db.execute(
+                "SELECT value FROM meta WHERE key = 'version'"
+            ).fetchone()
+        except sqlite3.OperationalError:
+            pass
+        if row is not None and row[0] != str(INDEX_VERSION):
+            # an index of another version is simply built again
+            for table in ("modsources", "mapitems", "params", "files", "meta"):
+                self.db.execute(f"DROP TABLE IF EXISTS {table}")
+        self.db.executescript(SCHEMA)
+        self.db.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)",
+            (str(INDEX_VERSION),),
+        )
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def index_folder(self, folder: str, tenten_device: TenTenDevice) -> dict:
+        """
+        Brings the index up to date with the presets of the device in the
+        folder.
+
+        Returns:
+            dict: The number of presets which were indexed, unchanged and removed.
+        """
+        return self.index_files(
+            find_presets(folder, tenten_device),
+            tenten_device,
+            prune_folder=folder,
+        )
+
+    def index_files(self, paths, tenten_device: TenTenDevice, prune_folder=None):
+        mapper = index_mapper(tenten_device)
+        known = {
+            path: (file_id, mtime, size, hash)
+            for file_id, path, mtime, size, hash in self.db.execute(
+                "SELECT id, path, mtime, size, hash FROM files WHERE device = ?",
+                (tenten_device.value,),
+            )
+        }
+        stats = {"indexed": 0, "unchanged": 0, "removed": 0, "errors": 0}
+        seen = set()
+        with self.db:
+            for path in paths:
+                path = os.path.abspath(path)
+                seen.add(path)
+                try:
+                    stat = os.stat(path)
+                except OSError as e:
+                    print(f"Error indexing file {path}: {e}")
+                    stats["errors"] += 1
+                    continue
+                entry = known.get(path)
+                if entry is not None and entry[1:3] == (stat.st_mtime, stat.st_size):
+                    stats["unchanged"] += 1
+                    continue
+                content_hash = file_hash(path)
+                if entry is not None and entry[3] == content_hash:
+                    # touched, but not changed
+                    self.db.execute(
+                        "UPDATE files SET mtime = ?, size = ? WHERE id = ?",
+                        (stat.st_mtime, stat.st_size, entry[0]),
+                    )
+                    stats["unchanged"] += 1
+                    continue
+                try:
+                    with open(path, "rb") as f:
+                        root, recovered = parse_xml(f.read())
+                except Exception as e:
+                    print(f"Error indexing file {path}: {e}")
+                    stats["errors"] += 1
+                    continue
+                self.store(
+                    path,
+                    tenten_device,
+                    stat,
+                    content_hash,
+                    recovered,
+                    extract_rows(mapper, root),
+                )
+                stats["indexed"] += 1
+            if prune_folder is not None:
+                prefix = os.path.join(os.path.abspath(prune_folder), "")
+                for path, entry in known.items():
+                    if path.startswith(prefix) and path not in seen:
+                        self.db.execute("DELETE FROM files WHERE id = ?", (entry[0],))
+                        stats["removed"] += 1
+        return stats
+
+    def store(self, path, tenten_device, stat, content_hash, recovered, rows):
+        self.db.execute("DELETE FROM files WHERE path = ?", (path,))
+        file_id = self.db.execute(
+            "INSERT INTO files (path, device, mtime, size, hash, recovered) "
+            + "VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                path,
+                tenten_device.value,
+                stat.st_mtime,
+                stat.st_size,
+                content_hash,
+                int(recovered),
+            ),
+        ).lastrowid
+        for table, columns in TABLE_COLUMNS.items():
+            self.db.executemany(
+                f"INSERT INTO {table} (file_id, {', '.join(columns)}) "
+                + f"VALUES (?, {', '.join('?' * len(columns))})",
+                [(file_id,) + row for row in rows[table]],
+            )
+
+    def presets_with_cc(self, ccnum, mchan=None, tenten_device=None) -> list:
+        """
+        Returns the paths of the presets, which map the CC in a modsource or a
+        mapitem. The channel is compared as it is stored in the preset.
+        """
+        ccnum = str(ccnum)
+        conditions = ["ccnum = ?"]
+        params = [ccnum]
+        if mchan is not None:
+            conditions.append("mchan = ?")
+            params.append(str(mchan))
+        where = " AND ".join(conditions)
+        query = (
+            "SELECT path FROM files WHERE id IN ("
+            + f"SELECT file_id FROM modsources WHERE {where} "
+            + f"UNION SELECT file_id FROM mapitems WHERE {where})"
+        )
+        params = params + params
+        if tenten_device is not None:
+            query += " AND device = ?"
+            params.append(tenten_device.value)
+        return [row[0] for row in self.db.execute(query + " ORDER BY path", params)]
+
+    def presets_with_param(self, name, value, kind=None, tenten_device=None) -> list:
+        """
+        Returns the paths of the presets with at least one cell, whose param
+        has the value.
+        """
+        query = (
+            "SELECT path FROM files WHERE id IN ("
+            + "SELECT file_id FROM params WHERE name = ? AND value = ?"
+        )
+        params = [name, str(value)]
+        if kind is not None:
+            query += " AND kind = ?"
+            params.append(kind)
+        query += ")"
+        if tenten_device is not None:
+            query += " AND device = ?"
+            params.append(tenten_device.value)
+        return [row[0] for row in self.db.execute(query + " ORDER BY path", params)]
+
+    def presets_missing_template(self, template_path, tenten_device) -> list:
+        """
+        Returns the presets of the device, which lack at least one mapping of
+        the template, with the number of missing mappings.
+        """
+        with open(template_path, "rb") as f:
+            root = parse_xml(f.read())[0]
+        rows = extract_rows(index_mapper(tenten_device), root)
+        template_path = os.path.abspath(template_path)
+        missing = {}
+        for table, columns in MISSING_COLUMNS.items():
+            indices = [TABLE_COLUMNS[table].index(c) for c in columns]
+            template_rows = {tuple(row[i] for i in indices) for row in rows[table]}
+            if not template_rows:
+                continue
+            self.db.execute(f"DROP TABLE IF EXISTS temp.template_{table}")
+            self.db.execute(
+                f"CREATE TEMP TABLE template_{table} ({', '.join(columns)})"
+            )
+            self.db.executemany(
+                f"INSERT INTO temp.template_{table} "
+                + f"VALUES ({', '.join('?' * len(columns))})",
+                template_rows,
+            )
+            # `IS` also matches the attributes missing on both sides
+            match = " AND ".join(f"m.{c} IS t.{c}" for c in columns)
+            query = (
+                f"SELECT f.path, COUNT(*) FROM files f, temp.template_{table} t "
+                + "WHERE f.device = ? AND f.path != ? AND NOT EXISTS ("
+                + f"SELECT 1 FROM {table} m WHERE m.file_id = f.id AND {match}) "
+                + "GROUP BY f.path"
+            )
+            for path, count in self.db.execute(
+                query, (tenten_device.value, template_path)
+            ):
+                missing[path] = missing.get(path, 0) + count
+            self.db.execute(f"DROP TABLE temp.template_{table}")
+        self.db.commit()
+        return sorted(missing.items())
+
+    def count_files(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Index the MIDI mappings of a preset library and query them."
+    )
+    parser.add_argument(
+        "-d", "--database", required=True, help="SQLite database of the index"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    index_parser = commands.add_parser("index", help="Add or update presets")
+    index_parser.add_argument("folder", help="Folder with the presets")
+    index_parser.add_argument(
+        "-t",
+        "--tenten_device",
+        required=True,
+        choices=[d.value for d in TenTenDevice],
+        help="TenTen device type",
+    )
+
+    cc_parser = commands.add_parser("cc", help="Presets, which map a MIDI CC")
+    cc_parser.add_argument("--ccnum", required=True, help="CC number")
+    cc_parser.add_argument(
+        "--mchan", default=None, help="MIDI channel as stored in the preset"
+    )
+
+    param_parser = commands.add_parser("param", help="Presets with a param value")
+    param_parser.add_argument("--name", required=True, help="Param, e.g. outputbus")
+    param_parser.add_argument("--value", required=True, help="Value of the param")
+    param_parser.add_argument(
+        "--kind", choices=["pad", "noteseq"], default=None, help="Kind of the cell"
+    )
+
+    missing_parser = commands.add_parser(
+        "missing", help="Presets, which lack mappings of a template"
+    )
+    missing_parser.add_argument("-i", "--infile", required=True, help="Template")
+    missing_parser.add_argument(
+        "-t",
+        "--tenten_device",
+        required=True,
+        choices=[d.value for d in TenTenDevice],
+        help="TenTen device type",
+    )
+
+    args = parser.parse_args()
+
+    with MappingIndex(args.database) as index:
+        start = time.perf_counter()
+        if args.command == "index":
+            if not os.path.isdir(args.folder):
+                print(f"Error: Folder '{args.folder}' does not exist.")
+                sys.exit(1)
+            stats = index.index_folder(args.folder, TenTenDevice(args.tenten_device))
+            print(
+                f"Indexed {stats['indexed']}, unchanged {stats['unchanged']}, "
+                + f"removed {stats['removed']}, errors {stats['errors']} "
+                + f"({index.count_files()} presets in the index)."
+            )
+        elif args.command == "cc":
+            for path in index.presets_with_cc(args.ccnum, args.mchan):
+                print(path)
+        elif args.command == "param":
+            for path in index.presets_with_param(args.name, args.value, args.kind):
+                print(path)
+        elif args.command == "missing":
+            if not os.path.isfile(args.infile):
+                print(f"Error: Infile '{args.infile}' does not exist.")
+                sys.exit(1)
+            for path, count in index.presets_missing_template(
+                args.infile, TenTenDevice(args.tenten_device)
+            ):
+                print(f"{path}\t{count} missing")
+        print(
+            f"Done in {(time.perf_counter() - start) * 1000:.1f} ms.", file=sys.stderr
+        )
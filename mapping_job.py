@@ -0,0 +1,72 @@
+import threading
+import time
+
+
+class MappingJob:
+    """
+    Runs a mapping function on a background thread, so that a UI can show the
+    progress and stop it in between.
+
+    The progress and cancellation hooks of the mapper are connected to the job.
+    The function must not touch any UI state, it only gets the mapper.
+    """
+
+    def __init__(self, mapper, func):
+        self.mapper = mapper
+        self.func = func
+        self.cancel_event = threading.Event()
+        self.done = 0
+        self.total = 0
+        self.result = None
+        self.error = None
+        self.start_time = None
+        self.end_time = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        mapper.progress_callback = self.on_progress
+        mapper.cancel_event = self.cancel_event
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self.thread.start()
+
+    def run(self):
+        try:
+            self.result = self.func(self.mapper)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.end_time = time.perf_counter()
+
+    def on_progress(self, done: int, total: int):
+        self.done = done
+        self.total = total
+
+    def cancel(self):
+        """
+        Stops the job after the current file and waits for it.
+        """
+        self.cancel_event.set()
+        self.wait()
+
+    def wait(self, timeout=None):
+        if self.thread.is_alive():
+            self.thread.join(timeout)
+
+    def running(self) -> bool:
+        return self.thread.is_alive()
+
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    def fraction(self) -> float:
+        if self.total == 0:
+            return 0.0
+        return min(1.0, self.done / self.total)
+
+    def files_per_second(self) -> float:
+        if self.start_time is None:
+            return 0.0
+        elapsed = (self.end_time or time.perf_counter()) - self.start_time
+        if elapsed <= 0:
+            return 0.0
+        return self.done / elapsed
@@ -0,0 +1,184 @@
+import hashlib
+import json
+import os
+import tempfile
+from typing import Optional
+
+from lxml import etree
+from pydantic import BaseModel, Field
+
+PLAN_VERSION = 1
+
+# the cell attributes, which are needed to find the cell in a target again
+PLAN_CELL_ATTRIBUTES = ["row", "column", "layer", "synth", "seqsublayer"]
+
+
+class PlanNode(BaseModel):
+    """
+    A single modsource, mapitem or params node of the template.
+    """
+
+    cell: dict = Field(default_factory=dict)
+    attrib: dict = Field(default_factory=dict)
+    # the whitespace after the node is kept, so the written files don't change
+    # compared to copying the node from the parsed template
+    tail: Optional[str] = None
+
+
+class MappingPlan(BaseModel):
+    """
+    Everything `MidiMapper` extracts from a template for the selected settings.
+    """
+
+    version: int = PLAN_VERSION
+    template_hash: str = ""
+    settings_hash: str = ""
+    modsources: list[PlanNode] = Field(default_factory=list)
+    mapitems: list[PlanNode] = Field(default_factory=list)
+    pad_params: list[PlanNode] = Field(default_factory=list)
+    noteseq_params: list[PlanNode] = Field(default_factory=list)
+
+
+def _value(key):
+    return getattr(key, "value", key)
+
+
+def file_hash(filepath) -> str:
+    h = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def settings_hash(
+    tenten_device, general_midi_settings, device_settings, remove_blank_text=False
+) -> str:
+    settings = {
+        "version": PLAN_VERSION,
+        "tenten_device": _value(tenten_device),
+        "mod_sources": [_value(m) for m in general_midi_settings.mod_sources],
+        "pad_params": [],
+        "noteseq_params": [],
+    }
+    if device_settings is not None:
+        settings["pad_params"] = [_value(p) for p in device_settings.pad_params]
+        settings["noteseq_params"] = [_value(p) for p in device_settings.noteseq_params]
+    if remove_blank_text:
+        # the whitespace of the template ends up in the plan
+        settings["remove_blank_text"] = True
+    return hashlib.sha256(json.dumps(settings).encode()).hexdigest()
+
+
+def plan_hash(plan: MappingPlan) -> str:
+    # the hashes the plan is stored under don't change what it does
+    data = plan.model_dump_json(exclude={"template_hash", "settings_hash"})
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def _plan_node(node, keys=None) -> PlanNode:
+    parent = node.getparent()
+    cell = {}
+    if parent is not None and parent.tag == "cell":
+        cell = {k: parent.attrib[k] for k in PLAN_CELL_ATTRIBUTES if k in parent.attrib}
+    if keys is None:
+        attrib = dict(node.attrib)
+    else:
+        attrib = {k: node.attrib[k] for k in keys if k in node.attrib}
+    return PlanNode(cell=cell, attrib=attrib, tail=node.tail)
+
+
+def compile_plan(
+    modsources,
+    mapitems,
+    pad_params,
+    noteseq_params,
+    device_settings=None,
+    template_hash="",
+    settings_hash="",
+) -> MappingPlan:
+    """
+    Compiles the nodes extracted from a template into a `MappingPlan`.
+    For params only the attributes selected in the device settings are kept.
+    """
+    pad_keys = []
+    noteseq_keys = []
+    if device_settings is not None:
+        pad_keys = [_value(k) for k in device_settings.pad_params]
+        noteseq_keys = [_value(k) for k in device_settings.noteseq_params]
+    return MappingPlan(
+        template_hash=template_hash,
+        settings_hash=settings_hash,
+        modsources=[_plan_node(n) for n in modsources],
+        mapitems=[_plan_node(n) for n in mapitems],
+        pad_params=[_plan_node(n, pad_keys) for n in pad_params],
+        noteseq_params=[_plan_node(n, noteseq_keys) for n in noteseq_params],
+    )
+
+
+def _plan_elements(nodes, tag):
+    elements = []
+    for node in nodes:
+        if node.cell:
+            cell = etree.Element("cell", node.cell)
+            elem = etree.SubElement(cell, tag, node.attrib)
+        else:
+            elem = etree.Element(tag, node.attrib)
+        elem.tail = node.tail
+        elements.append(elem)
+    return elements
+
+
+def plan_elements(plan: MappingPlan) -> tuple:
+    """
+    Turns a plan back into detached elements, which can be used in place of the
+    nodes extracted from a parsed template.
+    Returns (modsources, mapitems, pad_params, noteseq_params).
+    """
+    return (
+        _plan_elements(plan.modsources, "modsource"),
+        _plan_elements(plan.mapitems, "mapitem"),
+        _plan_elements(plan.pad_params, "params"),
+        _plan_elements(plan.noteseq_params, "params"),
+    )
+
+
+class PlanCache:
+    """
+    Stores compiled plans in a folder, keyed by template and settings hash.
+    """
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def path(self, template_hash: str, settings_hash: str) -> str:
+        return os.path.join(self.folder, f"{template_hash}-{settings_hash}.json")
+
+    def load(self, template_hash: str, settings_hash: str) -> MappingPlan:
+        path = self.path(template_hash, settings_hash)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                plan = MappingPlan.model_validate_json(f.read())
+        except ValueError:
+            # a broken cache file is recompiled
+            return None
+        if plan.version != PLAN_VERSION:
+            return None
+        return plan
+
+    def save(self, plan: MappingPlan):
+        path = self.path(plan.template_hash, plan.settings_hash)
+        # write to a temporary file first, so that concurrent runs never read
+        # a half written plan
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(plan.model_dump_json())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return path
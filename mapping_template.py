@@ -0,0 +1,148 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from pydantic import BaseModel, ConfigDict
+
+from mapping_plan import MappingPlan, settings_hash
+from midi_mapper import MidiMapper
+from models import BlackboxSettings, GeneralMidiSettings, TenTenDevice
+from xml_parser import parse_xml
+
+# number of templates kept by the process wide cache
+TEMPLATE_CACHE_SIZE = 32
+
+
+class MappingTemplate(BaseModel):
+    """
+    A parsed and filtered template for one set of settings.
+
+    It only holds plain data (the compiled `MappingPlan`) and is never changed,
+    so a single instance can be shared by all threads and sessions. Every job
+    uses it through its own `MidiMapper(template=...)`.
+    """
+
+    model_config = ConfigDict(frozen=True)
+
+    template_hash: str
+    tenten_device: TenTenDevice
+    general_midi_settings: GeneralMidiSettings
+    device_settings: Optional[BlackboxSettings] = None
+    remove_blank_text: bool = False
+    plan: MappingPlan
+
+    @classmethod
+    def from_bytes(
+        cls,
+        xml: bytes,
+        tenten_device,
+        general_midi_settings,
+        device_settings=None,
+        remove_blank_text=False,
+    ):
+        template_hash = hashlib.sha256(xml).hexdigest()
+        mm = MidiMapper(
+            tenten_device=tenten_device,
+            general_midi_settings=general_midi_settings,
+            device_settings=device_settings,
+            remove_blank_text=remove_blank_text,
+        )
+        mm.root_infile = parse_xml(xml, remove_blank_text)[0]
+        mm.extract_template_data()
+        plan = mm.compile_plan(
+            template_hash,
+            settings_hash(
+                tenten_device,
+                general_midi_settings,
+                device_settings,
+                remove_blank_text,
+            ),
+        )
+        # the settings are copied, so later changes of the caller don't leak
+        # into the shared template
+        return cls(
+            template_hash=template_hash,
+            tenten_device=tenten_device,
+            general_midi_settings=general_midi_settings.model_copy(deep=True),
+            device_settings=(
+                device_settings.model_copy(deep=True)
+                if device_settings is not None
+                else None
+            ),
+            remove_blank_text=remove_blank_text,
+            plan=plan,
+        )
+
+
+class TemplateCache:
+    """
+    Thread-safe LRU cache of `MappingTemplate`s, keyed by the hashes of the
+    template content and the settings.
+    """
+
+    def __init__(self, maxsize: int = TEMPLATE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.templates = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(
+        self,
+        xml: bytes,
+        tenten_device,
+        general_midi_settings,
+        device_settings=None,
+        remove_blank_text=False,
+    ) -> MappingTemplate:
+        key = (
+            hashlib.sha256(xml).hexdigest(),
+            settings_hash(
+                tenten_device,
+                general_midi_settings,
+                device_settings,
+                remove_blank_text,
+            ),
+        )
+        with self.lock:
+            template = self.templates.get(key)
+            if template is not None:
+                self.templates.move_to_end(key)
+                return template
+        # the template is compiled without holding the lock, two threads might
+        # compile the same one, but they don't block the others
+        template = MappingTemplate.from_bytes(
+            xml,
+            tenten_device,
+            general_midi_settings,
+            device_settings,
+            remove_blank_text,
+        )
+        with self.lock:
+            self.templates[key] = template
+            self.templates.move_to_end(key)
+            while len(self.templates) > self.maxsize:
+                self.templates.popitem(last=False)
+        return template
+
+    def clear(self):
+        with self.lock:
+            self.templates.clear()
+
+
+_template_cache = TemplateCache()
+
+
+def get_template(
+    xml: bytes,
+    tenten_device,
+    general_midi_settings,
+    device_settings=None,
+    remove_blank_text=False,
+) -> MappingTemplate:
+    """
+    Returns the shared template for the content and settings from the process
+    wide cache, it is only parsed if it isn't in there yet.
+    """
+    return _template_cache.get(
+        xml, tenten_device, general_midi_settings, device_settings, remove_blank_text
+    )
@@ -1,14 +1,44 @@
 #!/usr/bin/env python3
 
 import os
+import shutil
 import uuid
 import sys
 import argparse
+import hashlib
+import json
+import time
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
 
 from lxml import etree
 from copy import copy
 
-from mod_source_list import NUM_SLOTS, ModSourceList
+from mod_source_list import NUM_SLOTS, SlotPlanner
+from cell_index import CellIndex, cell_coordinates
+from cell_visitor import CellVisitor, LayeredCellVisitor
+from device_detection import detect_device, group_presets
+from midimap_merge import MidimapMerge
+from stream_patcher import StreamPatcher
+from xml_parser import parse_xml
+from run_manifest import RunManifest
+from run_report import (
+    CHANGE_COUNTERS,
+    RunProfiler,
+    RunReport,
+    TargetReport,
+    STATUS_ERROR,
+    STATUS_SKIPPED,
+)
+from mapping_plan import (
+    MappingPlan,
+    PlanCache,
+    compile_plan,
+    file_hash,
+    plan_elements,
+    plan_hash,
+    settings_hash,
+)
 
 # import models
 from models import (
@@ -19,38 +49,52 @@ from models import (
     ModSources,
     TENTEN_MIDIMAP_ITEMS,
     GeneralMidiSettings,
-    TENTEN_ROW_COLUMN_LAYER,
-    TENTEN_ROW_COLUMN_SYNTH,
-    TENTEN_ROW_COLUMN,
-    TENTEN_ROW_LAYER,
+    PADPARAM_DEVICES,
+    NOTESEQ_PARAM_DEVICES,
 )
 
 ROOT_FOLDER = os.path.dirname(os.path.abspath(__file__))
 
 DEFAULT_SLOT = "1"
 
-PADPARAM_DEVICES = [TenTenDevice.BLACKBOX]
-NOTESEQ_PARAM_DEVICES = [TenTenDevice.BLACKBOX]
-
 
 class MidiMapper:
     def __init__(
         self,
         infile: str = "",
-        outfiles: list = [],
+        outfiles: list = None,
         overwrite_files: bool = False,
         tenten_device=TenTenDevice.BLACKBOX,
         general_midi_settings=None,
         device_settings=None,
+        plan_cache_folder: str = None,
+        streaming: bool = False,
+        manifest_file: str = None,
+        remove_blank_text: bool = False,
+        progress_callback=None,
+        cancel_event=None,
+        template=None,
+        dedup_targets: bool = False,
+        canonical_dedup: bool = False,
+        templates: list = None,
     ):
         self.infile = infile
-        self.outfiles = outfiles
+        self.outfiles = list(outfiles or [])
         self.overwrite_files = overwrite_files
         self.wipe_existing_mappings = True
         self.tenten_device = tenten_device
         self.general_midi_settings = general_midi_settings
         self.device_settings = device_settings
-        self.parser = etree.XMLParser(recover=True)
+        self.remove_blank_text = remove_blank_text
+        # called with the number of finished and of all targets
+        self.progress_callback = progress_callback
+        # a `threading.Event`, which stops the run before the next target
+        self.cancel_event = cancel_event
+        self.template = None
+        # targets with the same content are only mapped once
+        self.dedup_targets = dedup_targets
+        # compare the canonical XML instead of the raw bytes
+        self.canonical_dedup = canonical_dedup
         self.root_infile = None
         self.result_files = []
         self.modsources_infile = []
@@ -58,6 +102,26 @@ class MidiMapper:
         self.pad_params_infile = []
         self.noteseq_params_infile = []
         self.outfile_subfolder = None
+        self.errors = []
+        self.plan = None
+        self.plan_cache_folder = plan_cache_folder
+        self.streaming = streaming
+        self.manifest_file = manifest_file
+        self.manifest = None
+        self.skipped_files = []
+        self.report = None
+        self.target_report = None
+        self.recovered_files = []
+        # mappers of the templates, which are applied after this one
+        self.layers = []
+        if template is not None and templates:
+            raise ValueError("Pass either a template or a list of templates.")
+        if template is not None:
+            self.use_template(template)
+        if templates:
+            self.use_template(templates[0])
+            for layer_template in templates[1:]:
+                self.add_template(layer_template)
 
     def reset(self):
         self.infile = ""
@@ -66,7 +130,12 @@ class MidiMapper:
         self.wipe_existing_mappings = True
         self.tenten_device = None
         self.general_midi_settings = None
-        self.parser = etree.XMLParser(recover=True)
+        self.remove_blank_text = False
+        self.progress_callback = None
+        self.cancel_event = None
+        self.template = None
+        self.dedup_targets = False
+        self.canonical_dedup = False
         self.root_infile = None
         self.result_files = []
         self.modsources_infile = []
@@ -74,16 +143,107 @@ class MidiMapper:
         self.pad_params_infile = []
         self.noteseq_params_infile = []
         self.outfile_subfolder = None
+        self.errors = []
+        self.plan = None
+        self.plan_cache_folder = None
+        self.streaming = False
+        self.manifest_file = None
+        self.manifest = None
+        self.skipped_files = []
+        self.report = None
+        self.target_report = None
+        self.recovered_files = []
+        self.layers = []
 
     def prepare_data(self):
         self.outfiles = self.filter_outfiles(self.outfiles)
+        self.prepare_template()
+        self.outfile_subfolder = self.get_output_folder()
+
+    def prepare_template(self):
         self.check_settings()
+        if self.plan is None:
+            self.prepare_plan()
+
+    def prepare_plan(self):
+        # without a cache (or when the template was read directly) the template
+        # is parsed and filtered as usual
+        if self.plan_cache_folder is None or self.root_infile is not None:
+            self.read_preset_file(self.infile)
+            self.extract_template_data()
+            return
+        cache = PlanCache(self.plan_cache_folder)
+        template_hash = file_hash(self.infile)
+        plan_settings_hash = settings_hash(
+            self.tenten_device,
+            self.general_midi_settings,
+            self.device_settings,
+            self.remove_blank_text,
+        )
+        plan = cache.load(template_hash, plan_settings_hash)
+        if plan is not None:
+            self.load_plan(plan)
+            return
         self.read_preset_file(self.infile)
+        self.extract_template_data()
+        self.plan = self.compile_plan(template_hash, plan_settings_hash)
+        cache.save(self.plan)
+
+    def compile_plan(self, template_hash="", plan_settings_hash="") -> MappingPlan:
+        return compile_plan(
+            modsources=self.modsources_infile,
+            mapitems=self.mapitems_infile,
+            pad_params=self.pad_params_infile,
+            noteseq_params=self.noteseq_params_infile,
+            device_settings=self.device_settings,
+            template_hash=template_hash,
+            settings_hash=plan_settings_hash,
+        )
+
+    def load_plan(self, plan: MappingPlan):
+        """
+        Uses a compiled plan instead of parsing and filtering the template.
+        """
+        self.plan = plan
+        (
+            self.modsources_infile,
+            self.mapitems_infile,
+            self.pad_params_infile,
+            self.noteseq_params_infile,
+        ) = plan_elements(plan)
+
+    def use_template(self, template):
+        """
+        Uses a shared `MappingTemplate` instead of reading the template file.
+        The template is never changed, so it can be used by many mappers at once.
+        """
+        self.template = template
+        self.tenten_device = template.tenten_device
+        self.general_midi_settings = template.general_midi_settings
+        self.device_settings = template.device_settings
+        self.remove_blank_text = template.remove_blank_text
+        self.load_plan(template.plan)
+
+    def add_template(self, template):
+        """
+        Applies another `MappingTemplate` with its own settings after the
+        template of this mapper. All templates are applied in the same parse,
+        patch and write of a target, see `LayeredCellVisitor`.
+        """
+        if template.tenten_device != self.tenten_device:
+            raise ValueError(
+                f"The template is for {template.tenten_device.value}, "
+                + f"but the mapper for {self.tenten_device.value}."
+            )
+        if template.remove_blank_text != self.remove_blank_text:
+            raise ValueError("All templates need the same remove_blank_text setting.")
+        self.layers.append(MidiMapper(template=template))
+
+    def extract_template_data(self):
         self.modsources_infile = self.filter_midi_modsources(self.root_infile)
         self.mapitems_infile = self.filter_map_items(self.root_infile)
         self.pad_params_infile = self.filter_pad_params(self.root_infile)
         self.noteseq_params_infile = self.filter_noteseq_params(self.root_infile)
-        self.outfile_subfolder = self.get_output_folder()
 
     def read_preset_file(self, file_path: str):
         if self.root_infile is None:
@@ -123,26 +283,373 @@ class MidiMapper:
     def read_xml_file(self, filepath):
         with open(filepath, "rb") as f:
             xml = f.read()
-            root = etree.fromstring(xml, parser=self.parser)
-            return root
+        return self.parse_xml(xml, filepath)
+
+    def parse_xml(self, xml: bytes, name: str):
+        root, recovered = parse_xml(xml, self.remove_blank_text)
+        if recovered:
+            self.mark_recovered(name)
+        return root
+
+    def mark_recovered(self, name):
+        print(f"Broken XML in file {name}, it was read in recover mode")
+        if self.target_report is not None:
+            self.target_report.recovered = True
+        else:
+            self.recovered_files.append(name)
 
-    def run(self):
+    def run(
+        self,
+        jobs: int = 1,
+        profile: bool = False,
+        trace_memory: bool = False,
+        return_report: bool = False,
+    ):
+        """
+        Maps the template onto all outfiles.
+
+        Returns the written files, or the `RunReport` with timings and counts
+        per target if `return_report` is set. The report is also kept in
+        `self.report`. With `profile` and `trace_memory` a cProfile and
+        tracemalloc capture of this process is added to the report.
+        """
+        with RunProfiler(profile, trace_memory) as profiler:
+            for _ in self.iter_run(jobs):
+                pass
+        profiler.fill_report(self.report)
+        if return_report:
+            return self.report
+        return self.result_files
+
+    def iter_run(self, jobs: int = 1):
+        """
+        Maps the template onto all outfiles and yields the `TargetReport` of
+        every target as soon as it has been written, so the results can be
+        used while the others are still mapped. Targets skipped by the manifest
+        come first, the others follow in the original order.
+
+        The tree of a target is released before its report is yielded.
+        """
+        start = time.perf_counter()
+        if jobs == 0:
+            jobs = os.cpu_count()
+        self.report = RunReport(jobs=jobs)
+        self.target_report = None
+        self.target_hashes = {}
+        prepare_start = time.perf_counter()
         self.prepare_data()
-        for outfile in self.outfiles:
+        self.report.phases["prepare"] = time.perf_counter() - prepare_start
+        outfiles = self.outfiles
+        target_reports = (report for report in ())
+        try:
+            if self.manifest_file is not None:
+                self.manifest = RunManifest(self.manifest_file)
+                outfiles = self.filter_up_to_date(outfiles)
+                self.report_progress(len(self.report.targets), len(self.outfiles))
+                yield from list(self.report.targets)
+            if self.cancelled():
+                outfiles = []
+            duplicates = {}
+            if self.dedup_targets:
+                outfiles, duplicates = self.group_duplicates(outfiles)
+            self.reserved_paths = set()
+            if jobs > 1 and len(outfiles) > 1:
+                target_reports = self.iter_parallel(jobs, outfiles)
+            else:
+                target_reports = (self.run_target(outfile) for outfile in outfiles)
+            for target_report in target_reports:
+                for report in [target_report] + [
+                    self.copy_result(target_report, duplicate)
+                    for duplicate in duplicates.get(target_report.outfile, [])
+                ]:
+                    self.collect_target(report)
+                    self.report_progress(len(self.report.targets), len(self.outfiles))
+                    yield report
+                if self.cancelled():
+                    break
+        finally:
+            target_reports.close()
+            # a stopped run still remembers the targets, which are done
+            if self.manifest is not None:
+                self.manifest.save()
+        self.report.cancelled = self.cancelled()
+        # skipped targets were reported first, restore the original order
+        order = {outfile: index for index, outfile in enumerate(self.outfiles)}
+        self.report.targets.sort(key=lambda t: order.get(t.outfile, len(order)))
+        self.report.total_s = time.perf_counter() - start
+
+    def target_content_hash(self, outfile) -> str:
+        if not self.canonical_dedup:
+            if outfile in self.target_hashes:
+                # already hashed for the manifest
+                return self.target_hashes[outfile]
+            return file_hash(outfile)
+        # attribute order, quotes and empty elements don't matter here
+        with open(outfile, "rb") as f:
+            root = parse_xml(f.read())[0]
+        return hashlib.sha256(etree.tostring(root, method="c14n2")).hexdigest()
+
+    def group_duplicates(self, outfiles):
+        """
+        Returns the outfiles with unique content and a dict with the other
+        outfiles of the same content for each of them.
+        """
+        unique = {}
+        duplicates = {}
+        for outfile in outfiles:
             try:
-                root_outfile = self.read_xml_file(outfile)
-                self.wipe_modsources(root_outfile)
-                self.wipe_map_items(root_outfile)
-                self.insert_modsources(root_outfile)
-                self.insert_map_items(root_outfile)
-                self.insert_pad_params(root_outfile)
-                self.insert_noteseq_params(root_outfile)
-                result_file = self.write_xml_file(filepath=outfile, root=root_outfile)
-                self.result_files.append(result_file)
-            except Exception as e:
-                print(f"Error processing file {outfile}: {e}")
+                content_hash = self.target_content_hash(outfile)
+            except (OSError, etree.XMLSyntaxError):
+                # the error is reported when the file is processed
+                content_hash = outfile
+            if content_hash in unique:
+                duplicates.setdefault(unique[content_hash], []).append(outfile)
+            else:
+                unique[content_hash] = outfile
+        return list(unique.values()), duplicates
+
+    def copy_result(self, target_report: TargetReport, outfile) -> TargetReport:
+        """
+        Uses the result of a target with the same content for outfile.
+        """
+        report = TargetReport(outfile=outfile, duplicate_of=target_report.outfile)
+        if target_report.status == STATUS_ERROR:
+            report.status = STATUS_ERROR
+            report.error = target_report.error
+            return report
+        start = time.perf_counter()
+        try:
+            result_path = self.get_result_path(outfile, self.reserved_paths)
+            self.reserved_paths.add(result_path)
+            report.bytes_read = os.path.getsize(outfile)
+            if result_path != target_report.result_file:
+                shutil.copyfile(target_report.result_file, result_path)
+        except OSError as e:
+            report.status = STATUS_ERROR
+            report.error = str(e)
+            return report
+        report.phases["copy"] = time.perf_counter() - start
+        report.result_file = result_path
+        report.bytes_written = os.path.getsize(result_path)
+        return report
+
+    def report_progress(self, done: int, total: int):
+        if self.progress_callback is not None:
+            self.progress_callback(done, total)
+
+    def cancelled(self) -> bool:
+        return self.cancel_event is not None and self.cancel_event.is_set()
+
+    def run_target(self, outfile, result_path=None) -> TargetReport:
+        """
+        Processes a single outfile and returns its report. Errors are caught
+        and stored in the report.
+        """
+        try:
+            self.process_outfile(outfile, result_path)
+        except Exception as e:
+            self.target_report.status = STATUS_ERROR
+            self.target_report.error = str(e)
+        return self.target_report
+
+    def collect_target(self, target_report: TargetReport):
+        self.report.targets.append(target_report)
+        if target_report.recovered:
+            self.recovered_files.append(target_report.outfile)
+        if target_report.status == STATUS_ERROR:
+            self.report_error(target_report.outfile, target_report.error)
+            return
+        self.add_result(target_report.outfile, target_report.result_file)
+
+    def get_run_hash(self):
+        settings = [
+            settings_hash(
+                self.tenten_device,
+                self.general_midi_settings,
+                self.device_settings,
+                self.remove_blank_text,
+            ),
+            self.overwrite_files,
+            self.wipe_existing_mappings,
+        ]
+        for layer in self.layers:
+            settings.append(
+                settings_hash(
+                    layer.tenten_device,
+                    layer.general_midi_settings,
+                    layer.device_settings,
+                    layer.remove_blank_text,
+                )
+            )
+        return hashlib.sha256(json.dumps(settings).encode()).hexdigest()
+
+    def get_plan_hash(self):
+        plan_hashes = [plan_hash(self.plan or self.compile_plan())]
+        if not self.layers:
+            return plan_hashes[0]
+        plan_hashes += [plan_hash(layer.plan) for layer in self.layers]
+        return hashlib.sha256(json.dumps(plan_hashes).encode()).hexdigest()
+
+    def filter_up_to_date(self, outfiles):
+        """
+        Returns the outfiles, which have changed since the manifest was written.
+        The others are collected in `skipped_files` with their previous result.
+        """
+        self.plan_hash = self.get_plan_hash()
+        self.run_hash = self.get_run_hash()
+        self.target_hashes = {}
+        changed = []
+        for outfile in outfiles:
+            try:
+                target_hash = file_hash(outfile)
+            except OSError:
+                # the error is reported, when the target is processed
+                changed.append(outfile)
                 continue
-        return self.result_files
+            result_file = self.manifest.up_to_date(
+                outfile, target_hash, self.plan_hash, self.run_hash
+            )
+            if result_file is not None:
+                self.skipped_files.append(result_file)
+                self.report.targets.append(
+                    TargetReport(
+                        outfile=outfile,
+                        result_file=result_file,
+                        status=STATUS_SKIPPED,
+                    )
+                )
+                continue
+            self.target_hashes[outfile] = target_hash
+            changed.append(outfile)
+        return changed
+
+    def add_result(self, outfile, result_file):
+        self.result_files.append(result_file)
+        if self.manifest is not None and outfile in self.target_hashes:
+            self.manifest.record(
+                outfile,
+                self.target_hashes[outfile],
+                self.plan_hash,
+                self.run_hash,
+                result_file,
+            )
+
+    def iter_parallel(self, jobs: int, outfiles: list):
+        # the output paths are reserved up front in the original order, so the
+        # workers don't race for the same file name
+        reserved = set()
+        tasks = []
+        for outfile in outfiles:
+            result_path = self.get_result_path(outfile, reserved)
+            reserved.add(result_path)
+            tasks.append((outfile, result_path))
+        self.reserved_paths.update(reserved)
+
+        chunksize = max(1, len(tasks) // (jobs * 4))
+        executor = ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=_init_worker,
+            initargs=(self.worker_payload(),),
+        )
+        try:
+            # map returns the results in the order of the tasks
+            yield from executor.map(_run_worker, tasks, chunksize=chunksize)
+        finally:
+            # the pending targets are dropped, if the caller stops early
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def worker_payload(self):
+        return {
+            "plan": self.plan or self.compile_plan(),
+            "tenten_device": self.tenten_device,
+            "general_midi_settings": self.general_midi_settings,
+            "device_settings": self.device_settings,
+            "overwrite_files": self.overwrite_files,
+            "wipe_existing_mappings": self.wipe_existing_mappings,
+            "outfile_subfolder": self.outfile_subfolder,
+            "streaming": self.streaming,
+            "remove_blank_text": self.remove_blank_text,
+            "layers": [layer.template for layer in self.layers],
+        }
+
+    def process_outfile(self, outfile, result_path=None):
+        report = TargetReport(outfile=outfile)
+        self.target_report = report
+        report.bytes_read = os.path.getsize(outfile)
+        if self.streaming:
+            with report.phase("stream"):
+                result_file = self.stream_outfile(outfile, result_path)
+        else:
+            with report.phase("parse"):
+                root_outfile = self.read_xml_file(outfile)
+            self.patch_root(root_outfile)
+            with report.phase("write"):
+                result_file = self.write_xml_file(
+                    filepath=outfile, root=root_outfile, result_path=result_path
+                )
+        report.result_file = result_file
+        report.bytes_written = os.path.getsize(result_file)
+        return result_file
+
+    def patch_bytes(self, xml: bytes, name: str = "") -> bytes:
+        """
+        Patches a target, which is already in memory, and returns the new content.
+        """
+        self.target_report = None
+        root_outfile = self.parse_xml(xml, name)
+        self.patch_root(root_outfile)
+        return self.serialize_xml(root_outfile)
+
+    def patch_root(self, root_outfile):
+        # wipe and insert in a single visit of every cell, see `CellVisitor`
+        with self.phase("patch"):
+            self.cell_visitor().visit_tree(root_outfile)
+
+    def cell_visitor(self):
+        """
+        Returns a visitor, which applies the template and the ones added with
+        `add_template` to a single target.
+        """
+        if not self.layers:
+            return CellVisitor(self)
+        for layer in self.layers:
+            # the layers count into the report of the target and use the
+            # wipe setting of this mapper
+            layer.target_report = self.target_report
+            layer.wipe_existing_mappings = self.wipe_existing_mappings
+        return LayeredCellVisitor([self] + self.layers)
+
+    def phase(self, name):
+        if self.target_report is None:
+            return nullcontext()
+        return self.target_report.phase(name)
+
+    def count(self, counter, n=1):
+        if self.target_report is not None:
+            setattr(
+                self.target_report, counter, getattr(self.target_report, counter) + n
+            )
+
+    def report_counters(self) -> dict:
+        if self.target_report is None:
+            return {}
+        return {c: getattr(self.target_report, c) for c in CHANGE_COUNTERS}
+
+    def restore_report_counters(self, counters: dict):
+        for counter, value in counters.items():
+            setattr(self.target_report, counter, value)
+
+    def stream_outfile(self, outfile, result_path=None):
+        """
+        Same as `process_outfile`, but the target is patched while it is parsed,
+        so only a single cell is held in memory at a time.
+        """
+        result_path = result_path or self.get_result_path(outfile)
+        return StreamPatcher(self).patch(outfile, result_path)
+
+    def report_error(self, outfile, error):
+        print(f"Error processing file {outfile}: {error}")
+        self.errors.append((outfile, str(error)))
 
     def filter_midi_modsources(self, root):
         modsources = []
@@ -175,128 +682,81 @@ class MidiMapper:
             for modsource in modsources:
                 self.delete_node(modsource)
 
-    def wipe_map_items(self, root_outfile):
-        if not self.wipe_existing_mappings:
-            return
-        # remove all mapitems from the outfile
-        # we will just delete the whole midimap node, if it exist, because
-        # we will add it in again later
-        midimap = root_outfile.xpath(f".//midimap")
-        if len(midimap) > 0:
-            self.delete_node(midimap[0])
-
     def delete_node(self, node):
         parent = node.getparent()
         parent.remove(node)
+        self.count("nodes_removed")
 
-    def get_cell_from_outfile(self, root_outfile, parent_attrib_infile):
-        cell_outfile = []
-        if self.tenten_device in TENTEN_ROW_COLUMN_LAYER:
-            # for these devices the midimap is under `midimap` and the node names are `mapitem`
-            cell_outfile = root_outfile.xpath(
-                f'.//cell[@row="{parent_attrib_infile["row"]}"][@column="{parent_attrib_infile["column"]}"]'
-                + f'[@layer="{parent_attrib_infile["layer"]}"]'
-            )
-        elif self.tenten_device in TENTEN_ROW_COLUMN_SYNTH:
-            cell_outfile = root_outfile.xpath(
-                f'.//cell[@row="{parent_attrib_infile["row"]}"][@column="{parent_attrib_infile["column"]}"]'
-                + f'[@synth="{parent_attrib_infile["synth"]}"]'
-            )
-        elif self.tenten_device in TENTEN_ROW_COLUMN:
-            cell_outfile = root_outfile.xpath(
-                f'.//cell[@row="{parent_attrib_infile["row"]}"][@column="{parent_attrib_infile["column"]}"]'
-            )
-        elif self.tenten_device in TENTEN_ROW_LAYER:
-            cell_outfile = root_outfile.xpath(
-                f'.//cell[@row="{parent_attrib_infile["row"]}"][@layer="{parent_attrib_infile["layer"]}"]'
-            )
-        return cell_outfile
+    def build_cell_index(self, root_outfile):
+        return CellIndex(root_outfile, cell_coordinates(self.tenten_device))
+
+    def get_cell_from_outfile(self, cell_index, parent_attrib_infile):
+        return cell_index.get_cell(parent_attrib_infile)
 
-    def insert_modsources(self, root_outfile):
+    def insert_modsources(self, root_outfile, cell_index=None):
+        if cell_index is None:
+            cell_index = self.build_cell_index(root_outfile)
+        # the modsources are grouped by cell, so that the slots of every cell
+        # are planned once
+        cells = {}
         for mod_infile in self.modsources_infile:
             # get element from infile
             parent_attrib_infile = mod_infile.getparent().attrib
             # get cell from outfile at the same position
-            cell_outfile = self.get_cell_from_outfile(
-                root_outfile, parent_attrib_infile
-            )
-            try:
-                cell_outfile = cell_outfile[0]
-            except IndexError:
+            cell_outfile = self.get_cell_from_outfile(cell_index, parent_attrib_infile)
+            if cell_outfile is None:
                 print(
                     f"Cell not found in outfile for row {parent_attrib_infile['row']} and column {parent_attrib_infile['column']}"
                 )
                 continue
-            # get all modsources from the outfile, which have the same destination
-            modsources = cell_outfile.xpath(
-                f'./modsource[@dest="{mod_infile.attrib["dest"]}"]'
-            )
-            mod_same_dest = ModSourceList(modsources=modsources)
-
-            # if there is a free slot, we will place it there
-            first_free_slot = mod_same_dest.first_free_slot()
-            if first_free_slot is not None:
-                # place it in the first free slot
-                self.add_to_free_slot(mod_infile, cell_outfile, first_free_slot)
-                continue
-
-            # if there is a midicc modsource, we will replace it
-            first_cc_modsource = mod_same_dest.first_cc_modsource()
-            if first_cc_modsource is not None:
-                slot = first_cc_modsource.attrib["slot"]
-                self.delete_node(first_cc_modsource)
-                self.add_to_free_slot(mod_infile, cell_outfile, slot)
-                continue
+            cells.setdefault(cell_outfile, []).append(mod_infile)
+        for cell_outfile, mod_infiles in cells.items():
+            self.insert_cell_modsources(mod_infiles, cell_outfile)
 
-            # if there is no gap and no cc slot, we will replace the middle one with index 1
-            # (because in blackbox 0 and 2 are sometimes set by default)
-            middle_elem = mod_same_dest.elem_at_slot(DEFAULT_SLOT)
-            if middle_elem is not None:
-                self.delete_node(middle_elem)
-
-            # create a new one
-            new_elem = copy(mod_infile)
-            new_elem.attrib["slot"] = DEFAULT_SLOT
-            cell_outfile.append(new_elem)
+    def insert_cell_modsources(self, mod_infiles, cell_outfile):
+        # new modsources go into the first free slot of their destination,
+        # otherwise they replace the first midicc modsource and if there is none
+        # the one at slot 1 (because in blackbox 0 and 2 are sometimes set by default)
+        planner = SlotPlanner(
+            cell_outfile.iterchildren("modsource"), default_slot=DEFAULT_SLOT
+        )
+        removed, added = planner.plan(mod_infiles)
+        for node in removed:
+            self.delete_node(node)
+        for mod_infile, slot in added:
+            self.add_to_free_slot(mod_infile, cell_outfile, slot)
 
     def insert_map_items(self, root_outfile):
         if not self.tenten_device in TENTEN_MIDIMAP_ITEMS:
             return
-        midimap = root_outfile.xpath(f".//midimap")
-        if not midimap:
+        midimap = root_outfile.find(".//midimap")
+        if midimap is None:
             session = root_outfile.xpath(".//session")[0]
             # we have to create a new midimap element
             midimap = etree.SubElement(session, "midimap")
-            # midimap = root_outfile.xpath(f".//midimap")
-        for mapitem in self.mapitems_infile:
-            # get cell from outfile at the same position
-            try:
-                new_elem = copy(mapitem)
-                midimap.append(new_elem)
-            except Exception as e:
-                print(f"Error while inserting map items: {e}")
-                continue
+        MidimapMerge(self.mapitems_infile).merge(
+            midimap, self, self.wipe_existing_mappings
+        )
 
-    def insert_pad_params(self, root_outfile):
+    def insert_pad_params(self, root_outfile, cell_index=None):
         if not self.tenten_device in PADPARAM_DEVICES:
             return
+        if cell_index is None:
+            cell_index = self.build_cell_index(root_outfile)
         for pad_params in self.pad_params_infile:
             try:
                 pad_params_cell = pad_params.getparent()
                 # get element from outfile
-                params_outfile = root_outfile.xpath(
-                    f'.//cell[@row="{pad_params_cell.attrib["row"]}"]'
-                    + f'[@column="{pad_params_cell.attrib["column"]}"]'
-                    + f'[@layer="{pad_params_cell.attrib["layer"]}"]/params'
+                params_outfile = cell_index.get_pad_params(pad_params_cell.attrib)
+                if params_outfile is None:
+                    raise IndexError
+                self.copy_params(
+                    pad_params, params_outfile, self.device_settings.pad_params
                 )
-                params_outfile = params_outfile[0]
-                for key in self.device_settings.pad_params:
-                    if key in pad_params.attrib:
-                        params_outfile.attrib[key] = pad_params.attrib[key]
 
             except IndexError:
                 print(
-                    f"Cell not found in outfile for row {pad_params.attrib['row']} and column {pad_params.attrib['column']}"
+                    f"Cell not found in outfile for row {pad_params_cell.attrib['row']} and column {pad_params_cell.attrib['column']}"
                 )
                 continue
 
@@ -304,34 +764,30 @@ class MidiMapper:
                 print(f"Error: {e}")
                 continue
 
-    def insert_noteseq_params(self, root_outfile):
+    def insert_noteseq_params(self, root_outfile, cell_index=None):
         if not self.tenten_device in NOTESEQ_PARAM_DEVICES:
             return
+        if cell_index is None:
+            cell_index = self.build_cell_index(root_outfile)
         for noteseq_params in self.noteseq_params_infile:
             try:
                 noteseq_params_cell = noteseq_params.getparent()
 
                 # get element from outfile
-
-                params_outfile = root_outfile.xpath(
-                    f'.//cell[@row="{noteseq_params_cell.attrib["row"]}"]'
-                    + f'[@column="{noteseq_params_cell.attrib["column"]}"]'
-                    + f'[@layer="{noteseq_params_cell.attrib["layer"]}"]'
-                    + f'[@seqsublayer="{noteseq_params_cell.attrib["seqsublayer"]}"]/params'
+                params_outfile = cell_index.get_noteseq_params(
+                    noteseq_params_cell.attrib
                 )
                 # it might be that the sequence hasn't been initialized yet and in that case
                 # the seqsublayer is empty
-                if not params_outfile:
-                    params_outfile = root_outfile.xpath(
-                        f'.//cell[@row="{noteseq_params_cell.attrib["row"]}"]'
-                        + f'[@column="{noteseq_params_cell.attrib["column"]}"]'
-                        + f'[@layer="{noteseq_params_cell.attrib["layer"]}"]/params'
+                if params_outfile is None:
+                    params_outfile = cell_index.get_pad_params(
+                        noteseq_params_cell.attrib
                     )
-
-                params_outfile = params_outfile[0]
-                for key in self.device_settings.noteseq_params:
-                    if key in noteseq_params.attrib:
-                        params_outfile.attrib[key] = noteseq_params.attrib[key]
+                if params_outfile is None:
+                    raise IndexError
+                self.copy_params(
+                    noteseq_params, params_outfile, self.device_settings.noteseq_params
+                )
 
             except IndexError:
                 print(
@@ -344,54 +800,100 @@ class MidiMapper:
                 print(f"Error: {e}")
                 continue
 
+    def copy_params(self, params_infile, params_outfile, keys):
+        for key in keys:
+            if key in params_infile.attrib:
+                params_outfile.attrib[key] = params_infile.attrib[key]
+                self.count("params_updated")
+
     def add_to_free_slot(self, mod_infile, cell_outfile, slot):
         new_elem = copy(mod_infile)
         new_elem.attrib["slot"] = slot
         cell_outfile.append(new_elem)
+        self.count("nodes_inserted")
 
     def add_outfile(self, outfile):
         self.outfiles.append(outfile)
 
-    def write_xml_file(self, filepath, root):
+    def get_result_path(self, filepath, reserved=()):
         if self.overwrite_files:
-            new_fp = filepath
-        else:
-            # get the filename and prepare the output path
-            file_name = os.path.basename(filepath)
+            return filepath
+        # get the filename and prepare the output path
+        file_name = os.path.basename(filepath)
 
-            base_name, file_extension = os.path.splitext(file_name)
-            new_fp = os.path.join(self.outfile_subfolder, file_name)
+        base_name, file_extension = os.path.splitext(file_name)
+        new_fp = os.path.join(self.outfile_subfolder, file_name)
 
-            # handle filename conflicts by appending an incrementing index
-            index = 1
-            while os.path.exists(new_fp):
-                new_fp = os.path.join(
-                    self.outfile_subfolder, f"{base_name}{index}{file_extension}"
-                )
-                index += 1
+        # handle filename conflicts by appending an incrementing index
+        index = 1
+        while os.path.exists(new_fp) or new_fp in reserved:
+            new_fp = os.path.join(
+                self.outfile_subfolder, f"{base_name}{index}{file_extension}"
+            )
+            index += 1
+        return new_fp
+
+    def write_xml_file(self, filepath, root, result_path=None):
+        new_fp = result_path or self.get_result_path(filepath)
 
         with open(new_fp, "wb") as f:
-            xml = etree.tostring(
-                root,
-                pretty_print=True,
-                encoding="UTF-8",
-                xml_declaration=True,
-            )
-            f.write(xml)
+            f.write(self.serialize_xml(root))
 
         return new_fp
 
+    def serialize_xml(self, root) -> bytes:
+        return etree.tostring(
+            root,
+            pretty_print=True,
+            encoding="UTF-8",
+            xml_declaration=True,
+        )
+
+
+# the mapper of a worker process, created once per worker by `_init_worker`
+_worker_mapper = None
+
+
+def _init_worker(payload):
+    global _worker_mapper
+    mm = MidiMapper(
+        tenten_device=payload["tenten_device"],
+        general_midi_settings=payload["general_midi_settings"],
+        device_settings=payload["device_settings"],
+        overwrite_files=payload["overwrite_files"],
+        streaming=payload["streaming"],
+        remove_blank_text=payload["remove_blank_text"],
+    )
+    mm.wipe_existing_mappings = payload["wipe_existing_mappings"]
+    mm.outfile_subfolder = payload["outfile_subfolder"]
+    mm.load_plan(payload["plan"])
+    for template in payload["layers"]:
+        mm.add_template(template)
+    _worker_mapper = mm
+
+
+def _run_worker(task):
+    outfile, result_path = task
+    return _worker_mapper.run_target(outfile, result_path)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Run the MIDI Mapper.")
-    parser.add_argument("-i", "--infile", required=True, help="Input file path")
+    parser.add_argument(
+        "-i",
+        "--infile",
+        required=True,
+        action="append",
+        help="Input file path, repeat it to map the presets of several devices "
+        + "or to apply several templates of a device in this order",
+    )
     parser.add_argument("-o", "--outfolder", required=True, help="Output folder path")
     parser.add_argument(
         "-t",
         "--tenten_device",
-        required=True,
-        choices=["lemondrop", "blackbox"],
-        help="TenTen device type (lemondrop or blackbox)",
+        default=None,
+        choices=[d.value for d in TenTenDevice],
+        help="TenTen device type (default: detected from the input file)",
     )
     parser.add_argument(
         "-r",
@@ -399,69 +901,184 @@ if __name__ == "__main__":
         action="store_true",
         help="Replace existing files in the output folder",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of worker processes (0 uses all CPU cores)",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Patch the target files while parsing them to keep memory usage low",
+    )
+    parser.add_argument(
+        "-m",
+        "--manifest",
+        default=None,
+        help="Manifest file to skip targets, which haven't changed since the last run",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Profile the run with cProfile and tracemalloc and print the results",
+    )
+    parser.add_argument(
+        "--report-json",
+        default=None,
+        help="Write a JSON report with timings and counts per target to this file",
+    )
+    parser.add_argument(
+        "--plan-cache",
+        default=None,
+        help="Folder to cache compiled template mapping plans in",
+    )
+    parser.add_argument(
+        "--strip-whitespace",
+        action="store_true",
+        help="Drop the whitespace between elements and re-indent the output "
+        + "(not with --stream)",
+    )
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="Map targets with identical content only once and copy the result",
+    )
+    parser.add_argument(
+        "--dedup-canonical",
+        action="store_true",
+        help="Like --dedup, but compare the canonical XML instead of the raw bytes",
+    )
 
     args = parser.parse_args()
 
-    infile = args.infile
     outfolder = args.outfolder
-    tenten_device = args.tenten_device
     overwrite = args.replace
 
-    # Validate infile
-    if not os.path.isfile(infile):
-        print(f"Error: Infile '{infile}' does not exist.")
-        sys.exit(1)
-
     # Validate outfolder
     if not os.path.exists(outfolder):
         print(f"Error: Outfolder '{outfolder}' does not exist.")
         sys.exit(1)
 
-    # Collect all .xml files in the outfolder and its subdirectories
-    outfiles = []
-    for root, _, files in os.walk(outfolder):
-        for file in files:
-            if file.endswith(".xml"):
-                outfiles.append(os.path.join(root, file))
+    # Validate the infiles and detect their devices
+    infiles = {}
+    for infile in args.infile:
+        if not os.path.isfile(infile):
+            print(f"Error: Infile '{infile}' does not exist.")
+            sys.exit(1)
+        if args.tenten_device is not None:
+            device = TenTenDevice(args.tenten_device)
+        else:
+            device = detect_device(infile)
+        if device is None:
+            print(f"Error: The device of '{infile}' could not be detected, use -t.")
+            sys.exit(1)
+        infiles.setdefault(device, []).append(infile)
 
-    if not outfiles:
-        print(f"Error: No .xml files found in the outfolder '{outfolder}'.")
+    # Collect the presets of these devices in the outfolder and its subdirectories
+    outfiles_per_device = group_presets(outfolder, list(infiles))
+    if not outfiles_per_device:
+        devices = ", ".join(d.value for d in infiles)
+        print(f"Error: No {devices} presets found in the outfolder '{outfolder}'.")
         sys.exit(1)
 
     mod_sources = [m for m in ModSources]
     general_midi_settings = GeneralMidiSettings(mod_sources=mod_sources)
 
-    # Set device-specific settings
-    if tenten_device == "blackbox":
-        settings = BlackboxSettings(
-            pad_params=[
-                BlackboxPadParam.MIDIMODE,
-                BlackboxPadParam.OUTPUTBUS,
-            ],
-            noteseq_params=[
-                BlackboxNoteseqParam.SEQPADMAPDEST,
-                BlackboxNoteseqParam.MIDIOUTCHAN,
-                BlackboxNoteseqParam.MIDISEQCELLCHAN,
-            ],
+    reports = {}
+    for device, device_infiles in infiles.items():
+        # the templates aren't targets of each other
+        template_paths = {os.path.abspath(infile) for infile in device_infiles}
+        outfiles = [
+            f
+            for f in outfiles_per_device.get(device, [])
+            if os.path.abspath(f) not in template_paths
+        ]
+        if not outfiles:
+            print(f"No {device.value} presets found in the outfolder '{outfolder}'.")
+            continue
+
+        # Set device-specific settings
+        if device == TenTenDevice.BLACKBOX:
+            settings = BlackboxSettings(
+                pad_params=[
+                    BlackboxPadParam.MIDIMODE,
+                    BlackboxPadParam.OUTPUTBUS,
+                ],
+                noteseq_params=[
+                    BlackboxNoteseqParam.SEQPADMAPDEST,
+                    BlackboxNoteseqParam.MIDIOUTCHAN,
+                    BlackboxNoteseqParam.MIDISEQCELLCHAN,
+                ],
+            )
+        else:
+            settings = None
+
+        templates = ", ".join(f"'{infile}'" for infile in device_infiles)
+        print(f"Mapping {len(outfiles)} {device.value} presets with {templates}.")
+        # Run the MidiMapper
+        mm = MidiMapper(
+            infile=device_infiles[0],
+            outfiles=outfiles,
+            tenten_device=device,
+            device_settings=settings,
+            general_midi_settings=general_midi_settings,
+            overwrite_files=overwrite,
+            plan_cache_folder=args.plan_cache,
+            streaming=args.stream,
+            manifest_file=args.manifest,
+            remove_blank_text=args.strip_whitespace,
+            dedup_targets=args.dedup or args.dedup_canonical,
+            canonical_dedup=args.dedup_canonical,
         )
-        device = TenTenDevice.BLACKBOX
-    elif tenten_device == "lemondrop":
-        settings = None
-        device = TenTenDevice.LEMONDROP
+        if len(device_infiles) > 1:
+            # imported here, as it imports this module
+            from mapping_template import MappingTemplate
 
-    # Run the MidiMapper
-    mm = MidiMapper(
-        infile=infile,
-        outfiles=outfiles,
-        tenten_device=device,
-        device_settings=settings,
-        general_midi_settings=general_midi_settings,
-        overwrite_files=overwrite,
-    )
-    mm.run()
-    if overwrite:
-        print(f"Processing completed. Output files replaced in '{outfolder}'.")
-    else:
-        print(
-            f"Processing completed. Output files written to '{mm.outfile_subfolder}'."
+            for infile in device_infiles[1:]:
+                with open(infile, "rb") as f:
+                    mm.add_template(
+                        MappingTemplate.from_bytes(
+                            f.read(),
+                            device,
+                            general_midi_settings,
+                            settings,
+                            args.strip_whitespace,
+                        )
+                    )
+        report = mm.run(
+            jobs=args.jobs,
+            profile=args.profile,
+            trace_memory=args.profile,
+            return_report=True,
         )
+        reports[device.value] = {
+            "summary": report.summary(),
+            "report": report.model_dump(),
+        }
+        if args.profile:
+            print(json.dumps(report.summary(), indent=2))
+            print(report.profile)
+            print(f"Peak memory: {report.memory_peak_bytes} bytes")
+            print("\n".join(report.memory_top))
+        if mm.recovered_files:
+            print(f"{len(mm.recovered_files)} files had to be read in recover mode.")
+        if mm.skipped_files:
+            print(
+                f"Skipped {len(mm.skipped_files)} files, which are already up to date."
+            )
+        if overwrite:
+            print(f"Processing completed. Output files replaced in '{outfolder}'.")
+        else:
+            print(
+                f"Processing completed. Output files written to '{mm.outfile_subfolder}'."
+            )
+    if args.report_json and reports:
+        with open(args.report_json, "w") as f:
+            # the reports of several devices are keyed by the device
+            json.dump(
+                reports if len(infiles) > 1 else next(iter(reports.values())),
+                f,
+                indent=2,
+            )
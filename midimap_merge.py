@@ -0,0 +1,111 @@
+from copy import copy
+
+# a mapitem is driven by a midi controller ...
+MAPITEM_SOURCE_ATTRIBUTES = ("mchan", "ccnum")
+# ... and controls a parameter of the device
+MAPITEM_TARGET_ATTRIBUTES = ("target", "dest")
+
+
+def mapitem_source(mapitem) -> tuple:
+    return tuple(mapitem.get(name) for name in MAPITEM_SOURCE_ATTRIBUTES)
+
+
+def mapitem_target(mapitem) -> tuple:
+    return tuple(mapitem.get(name) for name in MAPITEM_TARGET_ATTRIBUTES)
+
+
+def mapitem_key(mapitem) -> tuple:
+    """
+    The identity of a mapitem: the controller and the parameter it controls.
+    """
+    return mapitem_source(mapitem) + mapitem_target(mapitem)
+
+
+class MidimapMerge:
+    """
+    Merges the template mapitems into an existing midimap in a single pass.
+
+    The template mapitems are indexed by identity once, then every existing
+    mapitem is looked up in that index:
+
+    - a mapitem with the identity of a template mapitem is replaced in place
+    - a mapitem of a controller or a parameter the template maps differently
+      is removed, if the existing mappings are wiped
+    - every other mapitem is kept
+
+    The template mapitems that didn't replace anything are appended at the end.
+    """
+
+    def __init__(self, mapitems):
+        # with duplicates in the template the last one wins, like with several
+        # templates, it takes the place of the first one
+        unique = {}
+        for mapitem in mapitems:
+            unique[mapitem_key(mapitem)] = mapitem
+        self.mapitems = list(unique.values())
+        self.sources = set()
+        self.targets = set()
+        self.keys = {}
+        for index, (key, mapitem) in enumerate(unique.items()):
+            self.sources.add(mapitem_source(mapitem))
+            self.targets.add(mapitem_target(mapitem))
+            self.keys[key] = index
+
+    def merge(self, midimap, mapper, wipe_existing_mappings=True):
+        """
+        Merges the template mapitems into the midimap element in place.
+
+        Args:
+            midimap: The `midimap` element of the target.
+            mapper: The `MidiMapper` whose counters are updated.
+            wipe_existing_mappings (bool): Whether the mapitems that conflict
+                with the template are removed.
+        """
+        placed = set()
+        for mapitem in list(midimap):
+            if mapitem.tag != "mapitem":
+                continue
+            index = self.keys.get(mapitem_key(mapitem))
+            if index is not None and index not in placed:
+                placed.add(index)
+                new_item = copy(self.mapitems[index])
+                new_item.tail = mapitem.tail
+                midimap.replace(mapitem, new_item)
+                mapper.count("nodes_removed")
+                mapper.count("nodes_inserted")
+            elif wipe_existing_mappings and (
+                index is not None
+                or mapitem_source(mapitem) in self.sources
+                or mapitem_target(mapitem) in self.targets
+            ):
+                self.remove(mapitem, mapper)
+        self.append(
+            midimap,
+            [m for index, m in enumerate(self.mapitems) if index not in placed],
+            mapper,
+        )
+
+    def remove(self, mapitem, mapper):
+        # the whitespace after the mapitem is kept, so that the indentation of
+        # the closing tag survives
+        previous = mapitem.getprevious()
+        if previous is not None:
+            previous.tail = mapitem.tail
+        mapper.delete_node(mapitem)
+
+    def append(self, midimap, mapitems, mapper):
+        indent = None
+        if len(midimap) > 0 and midimap.text is not None and not midimap.text.strip():
+            # continue the indentation of the existing mapitems
+            indent = midimap.text
+            last = midimap[-1]
+            closing = last.tail
+            last.tail = indent
+        for mapitem in mapitems:
+            new_item = copy(mapitem)
+            if indent is not None:
+                new_item.tail = indent
+            midimap.append(new_item)
+            mapper.count("nodes_inserted")
+        if indent is not None:
+            midimap[-1].tail = closing
@@ -30,3 +30,86 @@ class ModSourceList:
             if m.attrib["slot"] == slot:
                 return m
         return None
+
+
+# slot occupancy as a bitmap, bit i is set if slot str(i) is taken
+SLOT_BITS = {str(i): 1 << i for i in range(NUM_SLOTS)}
+ALL_SLOTS = (1 << NUM_SLOTS) - 1
+
+
+class SlotPlanner:
+    """
+    Places a batch of new modsources into the slots of a single cell.
+
+    The result is the same as placing them one after another with
+    `ModSourceList`: the first free slot is used, otherwise the first midicc
+    modsource is replaced, otherwise the one at the default slot.
+    The cell is scanned once and nothing is changed until the plan is applied.
+    """
+
+    def __init__(self, modsources, default_slot: str):
+        self.default_slot = default_slot
+        self.existing = {}
+        for m in modsources:
+            self.existing.setdefault(m.get("dest"), []).append(m)
+        # per dest: the modsources in document order as [elem, slot, src, index]
+        # entries (index is the position in `added` for new ones) and the bitmap
+        self.dests = {}
+        self.removed = []
+        self.added = []
+
+    def dest_state(self, dest):
+        if dest not in self.dests:
+            entries = []
+            occupied = 0
+            for m in self.existing.get(dest, []):
+                slot = m.attrib["slot"]
+                entries.append([m, slot, m.get("src"), None])
+                occupied |= SLOT_BITS.get(slot, 0)
+            self.dests[dest] = [entries, occupied]
+        return self.dests[dest]
+
+    def remove(self, entries, index):
+        elem, _, _, added_index = entries.pop(index)
+        if added_index is None:
+            self.removed.append(elem)
+        else:
+            # a modsource of this batch, which is replaced again, is never added
+            self.added[added_index] = None
+
+    def find(self, entries, position, value):
+        for index, entry in enumerate(entries):
+            if entry[position] == value:
+                return index
+        return None
+
+    def place(self, modsource):
+        state = self.dest_state(modsource.attrib["dest"])
+        entries, occupied = state
+        free = ~occupied & ALL_SLOTS
+        if free:
+            bit = free & -free
+            slot = str(bit.bit_length() - 1)
+            state[1] = occupied | bit
+        else:
+            # all slots are taken, so a midicc modsource or the one at the
+            # default slot is replaced, the occupancy stays the same
+            index = self.find(entries, 2, "midicc")
+            if index is not None:
+                slot = entries[index][1]
+            else:
+                slot = self.default_slot
+                index = self.find(entries, 1, slot)
+            if index is not None:
+                self.remove(entries, index)
+        entries.append([modsource, slot, modsource.get("src"), len(self.added)])
+        self.added.append((modsource, slot))
+
+    def plan(self, modsources) -> tuple:
+        """
+        Returns the existing modsources to remove and the (modsource, slot)
+        pairs to append, in this order.
+        """
+        for modsource in modsources:
+            self.place(modsource)
+        return self.removed, [a for a in self.added if a is not None]
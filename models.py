@@ -84,6 +84,10 @@ PROJECT_FILENAMES = {
     TenTenDevice.BLUEBOX: "project.xml",
 }
 
+# these products have pad params and noteseq params, which can be transferred
+PADPARAM_DEVICES = [TenTenDevice.BLACKBOX]
+NOTESEQ_PARAM_DEVICES = [TenTenDevice.BLACKBOX]
+
 # these products hava block of midi mappings under `midimap` with the
 # node names `mapitem`
 TENTEN_MIDIMAP_ITEMS = [TenTenDevice.RAZZMATAZZ, TenTenDevice.BLUEBOX]
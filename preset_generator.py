@@ -0,0 +1,141 @@
+import random
+
+from lxml import etree
+
+from models import (
+    TenTenDevice,
+    ModSources,
+    BlackboxPadParam,
+    BlackboxNoteseqParam,
+    TENTEN_MIDIMAP_ITEMS,
+    TENTEN_ROW_COLUMN_LAYER,
+    TENTEN_ROW_COLUMN_SYNTH,
+    TENTEN_ROW_COLUMN,
+    TENTEN_ROW_LAYER,
+)
+from mod_source_list import SLOTS
+
+# sources, which are never touched by the mapper
+OTHER_SOURCES = ["lfo1", "lfo2", "env1", "env2", "key", "seq"]
+DESTINATIONS = ["level", "pitch", "cutoff", "res", "pan", "samstart", "decay"]
+
+# the grid size used to lay out the cells
+GRID_ROWS = 4
+GRID_COLUMNS = 4
+
+
+def cell_position(tenten_device, index) -> dict:
+    """
+    Returns the coordinate attributes of the cell with the given index
+    for the layout of the device.
+    """
+    row = str(index % GRID_ROWS)
+    column = str((index // GRID_ROWS) % GRID_COLUMNS)
+    layer = str(index // (GRID_ROWS * GRID_COLUMNS))
+    if tenten_device in TENTEN_ROW_COLUMN_LAYER:
+        return {"row": row, "column": column, "layer": layer}
+    if tenten_device in TENTEN_ROW_COLUMN_SYNTH:
+        return {"row": row, "column": column, "synth": layer}
+    if tenten_device in TENTEN_ROW_COLUMN:
+        return {"row": str(index), "column": "0"}
+    if tenten_device in TENTEN_ROW_LAYER:
+        return {"row": str(index % GRID_ROWS), "layer": str(index // GRID_ROWS)}
+    raise ValueError(f"Unknown device {tenten_device}")
+
+
+def random_modsource(rng, dest=None) -> dict:
+    src = rng.choice([m.value for m in ModSources] + OTHER_SOURCES)
+    attrib = {
+        "dest": dest or rng.choice(DESTINATIONS),
+        "src": src,
+    }
+    if src == ModSources.MIDICC:
+        attrib["mchan"] = str(rng.randint(0, 15))
+        attrib["ccnum"] = str(rng.randint(0, 127))
+    attrib["slot"] = rng.choice(sorted(SLOTS))
+    attrib["amount"] = str(rng.randint(-1000, 1000))
+    return attrib
+
+
+def random_params(rng, tenten_device, cell_type) -> dict:
+    params = {"level": str(rng.randint(-96000, 0)), "pitch": "0"}
+    if tenten_device == TenTenDevice.BLACKBOX:
+        for key in BlackboxPadParam:
+            params[key.value] = str(rng.randint(0, 3))
+        if cell_type == "noteseq":
+            for key in BlackboxNoteseqParam:
+                params[key.value] = str(rng.randint(0, 15))
+    return params
+
+
+def generate_preset(
+    tenten_device,
+    num_cells: int = 16,
+    modsources_per_cell: int = 4,
+    num_mapitems: int = 8,
+    seed: int = 0,
+) -> bytes:
+    """
+    Generates a synthetic preset in the layout of the given device.
+
+    Blackbox presets get a noteseq cell (with `seqsublayer`) for every sample
+    cell, devices in `TENTEN_MIDIMAP_ITEMS` get a `midimap` with mapitems.
+    """
+    tenten_device = TenTenDevice(tenten_device)
+    rng = random.Random(seed)
+    root = etree.Element("document")
+    root.text = "\n    "
+    session = etree.SubElement(root, "session", version="1")
+    session.text = "\n        "
+    session.tail = "\n"
+    cells = []
+    for index in range(num_cells):
+        position = cell_position(tenten_device, index)
+        if tenten_device == TenTenDevice.BLACKBOX:
+            # every pad layer is followed by the layer of its sequences
+            layer = 2 * int(position["layer"])
+            cells.append(dict(position, layer=str(layer), type="sample"))
+            cells.append(
+                dict(position, layer=str(layer + 1), type="noteseq", seqsublayer="0")
+            )
+        else:
+            cells.append(dict(position, type="osc"))
+
+    for attrib in cells:
+        cell = etree.SubElement(session, "cell", attrib)
+        cell.text = "\n            "
+        cell.tail = "\n        "
+        params = etree.SubElement(
+            cell, "params", random_params(rng, tenten_device, attrib["type"])
+        )
+        children = [params]
+        for _ in range(modsources_per_cell):
+            children.append(etree.SubElement(cell, "modsource", random_modsource(rng)))
+        for child in children:
+            child.tail = "\n            "
+        children[-1].tail = "\n        "
+
+    if tenten_device in TENTEN_MIDIMAP_ITEMS:
+        midimap = etree.SubElement(session, "midimap")
+        midimap.text = "\n            "
+        midimap.tail = "\n        "
+        for index in range(num_mapitems):
+            mapitem = etree.SubElement(
+                midimap,
+                "mapitem",
+                {
+                    "mchan": str(rng.randint(0, 15)),
+                    "ccnum": str(rng.randint(0, 127)),
+                    "target": str(index),
+                    "dest": rng.choice(DESTINATIONS),
+                },
+            )
+            mapitem.tail = "\n            "
+        if num_mapitems > 0:
+            mapitem.tail = "\n        "
+
+    if len(session) > 0:
+        session[-1].tail = "\n    "
+    return etree.tostring(
+        root, pretty_print=True, encoding="UTF-8", xml_declaration=True
+    )
@@ -0,0 +1,80 @@
+import json
+import os
+import tempfile
+
+from mapping_plan import file_hash
+
+MANIFEST_VERSION = 1
+
+
+class RunManifest:
+    """
+    Remembers for every target, which inputs produced which output, so that a
+    re-run can skip the targets which are already up to date.
+
+    The entries are keyed by the absolute target path and hold the hashes of
+    the target, the mapping plan and the run settings plus the output path and
+    its hash.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = {}
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except ValueError:
+            # a broken manifest only means that everything is processed again
+            return
+        if data.get("version") != MANIFEST_VERSION:
+            return
+        self.entries = data.get("entries", {})
+
+    def save(self):
+        folder = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(folder, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=folder, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"version": MANIFEST_VERSION, "entries": self.entries}, f)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def up_to_date(self, target, target_hash, plan_hash, run_hash) -> str:
+        """
+        Returns the output path of the last run, if it is still valid for the
+        given inputs, otherwise None.
+        """
+        entry = self.entries.get(os.path.abspath(target))
+        if entry is None:
+            return None
+        if entry["plan_hash"] != plan_hash or entry["run_hash"] != run_hash:
+            return None
+        output_path = entry["output_path"]
+        if output_path == os.path.abspath(target):
+            # the target has been replaced by the output
+            return output_path if target_hash == entry["output_hash"] else None
+        if target_hash != entry["target_hash"]:
+            return None
+        if not os.path.exists(output_path):
+            return None
+        if file_hash(output_path) != entry["output_hash"]:
+            return None
+        return output_path
+
+    def record(self, target, target_hash, plan_hash, run_hash, output_path):
+        output_path = os.path.abspath(output_path)
+        self.entries[os.path.abspath(target)] = {
+            "target_hash": target_hash,
+            "plan_hash": plan_hash,
+            "run_hash": run_hash,
+            "output_path": output_path,
+            "output_hash": file_hash(output_path),
+        }
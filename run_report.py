@@ -0,0 +1,152 @@
+import cProfile
+import io
+import pstats
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Optional
+
+from pydantic import BaseModel, Field
+
+STATUS_OK = "ok"
+STATUS_ERROR = "error"
+STATUS_SKIPPED = "skipped"
+
+# counters of the changes made to a target
+CHANGE_COUNTERS = ("nodes_removed", "nodes_inserted", "params_updated")
+
+# number of entries kept from the profiler and tracemalloc statistics
+PROFILE_TOP = 30
+
+
+class TargetReport(BaseModel):
+    """
+    What happened to a single target during a run.
+    """
+
+    outfile: str
+    result_file: Optional[str] = None
+    status: str = STATUS_OK
+    error: Optional[str] = None
+    # wall time in seconds per phase (parse, patch, write or stream)
+    phases: dict[str, float] = Field(default_factory=dict)
+    nodes_removed: int = 0
+    nodes_inserted: int = 0
+    params_updated: int = 0
+    bytes_read: int = 0
+    bytes_written: int = 0
+    # whether the target was broken XML, which had to be read in recover mode
+    recovered: bool = False
+    # the target with the same content, whose result was copied
+    duplicate_of: Optional[str] = None
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+
+class RunReport(BaseModel):
+    """
+    Report of a whole `MidiMapper.run`, with the reports of all targets in the
+    original order.
+    """
+
+    jobs: int = 1
+    total_s: float = 0.0
+    # wall time of the phases, which run once per run (e.g. reading the template)
+    phases: dict[str, float] = Field(default_factory=dict)
+    targets: list[TargetReport] = Field(default_factory=list)
+    profile: Optional[str] = None
+    memory_peak_bytes: Optional[int] = None
+    memory_top: list[str] = Field(default_factory=list)
+    # whether the run was stopped before all targets were done
+    cancelled: bool = False
+
+    def summary(self) -> dict:
+        """
+        Totals over all targets, per phase and per counter.
+        """
+        summary = {
+            "targets": len(self.targets),
+            "ok": 0,
+            "error": 0,
+            "skipped": 0,
+            "recovered": 0,
+            "duplicates": 0,
+            "phases": {},
+            "nodes_removed": 0,
+            "nodes_inserted": 0,
+            "params_updated": 0,
+            "bytes_read": 0,
+            "bytes_written": 0,
+        }
+        for target in self.targets:
+            summary[target.status] += 1
+            summary["recovered"] += int(target.recovered)
+            summary["duplicates"] += int(target.duplicate_of is not None)
+            for name, seconds in target.phases.items():
+                summary["phases"][name] = summary["phases"].get(name, 0.0) + seconds
+            for counter in [
+                "nodes_removed",
+                "nodes_inserted",
+                "params_updated",
+                "bytes_read",
+                "bytes_written",
+            ]:
+                summary[counter] += getattr(target, counter)
+        return summary
+
+
+class RunProfiler:
+    """
+    Optional cProfile and tracemalloc capture around a run.
+    """
+
+    def __init__(self, profile: bool = False, trace_memory: bool = False):
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.profiler = None
+        self.started_tracing = False
+        self.snapshot = None
+        self.memory_peak_bytes = None
+
+    def __enter__(self):
+        if self.trace_memory:
+            # tracing, which was started by someone else, is left running
+            self.started_tracing = not tracemalloc.is_tracing()
+            if self.started_tracing:
+                tracemalloc.start()
+        if self.profile:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc):
+        # the capture is stopped on every exit, also if the run raised
+        try:
+            if self.profiler is not None:
+                self.profiler.disable()
+            if self.trace_memory and tracemalloc.is_tracing():
+                self.snapshot = tracemalloc.take_snapshot()
+                _, self.memory_peak_bytes = tracemalloc.get_traced_memory()
+        finally:
+            if self.started_tracing:
+                tracemalloc.stop()
+                self.started_tracing = False
+        return False
+
+    def fill_report(self, report: RunReport):
+        if self.profiler is not None:
+            stream = io.StringIO()
+            stats = pstats.Stats(self.profiler, stream=stream)
+            stats.sort_stats("cumulative").print_stats(PROFILE_TOP)
+            report.profile = stream.getvalue()
+        if self.snapshot is not None:
+            report.memory_peak_bytes = self.memory_peak_bytes
+            report.memory_top = [
+                str(stat) for stat in self.snapshot.statistics("lineno")[:PROFILE_TOP]
+            ]
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+"""
+Finds the .wav files of Blackbox projects, which aren't referenced by the
+`preset.xml` of their project, and deletes them or moves them to a trash
+folder. This is what the `clean` operation of the Blackbox does:
+
+    python sample_cleaner.py /path/to/blackbox/projects/
+    python sample_cleaner.py /path/to/blackbox/projects/ --mode trash
+    python sample_cleaner.py /path/to/blackbox/projects/ --mode delete
+"""
+
+import argparse
+import os
+import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from lxml import etree
+from pydantic import BaseModel, Field
+
+from device_detection import preset_matcher, walk_library
+from format_utils import format_size
+from xml_parser import get_parser, strip_trailing_bytes
+
+SAMPLE_EXTENSIONS = (".wav",)
+CLEAN_MODES = ("dry-run", "trash", "delete")
+# folder in the library root the unused samples are moved to in trash mode
+TRASH_FOLDER = ".trash"
+CLEAN_MESSAGES = {
+    "dry-run": "Unreferenced file",
+    "trash": "Moving unreferenced file",
+    "delete": "Deleting unreferenced file",
+}
+
+
+class ProjectScan(BaseModel):
+    project: str
+    referenced: int = 0
+    unused: list = Field(default_factory=list)
+    unused_bytes: int = 0
+    error: Optional[str] = None
+
+
+def sample_reference(filename: str) -> str:
+    """
+    Normalizes a `filename` attribute (e.g. `.\\kick.wav`) to the path relative
+    to the project folder.
+
+    The SD card of the Blackbox is FAT formatted, so the names are compared
+    case-insensitively.
+    """
+    reference = filename.replace("\\", "/")
+    while reference.startswith("./"):
+        reference = reference[2:]
+    return reference.casefold()
+
+
+def preset_references(preset_path: str) -> set:
+    """
+    Returns the normalized sample paths, which the cells of a preset reference.
+
+    The preset is parsed strictly, a broken preset raises an XMLSyntaxError,
+    because the references of a recovered tree might be incomplete. Only the
+    trailing NUL byte of the presets is stripped beforehand.
+    """
+    with open(preset_path, "rb") as f:
+        root = etree.fromstring(strip_trailing_bytes(f.read()), parser=get_parser())
+    return {
+        sample_reference(filename)
+        for filename in root.xpath(".//cell/@filename")
+        if filename
+    }
+
+
+def scan_project(folder: str, project_filename: str = "preset.xml") -> ProjectScan:
+    """
+    Returns the samples directly in the project folder, which aren't referenced
+    by its preset.
+    """
+    scan = ProjectScan(project=folder)
+    try:
+        references = preset_references(os.path.join(folder, project_filename))
+    except (OSError, etree.XMLSyntaxError) as e:
+        scan.error = str(e)
+        return scan
+    scan.referenced = len(references)
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if not entry.name.lower().endswith(SAMPLE_EXTENSIONS):
+                continue
+            if not entry.is_file(follow_symlinks=False):
+                continue
+            if sample_reference(entry.name) in references:
+                continue
+            scan.unused.append(entry.path)
+            scan.unused_bytes += entry.stat(follow_symlinks=False).st_size
+    scan.unused.sort()
+    return scan
+
+
+def find_projects(root_folder: str, project_filename: str = "preset.xml") -> list:
+    """
+    Returns the folders of the library, which contain a project file.
+    """
+    matches = preset_matcher(project_filename=project_filename)
+    return sorted(
+        {os.path.dirname(entry.path) for _, entry in walk_library(root_folder, matches)}
+    )
+
+
+def scan_library(
+    root_folder: str, project_filename: str = "preset.xml", max_workers=None
+) -> list:
+    """
+    Scans all projects of the library in parallel.
+
+    Returns:
+        list: A `ProjectScan` per project, sorted by folder.
+    """
+    projects = find_projects(root_folder, project_filename)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(lambda p: scan_project(p, project_filename), projects))
+
+
+def clean_project(
+    scan: ProjectScan, mode: str = "dry-run", trash_folder: str = None
+) -> int:
+    """
+    Removes the unused samples of a scanned project.
+
+    Args:
+        scan (ProjectScan): The result of `scan_project`.
+        mode (str): `dry-run` only reports, `trash` moves the samples to
+            `trash_folder/<project>/` and `delete` deletes them.
+        trash_folder (str): The folder for the trash mode.
+
+    Returns:
+        int: The bytes reclaimed (or which would be reclaimed in dry-run mode).
+    """
+    if mode not in CLEAN_MODES:
+        raise ValueError(f"Unknown mode '{mode}', use one of {CLEAN_MODES}.")
+    if mode == "trash" and trash_folder is None:
+        raise ValueError("The trash mode needs a trash folder.")
+    reclaimed = 0
+    for path in scan.unused:
+        try:
+            size = os.stat(path).st_size
+            if mode == "trash":
+                destination = os.path.join(trash_folder, os.path.basename(scan.project))
+                os.makedirs(destination, exist_ok=True)
+                shutil.move(path, os.path.join(destination, os.path.basename(path)))
+            elif mode == "delete":
+                os.remove(path)
+        except OSError as e:
+            print(f"Error removing file {path}: {e}")
+            continue
+        reclaimed += size
+    return reclaimed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Delete .wav files, which aren't referenced by their preset."
+    )
+    parser.add_argument("folder", help="Folder with the Blackbox projects")
+    parser.add_argument(
+        "--mode",
+        choices=CLEAN_MODES,
+        default="dry-run",
+        help="Only list the files (default), move them to a trash folder or delete them",
+    )
+    parser.add_argument(
+        "--trash-folder",
+        default=None,
+        help=f"Folder for the trash mode (default: '{TRASH_FOLDER}' in the library)",
+    )
+    parser.add_argument(
+        "--project-filename",
+        default="preset.xml",
+        help="Name of the project files",
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=None, help="Number of threads"
+    )
+
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.folder):
+        print(f"Error: Folder '{args.folder}' does not exist.")
+        sys.exit(1)
+    trash_folder = args.trash_folder or os.path.join(args.folder, TRASH_FOLDER)
+
+    total = 0
+    for scan in scan_library(args.folder, args.project_filename, args.jobs):
+        if scan.error is not None:
+            # without the references nothing can be removed safely
+            print(f"Skipping '{scan.project}': {scan.error}")
+            continue
+        for path in scan.unused:
+            print(f"{CLEAN_MESSAGES[args.mode]}: {path}")
+        total += clean_project(scan, args.mode, trash_folder)
+    if args.mode == "dry-run":
+        print(f"{format_size(total)} could be reclaimed.")
+    else:
+        print(f"{format_size(total)} reclaimed.")
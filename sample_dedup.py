@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+
+"""
+Finds the samples, which are copied into several Blackbox projects, and
+replaces the copies with hardlinks (or reflinks) to a single file:
+
+    python sample_dedup.py /path/to/blackbox/projects/
+    python sample_dedup.py /path/to/blackbox/projects/ --mode hardlink
+
+Only files of the same size are compared, first by a hash of their head and
+tail and only then by a hash of the whole content. The hashes are kept in a
+cache file, so a re-run only hashes new or changed samples.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from format_utils import format_size
+from mapping_plan import file_hash
+from sample_cleaner import find_projects, preset_references, sample_reference
+
+HASH_CACHE_VERSION = 1
+# bytes of the head and the tail of a sample, which are hashed by the prefilter
+PARTIAL_HASH_SIZE = 64 * 1024
+LINK_MODES = ("dry-run", "hardlink", "reflink")
+# name of the hash cache in the library root
+HASH_CACHE_FILENAME = ".sample_hashes.json"
+# ioctl of Linux to share the extents of a file on btrfs, xfs, ...
+FICLONE = 0x40049409
+
+
+class HashCache:
+    """
+    Remembers the hashes of every sample, keyed by the absolute path. An entry
+    is only used while the size, mtime and inode of the file are the same.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except ValueError:
+            # a broken cache only means that everything is hashed again
+            return
+        if data.get("version") != HASH_CACHE_VERSION:
+            return
+        self.entries = data.get("entries", {})
+
+    def save(self):
+        if self.path is None:
+            return
+        folder = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(folder, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=folder, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"version": HASH_CACHE_VERSION, "entries": self.entries}, f)
+        os.replace(tmp_path, self.path)
+
+    def get(self, path, stat, kind) -> str:
+        with self.lock:
+            entry = self.entries.get(path)
+        if entry is None or entry["stat"] != stat_key(stat):
+            return None
+        return entry.get(kind)
+
+    def put(self, path, stat, kind, value):
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None or entry["stat"] != stat_key(stat):
+                entry = self.entries[path] = {"stat": stat_key(stat)}
+            entry[kind] = value
+
+
+def stat_key(stat) -> list:
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+
+def partial_hash(path, size: int = PARTIAL_HASH_SIZE) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        h.update(f.read(size))
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        if end > size:
+            f.seek(max(size, end - size))
+            h.update(f.read(size))
+    return h.hexdigest()
+
+
+def project_samples(project: str, project_filename: str = "preset.xml") -> list:
+    """
+    Returns the samples in the project folder, which its preset references.
+    """
+    references = preset_references(os.path.join(project, project_filename))
+    samples = []
+    with os.scandir(project) as entries:
+        for entry in entries:
+            if entry.is_file(follow_symlinks=False) and (
+                sample_reference(entry.name) in references
+            ):
+                samples.append(os.path.abspath(entry.path))
+    return samples
+
+
+class SampleDedup:
+    """
+    Groups samples with the same content and links the copies to one of them.
+
+    The files are grouped by device and size, then by a hash of their head and
+    tail and only the remaining candidates are hashed completely. Files, which
+    are already hardlinked, count as one.
+    """
+
+    def __init__(self, cache_path: str = None, max_workers=None):
+        self.cache = HashCache(cache_path)
+        self.max_workers = max_workers
+        self.hashed_bytes = 0
+        self.lock = threading.Lock()
+
+    def cached_hash(self, path, stat, kind, func) -> str:
+        value = self.cache.get(path, stat, kind)
+        if value is None:
+            value = func(path)
+            self.cache.put(path, stat, kind, value)
+            with self.lock:
+                self.hashed_bytes += (
+                    min(stat.st_size, 2 * PARTIAL_HASH_SIZE)
+                    if kind == "partial"
+                    else stat.st_size
+                )
+        return value
+
+    def refine(self, groups, kind, func) -> list:
+        # splits every group by the hash of one file per inode
+        files = [f for group in groups for f in group]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            hashes = list(
+                executor.map(
+                    lambda f: self.cached_hash(f[0], f[1], kind, func),
+                    files,
+                )
+            )
+        refined = {}
+        index = 0
+        for group_index, group in enumerate(groups):
+            for f in group:
+                refined.setdefault((group_index, hashes[index]), []).append(f)
+                index += 1
+        return [group for group in refined.values() if len(group) > 1]
+
+    def find_duplicates(self, paths) -> list:
+        """
+        Returns the groups of files with the same content as lists of paths.
+        The first path of every group is the one, which is kept.
+        """
+        inodes = {}
+        for path in sorted(set(paths)):
+            try:
+                stat = os.stat(path)
+            except OSError as e:
+                print(f"Error reading file {path}: {e}")
+                continue
+            if stat.st_size == 0:
+                continue
+            inodes.setdefault((stat.st_dev, stat.st_ino), []).append((path, stat))
+        # one file per inode is hashed, the other paths are already links
+        by_size = {}
+        for (dev, _), links in inodes.items():
+            by_size.setdefault((dev, links[0][1].st_size), []).append(links[0])
+        groups = [group for group in by_size.values() if len(group) > 1]
+        groups = self.refine(groups, "partial", partial_hash)
+        groups = self.refine(groups, "full", file_hash)
+        duplicates = []
+        for group in groups:
+            paths = []
+            for path, stat in sorted(group):
+                paths += [p for p, _ in inodes[(stat.st_dev, stat.st_ino)]]
+            duplicates.append(paths)
+        return sorted(duplicates)
+
+    def link_duplicates(self, duplicates, mode: str = "dry-run") -> int:
+        """
+        Replaces every copy with a link to the first file of its group.
+
+        Returns:
+            int: The bytes saved (or which would be saved in dry-run mode).
+        """
+        if mode not in LINK_MODES:
+            raise ValueError(f"Unknown mode '{mode}', use one of {LINK_MODES}.")
+        saved = 0
+        for group in duplicates:
+            source = group[0]
+            source_stat = os.stat(source)
+            replaced = set()
+            for path in group[1:]:
+                stat = os.stat(path)
+                if os.path.samestat(stat, source_stat):
+                    continue
+                try:
+                    if mode != "dry-run":
+                        link_file(source, path, mode)
+                except OSError as e:
+                    print(f"Error linking file {path}: {e}")
+                    continue
+                replaced.add((stat.st_dev, stat.st_ino))
+                if mode != "dry-run":
+                    # the link has the content of the source, so its hashes
+                    # don't have to be computed again
+                    link_stat = os.stat(path)
+                    for kind in ("partial", "full"):
+                        value = self.cache.get(source, source_stat, kind)
+                        if value is not None:
+                            self.cache.put(path, link_stat, kind, value)
+            saved += len(replaced) * source_stat.st_size
+        return saved
+
+    def save(self):
+        self.cache.save()
+
+
+def link_file(source, target, mode):
+    # the link is created next to the target and then moved over it, so the
+    # target is never missing
+    tmp_path = target + ".dedup.tmp"
+    try:
+        if mode == "hardlink":
+            os.link(source, tmp_path)
+        elif mode == "reflink":
+            import fcntl
+
+            with open(source, "rb") as src, open(tmp_path, "wb") as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        os.replace(tmp_path, target)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replace copies of samples across projects with links."
+    )
+    parser.add_argument("folder", help="Folder with the Blackbox projects")
+    parser.add_argument(
+        "--mode",
+        choices=LINK_MODES,
+        default="dry-run",
+        help="Only list the copies (default), replace them with hardlinks or "
+        + "with reflinks (copy-on-write filesystems on Linux)",
+    )
+    parser.add_argument(
+        "--cache",
+        default=None,
+        help=f"Hash cache file (default: '{HASH_CACHE_FILENAME}' in the library)",
+    )
+    parser.add_argument(
+        "--project-filename",
+        default="preset.xml",
+        help="Name of the project files",
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=None, help="Number of hashing threads"
+    )
+
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.folder):
+        print(f"Error: Folder '{args.folder}' does not exist.")
+        sys.exit(1)
+
+    samples = []
+    for project in find_projects(args.folder, args.project_filename):
+        try:
+            samples += project_samples(project, args.project_filename)
+        except Exception as e:
+            print(f"Skipping '{project}': {e}")
+
+    dedup = SampleDedup(
+        args.cache or os.path.join(args.folder, HASH_CACHE_FILENAME), args.jobs
+    )
+    duplicates = dedup.find_duplicates(samples)
+    for group in duplicates:
+        for path in group[1:]:
+            print(f"Copy of {group[0]}: {path}")
+    saved = dedup.link_duplicates(duplicates, args.mode)
+    dedup.save()
+    print(f"Hashed {format_size(dedup.hashed_bytes)} of {len(samples)} samples.")
+    if args.mode == "dry-run":
+        print(f"{format_size(saved)} could be saved.")
+    else:
+        print(f"{format_size(saved)} saved.")
@@ -2,11 +2,12 @@
 
 # Check if a folder is provided as an argument
 if [ $# -eq 0 ]; then
-  echo "Usage: $0 <folder> [filename]"
+  echo "Usage: $0 <folder> [filename] [--since previous.zip]"
   exit 1
 fi
 
 root_folder="$1"
+shift
 
 # Check if the provided folder exists
 if [ ! -d "$root_folder" ]; then
@@ -15,13 +16,13 @@ if [ ! -d "$root_folder" ]; then
 fi
 
 # Set the filename to search for, defaulting to "preset.xml"
-filename="${2:-preset.xml}"
-
-# Create a zip file containing all files matching the filename while preserving local folder structure
-zip_file="preset_files.zip"
-echo "Creating zip file: $zip_file"
-cd "$root_folder" || exit 1
-find . -type f -name "$filename" -print | zip -@ "../$zip_file"
-cd - > /dev/null
+filename="preset.xml"
+if [ $# -gt 0 ] && [ "${1#-}" = "$1" ]; then
+  filename="$1"
+  shift
+fi
 
-echo "Zip file created: $zip_file"
+# the files are packed by tenten_zip_utils.py into ../preset_files.zip,
+# keeping the local folder structure
+script_dir="$(cd "$(dirname "$0")" && pwd)"
+python3 "$script_dir/../tenten_zip_utils.py" "$root_folder" -f "$filename" "$@"
@@ -0,0 +1,132 @@
+import os
+import tempfile
+
+from lxml import etree
+
+from cell_visitor import noteseq_cell_keys
+from models import TENTEN_MIDIMAP_ITEMS
+from xml_parser import iterparse_document
+
+XML_DECLARATION = b"<?xml version='1.0' encoding='UTF-8'?>\n"
+
+# elements up to this depth (the document and the session) are only opened and
+# closed in the output, everything below is patched and written one by one
+CONTAINER_DEPTH = 1
+
+
+class StreamPatcher:
+    """
+    Patches a target file with `iterparse` and writes it with an incremental
+    writer, so that only a single child of the session (usually a `cell`) is
+    held in memory at a time.
+
+    The result is the same as the one of `MidiMapper.process_outfile`: the first
+    cell in document order with matching coordinates receives the template data.
+    """
+
+    def __init__(self, mapper):
+        self.mapper = mapper
+        self.visitor = mapper.cell_visitor()
+
+    def scan_noteseq_keys(self, filepath):
+        # a noteseq cell falls back to the cell without seqsublayer only if no
+        # matching cell exists anywhere in the file, so these keys are collected
+        # in a cheap first pass, which stops once all keys of the template are
+        # found
+        wanted_keys = self.visitor.wanted_noteseq_keys()
+        if not wanted_keys:
+            return set()
+        return noteseq_cell_keys(self.iter_cells(filepath), wanted_keys)
+
+    def iter_cells(self, filepath):
+        for _, cell in etree.iterparse(
+            filepath, tag="cell", recover=True, huge_tree=True
+        ):
+            yield cell
+            cell.clear(keep_tail=True)
+
+    def patch(self, filepath, result_path):
+        folder = os.path.dirname(os.path.abspath(result_path))
+        fd, tmp_path = tempfile.mkstemp(dir=folder, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                counters = self.mapper.report_counters()
+                try:
+                    self.patch_to(filepath, f)
+                except etree.XMLSyntaxError:
+                    # start over in the slower recover mode, without counting
+                    # the changes of the failed pass
+                    self.mapper.restore_report_counters(counters)
+                    f.seek(0)
+                    f.truncate()
+                    self.patch_to(filepath, f, recover=True)
+                    self.mapper.mark_recovered(filepath)
+            # the result may replace the file we have just been reading
+            os.replace(tmp_path, result_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return result_path
+
+    def patch_to(self, filepath, f, recover=False):
+        self.visitor.start(noteseq_keys=self.scan_noteseq_keys(filepath))
+        self.session_done = False
+
+        f.write(XML_DECLARATION)
+        with etree.xmlfile(f, encoding="UTF-8") as xf:
+            depth = -1
+            # the open containers with a flag, whether their text has been written
+            containers = []
+            # the text and tail of an element are only complete once the next
+            # event arrives, so they are written one event late
+            pending_tail = None
+            for event, elem in iterparse_document(filepath, recover=recover):
+                if event == "start":
+                    depth += 1
+                    if containers and not containers[-1][2]:
+                        xf.write(containers[-1][0].text or "")
+                        containers[-1][2] = True
+                    pending_tail = self.flush_tail(xf, pending_tail)
+                    if depth <= CONTAINER_DEPTH:
+                        context = xf.element(elem.tag, dict(elem.attrib))
+                        context.__enter__()
+                        containers.append([elem, context, False])
+                    continue
+
+                if depth <= CONTAINER_DEPTH:
+                    pending_tail = self.flush_tail(xf, pending_tail)
+                    _, context, text_written = containers.pop()
+                    if not text_written:
+                        xf.write(elem.text or "")
+                    if elem.tag == "session" and not self.session_done:
+                        self.write_midimap(xf)
+                        self.session_done = True
+                    context.__exit__(None, None, None)
+                    pending_tail = elem
+                elif depth == CONTAINER_DEPTH + 1:
+                    if self.visitor.visit_unit(elem):
+                        xf.write(elem, with_tail=False)
+                    else:
+                        # a deleted node takes its tail with it
+                        elem.tail = None
+                    pending_tail = elem
+                depth -= 1
+
+        f.write(b"\n")
+        if self.mapper.tenten_device in TENTEN_MIDIMAP_ITEMS and not self.session_done:
+            raise IndexError("No session found in outfile.")
+        self.visitor.report_missing_cells()
+
+    def flush_tail(self, xf, elem):
+        if elem is None:
+            return None
+        xf.write(elem.tail or "")
+        parent = elem.getparent()
+        if parent is not None:
+            elem.clear()
+            parent.remove(elem)
+        return None
+
+    def write_midimap(self, xf):
+        if self.visitor.needs_midimap():
+            xf.write(self.visitor.new_midimap())
@@ -1,11 +1,28 @@
 import os
+import time
+import uuid
+import zipfile
 import streamlit as st
 from tempfile import NamedTemporaryFile, TemporaryDirectory
 from pathlib import Path
-from tenten_zip_utils import zip_files_to_memory, unzip_files, zip_folder_to_memory
+from tenten_zip_utils import (
+    zip_files_to_spooled_file,
+    list_project_members,
+    map_zip_to_spooled_file,
+)
 
 from midi_mapper import MidiMapper
+from mapping_job import MappingJob
+from mapping_template import get_template
+from format_utils import format_size
+from upload_utils import (
+    MAX_PROJECT_FILE_SIZE,
+    SESSION_UPLOAD_QUOTA,
+    save_upload,
+    upload_quota,
+)
 from models import (
+    PROJECT_FILENAMES,
     TENTEN_EXTENSIONS,
     TENTEN_ZIP_PRODUCTS,
     TenTenDevice,
@@ -80,6 +97,23 @@ if "is_zipfile_upload" not in st.session_state:
 if "zip_output" not in st.session_state:
     st.session_state["zip_output"] = None
 
+if "uploaded_zip_path" not in st.session_state:
+    st.session_state["uploaded_zip_path"] = None
+
+if "mapping_job" not in st.session_state:
+    st.session_state["mapping_job"] = None
+
+# the error of the last failed job, shown until the next job starts
+if "mapping_error" not in st.session_state:
+    st.session_state["mapping_error"] = None
+
+# identifies the session for the upload quota
+if "session_id" not in st.session_state:
+    st.session_state["session_id"] = str(uuid.uuid4())
+
+# seconds between two updates of the progress bar
+PROGRESS_INTERVAL = 0.2
+
 
 ######################################
 # Title
@@ -102,6 +136,58 @@ def cleanup_temp_folders():
     """
     st.session_state["temp_folder"].cleanup()
     st.session_state["temp_zip_extraction_folder"].cleanup()
+    upload_quota.release(st.session_state["session_id"])
+
+
+def start_over():
+    """
+    Drops the uploads and lets the user start over with new temp folders.
+    """
+    cleanup_temp_folders()
+    # the uploads are written again into new temp folders on the next run
+    st.session_state["temp_folder"] = TemporaryDirectory(
+        suffix="",
+        prefix="tenten_folder_",
+        delete=False,
+    )
+    st.session_state["temp_zip_extraction_folder"] = TemporaryDirectory(
+        suffix="",
+        prefix="tenten_zip_extraction_",
+        delete=False,
+    )
+    reset_midi_mapper()
+    st.session_state["preset_uploaded"] = False
+    st.session_state["disable_preset_upload"] = False
+    st.session_state["disable_outfile_upload"] = False
+    st.session_state["uploaded_zip_path"] = None
+
+
+def reserve_upload(nbytes):
+    """
+    Reserves room for an upload, before anything of it is written.
+    Returns False and shows an error, if the upload is too large.
+    """
+    try:
+        upload_quota.reserve(st.session_state["session_id"], nbytes)
+    except ValueError as e:
+        st.error(str(e))
+        return False
+    return True
+
+
+def write_upload(uploaded_file, suffix):
+    """
+    Writes an upload in chunks into the temp folder and returns the path.
+    """
+    with NamedTemporaryFile(
+        suffix=suffix,
+        prefix=uploaded_file.name,
+        delete=False,
+        delete_on_close=False,
+        dir=st.session_state["temp_folder"].name,
+    ) as temp_file:
+        save_upload(uploaded_file, temp_file)
+    return temp_file.name
 
 
 def reset_midi_mapper():
@@ -116,6 +202,22 @@ def reset_midi_mapper():
     st.session_state["uploaded_outfiles"] = None
 
 
+# the uploads of sessions, which haven't been seen for a while, are deleted and
+# their quota is released, see `UploadQuota`
+if st.session_state["zip_output"] is None and not os.path.isdir(
+    st.session_state["temp_folder"].name
+):
+    start_over()
+    st.warning("Your uploads have expired, please upload the files again.")
+upload_quota.touch(
+    st.session_state["session_id"],
+    [
+        st.session_state["temp_folder"].name,
+        st.session_state["temp_zip_extraction_folder"].name,
+    ],
+)
+
+
 ######################################
 # 1 Device Selection
 ######################################
@@ -170,21 +272,14 @@ if st.session_state["device"] is not None:
     if (
         st.session_state["uploaded_preset"] is not None
         and not st.session_state["disable_preset_upload"]
+        and reserve_upload(st.session_state["uploaded_preset"].size)
     ):
         suffix = Path(st.session_state["uploaded_preset"].name).suffix
-
-        with NamedTemporaryFile(
-            suffix=suffix,
-            prefix=st.session_state["uploaded_preset"].name,
-            delete=False,
-            delete_on_close=False,
-            dir=st.session_state["temp_folder"].name,
-        ) as temp_file:
-            temp_file.write(st.session_state["uploaded_preset"].getvalue())
-            temp_file.seek(0)
-            st.session_state["mm"].read_preset_file(temp_file.name)
-            st.session_state["preset_uploaded"] = True
-
+        # the template is parsed once the settings are known, see `get_template`
+        st.session_state["mm"].infile = write_upload(
+            st.session_state["uploaded_preset"], suffix
+        )
+        st.session_state["preset_uploaded"] = True
         st.session_state["disable_preset_upload"] = True
 
 ######################################
@@ -202,10 +297,11 @@ if st.session_state["preset_uploaded"]:
     if st.session_state["is_zipfile_upload"]:
 
         st.markdown(
-            """
+            f"""
             #### Zip you projects before uploading
             - copy the project folders you want to map into a new folder
-            - _please_ remove all .wav files from the project folders (memory is limited on this server ;))
+            - the .wav files are copied over without being touched, but you can remove them
+              from the project folders to speed up the upload (the limit is {format_size(SESSION_UPLOAD_QUOTA)})
             - zip the folder and upload it here
             """
         )
@@ -218,26 +314,33 @@ if st.session_state["preset_uploaded"]:
         if (
             st.session_state["uploaded_outfiles"] is not None
             and st.session_state["disable_outfile_upload"] is False
+            and reserve_upload(st.session_state["uploaded_outfiles"].size)
         ):
-
-            with NamedTemporaryFile(
-                suffix=".zip",
-                prefix=st.session_state["uploaded_outfiles"].name,
-                delete=False,
-                delete_on_close=False,
-                dir=st.session_state["temp_folder"].name,
-            ) as temp_file:
-                temp_file.write(st.session_state["uploaded_outfiles"].getvalue())
-                temp_file.seek(0)
-                file_paths = unzip_files(
-                    zip_name=temp_file.name,
-                    extract_to=st.session_state["temp_zip_extraction_folder"].name,
-                    file_extension=st.session_state["file_extension"],
+            zip_path = write_upload(st.session_state["uploaded_outfiles"], ".zip")
+            # the zip file is mapped member by member later on, so nothing has to
+            # be extracted here, the project files are only checked by their
+            # entries in the central directory
+            try:
+                project_members = list_project_members(
+                    zip_name=zip_path,
+                    project_filename=PROJECT_FILENAMES[st.session_state["device"]],
+                    max_file_size=MAX_PROJECT_FILE_SIZE,
                 )
-                for file_path in file_paths:
-                    st.session_state["mm"].add_outfile(file_path)
-            if len(st.session_state["mm"].outfiles) > 0:
+            except (ValueError, zipfile.BadZipFile) as e:
+                st.error(f"The zip file can't be mapped: {e}")
+                project_members = []
+            if len(project_members) > 0:
+                st.session_state["uploaded_zip_path"] = zip_path
                 st.session_state["disable_outfile_upload"] = True
+            else:
+                os.remove(zip_path)
+                upload_quota.free(
+                    st.session_state["session_id"],
+                    st.session_state["uploaded_outfiles"].size,
+                )
+                st.warning(
+                    f"No {PROJECT_FILENAMES[st.session_state['device']]} files found in the zip file."
+                )
 
     #### Multiple files upload
     else:
@@ -252,20 +355,13 @@ if st.session_state["preset_uploaded"]:
         if (
             st.session_state["uploaded_outfiles"] is not None
             and st.session_state["disable_outfile_upload"] is False
+            and reserve_upload(
+                sum(f.size for f in st.session_state["uploaded_outfiles"])
+            )
         ):
             for uploaded_file in st.session_state["uploaded_outfiles"]:
                 suffix = Path(uploaded_file.name).suffix
-
-                with NamedTemporaryFile(
-                    suffix=suffix,
-                    prefix=uploaded_file.name,
-                    delete=False,
-                    delete_on_close=False,
-                    dir=st.session_state["temp_folder"].name,
-                ) as temp_file:
-                    temp_file.write(uploaded_file.getvalue())
-                    temp_file.seek(0)
-                    st.session_state["mm"].add_outfile(temp_file.name)
+                st.session_state["mm"].add_outfile(write_upload(uploaded_file, suffix))
             if len(st.session_state["mm"].outfiles) > 0:
                 st.session_state["disable_outfile_upload"] = True
 
@@ -349,44 +445,126 @@ def read_midi_settings():
 # 5 Run Mapping
 ######################################
 
+
+def map_uploaded_files(mm, is_zipfile_upload, uploaded_zip_path, project_filename):
+    """
+    Runs on the background thread of the mapping job, so it must not use the
+    session state.
+    """
+    if is_zipfile_upload:
+        # large archives are moved to disk instead of being held in memory
+        return map_zip_to_spooled_file(
+            zip_in=uploaded_zip_path,
+            mapper=mm,
+            project_filename=project_filename,
+        )
+    # the files are zipped while the others are still mapped
+    result_files = (
+        target.result_file for target in mm.iter_run() if target.result_file is not None
+    )
+    # large archives are moved to disk instead of being held in memory
+    return zip_files_to_spooled_file(
+        file_list=result_files,
+        cleanup=True,
+    )
+
+
+def cancel_mapping_job():
+    """
+    Stops the running job, frees the temp folders and lets the user start over.
+    """
+    st.session_state["mapping_job"].cancel()
+    st.session_state["mapping_job"] = None
+    start_over()
+
+
 if st.session_state["disable_outfile_upload"]:
     opti_label = "Transfer Preset Settings"
     if st.button(
         label=opti_label,
         type="primary",
         use_container_width=False,
-        disabled=st.session_state["zip_output"] is not None,
+        disabled=st.session_state["zip_output"] is not None
+        or st.session_state["mapping_job"] is not None,
     ):
-        try:
-            st.session_state["mm"].overwrite_files = True
-            st.session_state["mm"].tenten_device = st.session_state["device"]
-            st.session_state["mm"].device_settings = read_device_settings()
-            st.session_state["mm"].general_midi_settings = read_midi_settings()
-            result_files = st.session_state["mm"].run()
-            # TODO read zip file to memory and make downloadable
-            st.session_state["zip_out_name"] = (
-                f"{st.session_state['device']}_mapped_files.zip"
+        with open(st.session_state["mm"].infile, "rb") as f:
+            template_xml = f.read()
+        # parsed templates are shared by all sessions, the mapper of the job
+        # only holds the targets
+        template = get_template(
+            template_xml,
+            tenten_device=st.session_state["device"],
+            general_midi_settings=read_midi_settings(),
+            device_settings=read_device_settings(),
+        )
+        job_mapper = MidiMapper(
+            template=template,
+            outfiles=list(st.session_state["mm"].outfiles),
+            overwrite_files=True,
+        )
+        st.session_state["zip_out_name"] = (
+            f"{st.session_state['device']}_mapped_files.zip"
+        )
+        is_zipfile_upload = st.session_state["is_zipfile_upload"]
+        uploaded_zip_path = st.session_state["uploaded_zip_path"]
+        project_filename = PROJECT_FILENAMES.get(st.session_state["device"])
+        st.session_state["mapping_error"] = None
+        st.session_state["mapping_job"] = MappingJob(
+            job_mapper,
+            lambda mm: map_uploaded_files(
+                mm, is_zipfile_upload, uploaded_zip_path, project_filename
+            ),
+        )
+        st.session_state["mapping_job"].start()
+
+if st.session_state["mapping_job"] is not None:
+    job = st.session_state["mapping_job"]
+    # a click on the button reruns the script, which stops the polling below
+    if st.button("Cancel", disabled=not job.running()):
+        cancel_mapping_job()
+        st.warning("Mapping cancelled.")
+    else:
+        progress_bar = st.progress(0.0)
+        while True:
+            running = job.running()
+            progress_bar.progress(
+                job.fraction(),
+                text=f"{job.done} of {job.total} files mapped "
+                + f"({job.files_per_second():.1f} files/s)",
             )
-            if st.session_state["is_zipfile_upload"]:
-                # get the folder of the extracted zip file
-                st.session_state["zip_output"] = zip_folder_to_memory(
-                    st.session_state["temp_zip_extraction_folder"].name
-                )
-            else:
-                st.session_state["zip_output"] = zip_files_to_memory(
-                    file_list=result_files,
-                    cleanup=True,
-                )
+            if not running:
+                break
+            time.sleep(PROGRESS_INTERVAL)
+        st.session_state["mapping_job"] = None
+        if job.error is not None:
+            # the targets may already be partly overwritten, so the uploads
+            # are dropped like on cancel and the user starts over
+            st.session_state["mapping_error"] = str(job.error)
+            start_over()
+        else:
+            st.session_state["zip_output"] = job.result
             st.success("Mapping completed successfully.")
 
-        except Exception as e:
-            st.error(f"Error during mapping: {e}")
-            cleanup_temp_folders()
+if st.session_state["mapping_error"] is not None:
+    st.error(f"Error during mapping: {st.session_state['mapping_error']}")
 
 
 ######################################
 # 5 Download Button
 ######################################
+def zip_output_size():
+    zip_output = st.session_state["zip_output"]
+    zip_output.seek(0, os.SEEK_END)
+    return zip_output.tell()
+
+
+def read_zip_output():
+    # streamlit needs the whole archive as bytes, so it is only read on the
+    # rerun, in which the user asks for the download
+    st.session_state["zip_output"].seek(0)
+    return st.session_state["zip_output"].read()
+
+
 if st.session_state["zip_output"] is not None:
     cleanup_temp_folders()
     st.markdown(
@@ -395,10 +573,18 @@ if st.session_state["zip_output"] is not None:
     """
     )
 
-    st.download_button(
-        label="Download mapped files",
-        data=st.session_state["zip_output"],
-        file_name=st.session_state["zip_out_name"],
-        mime="application/zip",
+    if st.button(
+        label=f"Prepare download ({format_size(zip_output_size())})",
         use_container_width=True,
-    )
+    ):
+        # the download doesn't rerun the script, so the archive stays available
+        # until the next interaction
+        st.download_button(
+            label="Download mapped files",
+            data=read_zip_output(),
+            file_name=st.session_state["zip_out_name"],
+            mime="application/zip",
+            type="primary",
+            on_click="ignore",
+            use_container_width=True,
+        )
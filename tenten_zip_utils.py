@@ -1,10 +1,41 @@
+import argparse
 import io
+import json
 import os
+import shutil
+import struct
+import tempfile
+import time
 import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
 
+from device_detection import preset_matcher, walk_library
+from mapping_plan import file_hash
 from mod_source_list import NUM_SLOTS, ModSourceList
 import models
 
+# archives up to this size are kept in memory by `zip_files_to_spooled_file`
+ZIP_SPOOL_THRESHOLD = 64 * 1024 * 1024
+# members with these extensions are compressed already, so they are stored
+STORED_EXTENSIONS = (".zip", ".mp3", ".ogg", ".flac", ".m4a", ".png", ".jpg", ".jpeg")
+# the private attributes of `ZipFile`, which `write_raw_member` relies on
+RAW_WRITE_ATTRIBUTES = (
+    "_lock",
+    "_writecheck",
+    "_didModify",
+    "_seekable",
+    "start_dir",
+    "fp",
+    "filelist",
+    "NameToInfo",
+)
+# archives of `pack_library` list the packed files in this member
+PACK_MANIFEST_NAME = "pack_manifest.json"
+PACK_MANIFEST_VERSION = 1
+
 
 def zip_files(file_list, zip_name):
     """
@@ -32,33 +63,78 @@ def clean_up_filename(file_path):
         return file_name
 
 
-def zip_files_to_memory(file_list, cleanup=False):
+def zip_files_to_memory(
+    file_list,
+    cleanup=False,
+    compression=zipfile.ZIP_DEFLATED,
+    compresslevel=None,
+    max_workers=None,
+):
     """
     Zips all files in file_list into a single zip file in memory.
 
     Args:
         file_list (list): List of file paths to include in the zip.
-        zipfile_name (str): Name of the zip file.
+        cleanup (bool): Whether to remove the random part of the file names.
+        compression (int): zipfile.ZIP_DEFLATED or zipfile.ZIP_STORED.
+        compresslevel (int): zlib compression level, None for the default.
+        max_workers (int): Number of threads compressing the files.
 
     Returns:
         BytesIO: A BytesIO object containing the zip file.
     """
     zip_buffer = io.BytesIO()
-
-    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zipf:
-        for file_path in file_list:
-            with open(file_path, "rb") as f:
-                file_data = f.read()
-                if cleanup:
-                    file_name = clean_up_filename(file_path)
-                else:
-                    file_name = file_path.split("/")[-1]
-                zipf.writestr(file_name, file_data)
-
+    zip_files_to_file(
+        file_list, zip_buffer, cleanup, compression, compresslevel, max_workers
+    )
     zip_buffer.seek(0)
     return zip_buffer
 
 
+def zip_files_to_spooled_file(
+    file_list,
+    cleanup=False,
+    compression=zipfile.ZIP_DEFLATED,
+    compresslevel=None,
+    max_workers=None,
+    spool_threshold=ZIP_SPOOL_THRESHOLD,
+):
+    """
+    Same as `zip_files_to_memory`, but the zip file is moved to a temporary file
+    on disk, once it gets larger than spool_threshold bytes.
+
+    Returns:
+        SpooledTemporaryFile: The zip file, positioned at the start.
+    """
+    zip_file = tempfile.SpooledTemporaryFile(max_size=spool_threshold)
+    zip_files_to_file(
+        file_list, zip_file, cleanup, compression, compresslevel, max_workers
+    )
+    zip_file.seek(0)
+    return zip_file
+
+
+def zip_files_to_file(
+    file_list,
+    fileobj,
+    cleanup=False,
+    compression=zipfile.ZIP_DEFLATED,
+    compresslevel=None,
+    max_workers=None,
+):
+    """
+    Zips all files in file_list into the file object fileobj, the files are
+    compressed in parallel.
+    """
+    with ParallelZipWriter(fileobj, compression, compresslevel, max_workers) as writer:
+        for file_path in file_list:
+            if cleanup:
+                file_name = clean_up_filename(file_path)
+            else:
+                file_name = file_path.split("/")[-1]
+            writer.add(file_name, file_path)
+
+
 def unzip_files(zip_name, extract_to, file_extension=None):
     """
     Unzips the zip file zip_name into the directory extract_to.
@@ -82,25 +158,452 @@ def unzip_files(zip_name, extract_to, file_extension=None):
         return file_paths
 
 
-def zip_folder_to_memory(folder_path):
+def zip_folder_to_memory(
+    folder_path,
+    compression=zipfile.ZIP_DEFLATED,
+    compresslevel=None,
+    max_workers=None,
+):
     """
     Zips all files inside a folder, maintaining the folder structure, and writes the resulting zip file to an io.BytesIO.
 
     Args:
         folder_path (str): Path to the folder to zip.
+        compression (int): zipfile.ZIP_DEFLATED or zipfile.ZIP_STORED.
+        compresslevel (int): zlib compression level, None for the default.
+        max_workers (int): Number of threads compressing the files.
 
     Returns:
         BytesIO: A BytesIO object containing the zip file.
     """
     zip_buffer = io.BytesIO()
 
-    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zipf:
+    with ParallelZipWriter(
+        zip_buffer, compression, compresslevel, max_workers
+    ) as writer:
         for root, _, files in os.walk(folder_path):
             for file in files:
                 file_path = os.path.join(root, file)
-                with open(file_path, "rb") as f:
-                    file_data = f.read()
-                    zipf.writestr(os.path.relpath(file_path, folder_path), file_data)
+                writer.add(os.path.relpath(file_path, folder_path), file_path)
 
     zip_buffer.seek(0)
     return zip_buffer
+
+
+def compress_member(data, compression, compresslevel):
+    """
+    Compresses the data of a single member the same way zipfile does it.
+    Runs on the threads of `ParallelZipWriter`, zlib releases the GIL.
+
+    Returns:
+        tuple: The compressed data, the CRC and the uncompressed size.
+    """
+    crc = zlib.crc32(data)
+    if compression == zipfile.ZIP_STORED:
+        return data, crc, len(data)
+    if compresslevel is None:
+        compresslevel = zlib.Z_DEFAULT_COMPRESSION
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(), crc, len(data)
+
+
+def read_and_compress_member(source, compression, compresslevel):
+    if isinstance(source, bytes):
+        data = source
+    else:
+        with open(source, "rb") as f:
+            data = f.read()
+    return compress_member(data, compression, compresslevel)
+
+
+class ParallelZipWriter:
+    """
+    Writes a zip file, whose members are compressed on a thread pool. The
+    members are written in the order they were added and only a few of them
+    are held in memory at a time.
+    """
+
+    def __init__(
+        self,
+        fileobj,
+        compression=zipfile.ZIP_DEFLATED,
+        compresslevel=None,
+        max_workers=None,
+    ):
+        self.compression = compression
+        self.compresslevel = compresslevel
+        self.max_workers = max_workers or min(8, os.cpu_count() or 1)
+        self.zipf = zipfile.ZipFile(fileobj, "w", compression)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self.pending = deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.zipf.close()
+        return False
+
+    def add(self, arcname, source):
+        """
+        Adds a member from a file path or from bytes, like `ZipFile.writestr`.
+        """
+        compression = self.compression
+        if arcname.lower().endswith(STORED_EXTENSIONS):
+            compression = zipfile.ZIP_STORED
+        zinfo = zipfile.ZipInfo(arcname, time.localtime(time.time())[:6])
+        zinfo.external_attr = 0o600 << 16
+        zinfo.compress_type = compression
+        future = self.executor.submit(
+            read_and_compress_member, source, compression, self.compresslevel
+        )
+        self.pending.append((zinfo, future))
+        # a bounded number of members is compressed ahead of the writer
+        while len(self.pending) > 2 * self.max_workers:
+            self.write_next()
+
+    def write_next(self):
+        zinfo, future = self.pending.popleft()
+        data, crc, file_size = future.result()
+        zinfo.CRC = crc
+        zinfo.file_size = file_size
+        zinfo.compress_size = len(data)
+        write_raw_member(self.zipf, zinfo, [data])
+
+    def close(self):
+        try:
+            while self.pending:
+                self.write_next()
+        finally:
+            self.executor.shutdown(wait=True)
+            self.zipf.close()
+
+
+def is_project_member(member_name, project_filename):
+    """
+    Checks whether a zip member is a project file, which has to be mapped.
+    """
+    if "__MACOSX" in member_name:
+        return False
+    return member_name.split("/")[-1] == project_filename
+
+
+def list_project_members(zip_name, project_filename, max_file_size=None):
+    """
+    Returns the names of all project files in the zip file without extracting it.
+    With max_file_size a ValueError is raised for larger project files, which
+    are rejected before anything of them is read.
+    """
+    with zipfile.ZipFile(zip_name, "r") as zipf:
+        project_members = []
+        for zinfo in zipf.infolist():
+            if not is_project_member(zinfo.filename, project_filename):
+                continue
+            if max_file_size is not None and zinfo.file_size > max_file_size:
+                raise ValueError(
+                    f"{zinfo.filename} is too large ({zinfo.file_size} bytes)."
+                )
+            project_members.append(zinfo.filename)
+        return project_members
+
+
+def copy_raw_member(zip_in, zip_out, zinfo):
+    """
+    Copies a member from zip_in to zip_out without decompressing and
+    compressing it again.
+    """
+    if not supports_raw_write(zip_out):
+        # decompressed and compressed again with the public API
+        with zip_in.open(zinfo) as src, zip_out.open(copy(zinfo), "w") as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+        return
+    # skip the local file header of the source, its extra field may differ
+    # from the one in the central directory
+    zip_in.fp.seek(zinfo.header_offset)
+    header = zip_in.fp.read(zipfile.sizeFileHeader)
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    zip_in.fp.seek(name_length + extra_length, os.SEEK_CUR)
+
+    new_info = copy(zinfo)
+    write_raw_member(zip_out, new_info, _read_chunks(zip_in.fp, zinfo))
+
+
+def _read_chunks(fp, zinfo):
+    remaining = zinfo.compress_size
+    while remaining > 0:
+        chunk = fp.read(min(remaining, 1 << 20))
+        if not chunk:
+            raise zipfile.BadZipFile(f"Truncated member {zinfo.filename}")
+        yield chunk
+        remaining -= len(chunk)
+
+
+def supports_raw_write(zip_out) -> bool:
+    """
+    Checks whether the zipfile of this Python has the internals, which
+    `write_raw_member` needs, and isn't writing another member right now.
+    """
+    return all(hasattr(zip_out, a) for a in RAW_WRITE_ATTRIBUTES) and not getattr(
+        zip_out, "_writing", False
+    )
+
+
+def _decompress_chunks(chunks, compress_type):
+    if compress_type == zipfile.ZIP_STORED:
+        yield from chunks
+        return
+    if compress_type != zipfile.ZIP_DEFLATED:
+        raise NotImplementedError(f"Compression {compress_type} is not supported.")
+    decompressor = zlib.decompressobj(-15)
+    for chunk in chunks:
+        yield decompressor.decompress(chunk)
+    yield decompressor.flush()
+
+
+def write_raw_member(zip_out, zinfo, chunks):
+    """
+    Writes a member, whose compressed data, sizes and CRC are known already.
+
+    zipfile has no public API for this, so the local header and the compressed
+    data are written the same way `ZipFile.write` does it. If the internals
+    of zipfile are different (see `supports_raw_write`), the data is
+    decompressed and written with `ZipFile.open` instead.
+    """
+    if not supports_raw_write(zip_out):
+        with zip_out.open(zinfo, "w") as f:
+            for chunk in _decompress_chunks(chunks, zinfo.compress_type):
+                f.write(chunk)
+        return
+    # the sizes and the crc are known, so they go into the local header instead
+    # of a data descriptor behind the data
+    zinfo.flag_bits &= ~0x08
+    with zip_out._lock:
+        zip_out._writecheck(zinfo)
+        zip_out._didModify = True
+        if zip_out._seekable:
+            zip_out.fp.seek(zip_out.start_dir)
+        zinfo.header_offset = zip_out.fp.tell()
+        zip_out.fp.write(zinfo.FileHeader())
+        for chunk in chunks:
+            zip_out.fp.write(chunk)
+        zip_out.start_dir = zip_out.fp.tell()
+        zip_out.filelist.append(zinfo)
+        zip_out.NameToInfo[zinfo.filename] = zinfo
+
+
+def map_zip_to_zip(zip_in, zip_out, mapper, project_filename):
+    """
+    Maps all project files of the zip file zip_in with the MidiMapper and writes
+    them into zip_out. Nothing is extracted to disk: the project files are
+    patched in memory and all other members (e.g. .wav samples) are copied over
+    as they are, without decompressing them.
+    The progress and cancellation hooks of the mapper are used per project file,
+    a cancelled run leaves zip_out incomplete.
+
+    Args:
+        zip_in: Path or file object of the uploaded zip file.
+        zip_out: Path or file object the new zip file is written to.
+        mapper (MidiMapper): Mapper with the template and settings set.
+        project_filename (str): Name of the project files, e.g. `preset.xml`.
+
+    Returns:
+        list: The names of the members which have been mapped.
+    """
+    mapper.prepare_template()
+    mapped_members = []
+    with zipfile.ZipFile(zip_in, "r") as zipf_in, zipfile.ZipFile(
+        zip_out, "w", zipfile.ZIP_DEFLATED
+    ) as zipf_out:
+        members = zipf_in.infolist()
+        total = sum(is_project_member(z.filename, project_filename) for z in members)
+        done = 0
+        for zinfo in members:
+            if mapper.cancelled():
+                break
+            if is_project_member(zinfo.filename, project_filename):
+                done += 1
+                try:
+                    xml = mapper.patch_bytes(zipf_in.read(zinfo), zinfo.filename)
+                except Exception as e:
+                    # the original file is kept, if it can't be mapped
+                    mapper.report_error(zinfo.filename, e)
+                else:
+                    new_info = zipfile.ZipInfo(zinfo.filename, zinfo.date_time)
+                    new_info.external_attr = zinfo.external_attr
+                    new_info.compress_type = zipfile.ZIP_DEFLATED
+                    zipf_out.writestr(new_info, xml)
+                    mapped_members.append(zinfo.filename)
+                    continue
+                finally:
+                    mapper.report_progress(done, total)
+            copy_raw_member(zipf_in, zipf_out, zinfo)
+    return mapped_members
+
+
+def map_zip_to_memory(zip_in, mapper, project_filename):
+    """
+    Same as `map_zip_to_zip`, but the new zip file is written to a BytesIO.
+
+    Returns:
+        BytesIO: A BytesIO object containing the zip file.
+    """
+    zip_buffer = io.BytesIO()
+    map_zip_to_zip(zip_in, zip_buffer, mapper, project_filename)
+    zip_buffer.seek(0)
+    return zip_buffer
+
+
+def map_zip_to_spooled_file(
+    zip_in, mapper, project_filename, spool_threshold=ZIP_SPOOL_THRESHOLD
+):
+    """
+    Same as `map_zip_to_zip`, but the new zip file is moved to a temporary file
+    on disk, once it gets larger than spool_threshold bytes.
+
+    Returns:
+        SpooledTemporaryFile: The zip file, positioned at the start.
+    """
+    zip_file = tempfile.SpooledTemporaryFile(max_size=spool_threshold)
+    map_zip_to_zip(zip_in, zip_file, mapper, project_filename)
+    zip_file.seek(0)
+    return zip_file
+
+
+def read_pack_manifest(zip_name):
+    """
+    Returns the files listed by an archive of `pack_library`, an empty dict if
+    it has no (valid) manifest.
+    """
+    with zipfile.ZipFile(zip_name, "r") as zipf:
+        try:
+            data = json.loads(zipf.read(PACK_MANIFEST_NAME))
+        except (KeyError, ValueError):
+            return {}
+    if data.get("version") != PACK_MANIFEST_VERSION:
+        return {}
+    return data.get("files", {})
+
+
+def pack_library(
+    library_path,
+    fileobj,
+    tenten_device=None,
+    project_filename=None,
+    previous_files=None,
+    compression=zipfile.ZIP_DEFLATED,
+    compresslevel=None,
+    max_workers=None,
+):
+    """
+    Zips the project files of a library with their folder structure, e.g. to
+    upload them to the web tool. The files are streamed into the zip, nothing
+    is copied to a staging folder.
+
+    The archive lists every project file of the library with its size, mtime
+    and hash in `PACK_MANIFEST_NAME`. With the files of a previous archive
+    (see `read_pack_manifest`) only the project files which changed since then
+    are packed.
+
+    Args:
+        library_path (str): Folder with the projects.
+        fileobj: Path or file object the zip file is written to.
+        tenten_device (TenTenDevice): Device, which selects the project files.
+        project_filename (str): Name of the project files, instead of the device.
+        previous_files (dict): Files of the manifest of a previous archive.
+        compression (int): zipfile.ZIP_DEFLATED or zipfile.ZIP_STORED.
+        compresslevel (int): zlib compression level, None for the default.
+        max_workers (int): Number of threads compressing the files.
+
+    Returns:
+        tuple: The names of the packed members and the files of the manifest.
+    """
+    previous_files = previous_files or {}
+    matches = preset_matcher(tenten_device, project_filename)
+    files = {}
+    packed = []
+    with ParallelZipWriter(fileobj, compression, compresslevel, max_workers) as writer:
+        for name, entry in sorted(
+            walk_library(library_path, matches), key=lambda item: item[0]
+        ):
+            path = entry.path
+            stat = entry.stat()
+            previous = previous_files.get(name)
+            if (
+                previous is not None
+                and previous["size"] == stat.st_size
+                and previous["mtime_ns"] == stat.st_mtime_ns
+            ):
+                files[name] = previous
+                continue
+            files[name] = {
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "sha256": file_hash(path),
+            }
+            if previous is not None and previous["sha256"] == files[name]["sha256"]:
+                # touched, but not changed
+                continue
+            writer.add(name, path)
+            packed.append(name)
+        manifest = {"version": PACK_MANIFEST_VERSION, "files": files}
+        writer.add(PACK_MANIFEST_NAME, json.dumps(manifest, indent=1).encode())
+    return packed, files
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Zip the project files of a library with their folder structure."
+    )
+    parser.add_argument("folder", help="Folder with the projects")
+    parser.add_argument(
+        "-t",
+        "--tenten_device",
+        default="blackbox",
+        choices=[d.value for d in models.TenTenDevice],
+        help="TenTen device type, which selects the project files",
+    )
+    parser.add_argument(
+        "-f",
+        "--filename",
+        default=None,
+        help="Name of the project files (default: the one of the device)",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default=None,
+        help="Zip file to write (default: preset_files.zip next to the folder)",
+    )
+    parser.add_argument(
+        "--since",
+        default=None,
+        help="Previous archive, only project files changed since then are packed",
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=None, help="Number of compressing threads"
+    )
+
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.folder):
+        print(f"Error: Folder '{args.folder}' does not exist.")
+        raise SystemExit(1)
+    output = args.output or os.path.join(
+        os.path.dirname(os.path.abspath(args.folder)), "preset_files.zip"
+    )
+    # the manifest is read first, the previous archive might be overwritten
+    previous_files = read_pack_manifest(args.since) if args.since else None
+    print(f"Creating zip file: {output}")
+    packed, files = pack_library(
+        args.folder,
+        output,
+        models.TenTenDevice(args.tenten_device),
+        args.filename,
+        previous_files,
+        max_workers=args.jobs,
+    )
+    print(f"Zip file created: {output} ({len(packed)} of {len(files)} project files)")
@@ -0,0 +1,96 @@
+import unittest
+
+from lxml import etree
+
+from cc_analysis import CCAnalysis
+from cell_index import CellIndex, cell_coordinates, cell_key
+from midi_mapper import MidiMapper, DEFAULT_SLOT
+from mod_source_list import SlotPlanner
+from preset_generator import generate_preset
+import models
+
+
+class TestCCAnalysis(unittest.TestCase):
+    def analyse(self, device, template, targets, general_midi_settings, wipe=True):
+        analysis = CCAnalysis(device, general_midi_settings, wipe)
+        analysis.template.add_root(etree.fromstring(template), "template")
+        for index, target in enumerate(targets):
+            analysis.presets.add_root(etree.fromstring(target), str(index))
+        analysis.template.finish()
+        analysis.presets.finish()
+        return analysis.summary()
+
+    def planned_evictions(self, device, template, target, general_midi_settings, wipe):
+        # what `SlotPlanner` really removes from the target
+        mm = MidiMapper(
+            tenten_device=device, general_midi_settings=general_midi_settings
+        )
+        mm.wipe_existing_mappings = wipe
+        mm.root_infile = etree.fromstring(template)
+        mm.extract_template_data()
+        root = etree.fromstring(target)
+        mm.wipe_modsources(root)
+        coordinates = cell_coordinates(device)
+        cell_index = CellIndex(root, coordinates)
+        cells = {}
+        for modsource in mm.modsources_infile:
+            key = cell_key(modsource.getparent().attrib, coordinates)
+            cells.setdefault(key, []).append(modsource)
+        removed = []
+        for key, modsources in cells.items():
+            cell = cell_index.cells.get(key)
+            if cell is not None:
+                planner = SlotPlanner(cell.iterchildren("modsource"), DEFAULT_SLOT)
+                removed += planner.plan(modsources)[0]
+        return len(removed), sum(1 for m in removed if m.get("src") != "midicc")
+
+    def test_evictions_match_slot_planner(self):
+        for device in (models.TenTenDevice.BLACKBOX, models.TenTenDevice.LEMONDROP):
+            for mod_sources in (
+                [m for m in models.ModSources],
+                [models.ModSources.VELOCITY, models.ModSources.MIDICC],
+            ):
+                for wipe in (True, False):
+                    general_midi_settings = models.GeneralMidiSettings(
+                        mod_sources=mod_sources
+                    )
+                    template = generate_preset(device, modsources_per_cell=8)
+                    targets = [generate_preset(device, seed=s) for s in range(1, 16)]
+                    summary = self.analyse(
+                        device, template, targets, general_midi_settings, wipe
+                    )
+                    for target, preset in zip(targets, summary["presets"]):
+                        self.assertEqual(
+                            (
+                                preset["evicted_modsources"],
+                                len(preset["default_slot_evictions"]),
+                            ),
+                            self.planned_evictions(
+                                device, template, target, general_midi_settings, wipe
+                            ),
+                        )
+
+    def test_cc_collisions(self):
+        template = (
+            b'<document><session><cell row="0" column="0">'
+            b'<modsource dest="cutoff" src="midicc" mchan="0" ccnum="74" slot="0"/>'
+            b"</cell></session></document>"
+        )
+        target = (
+            b'<document><session><cell row="0" column="0">'
+            b'<modsource dest="cutoff" src="midicc" mchan="0" ccnum="74" slot="0"/>'
+            b'<modsource dest="pan" src="midicc" mchan="0" ccnum="74" slot="0"/>'
+            b'<modsource dest="level" src="midicc" mchan="1" ccnum="74" slot="0"/>'
+            b"</cell></session></document>"
+        )
+        general_midi_settings = models.GeneralMidiSettings(
+            mod_sources=[models.ModSources.MIDICC]
+        )
+        summary = self.analyse(
+            models.TenTenDevice.LEMONDROP, template, [target], general_midi_settings
+        )
+        preset = summary["presets"][0]
+        # only the pan modsource uses the CC of the template for something else
+        self.assertEqual(preset["cc_collisions"], 1)
+        self.assertEqual(preset["cc_collisions_left"], 0)
+        self.assertEqual(preset["colliding_ccs"], [[0, 74]])
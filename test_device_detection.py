@@ -0,0 +1,85 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from device_detection import detect_devices, group_presets, sniff_cells
+from mapping_index import find_presets
+from sample_cleaner import find_projects
+from tenten_zip_utils import pack_library
+from preset_generator import generate_preset
+import models
+
+
+class TestDeviceDetection(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write(self, name, data):
+        path = os.path.join(self.folder, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def test_detect_devices(self):
+        for device in models.TenTenDevice:
+            extension = models.TENTEN_EXTENSIONS[device.value]
+            path = self.write(
+                f"{device.value}/preset.{extension}",
+                generate_preset(device, num_cells=200),
+            )
+            # only the head of the large preset is parsed
+            self.assertGreater(os.path.getsize(path), 16 * 1024)
+            devices = detect_devices(path)
+            self.assertIn(device, devices)
+            if device != models.TenTenDevice.TANGERINE:
+                self.assertEqual(devices[0], device)
+
+    def test_lemondrop_file(self):
+        path = os.path.join("test_files", "lemondrop", "NuDefault.nnl")
+        self.assertEqual(detect_devices(path), [models.TenTenDevice.LEMONDROP])
+
+    def test_no_preset(self):
+        self.assertIsNone(sniff_cells(b"<html><body/></html>"))
+        self.assertIsNone(sniff_cells(b"RIFF\x00\x00"))
+        self.assertEqual(sniff_cells(b"<document><session><cell row="), [])
+
+    def test_group_presets(self):
+        devices = [models.TenTenDevice.BLACKBOX, models.TenTenDevice.LEMONDROP]
+        for device in devices:
+            for i in range(3):
+                self.write(
+                    f"{device.value}/{i}/p.{models.TENTEN_EXTENSIONS[device.value]}",
+                    generate_preset(device, seed=i),
+                )
+        self.write("__MACOSX/blackbox/p.xml", b"")
+        self.write("notes.xml", b"<notes/>")
+        groups = group_presets(self.folder, max_workers=4)
+        self.assertEqual(sorted(groups), devices)
+        self.assertEqual(
+            groups[models.TenTenDevice.LEMONDROP],
+            [os.path.join(self.folder, "lemondrop", str(i), "p.nnl") for i in range(3)],
+        )
+        groups = group_presets(self.folder, [models.TenTenDevice.LEMONDROP])
+        self.assertEqual(list(groups), [models.TenTenDevice.LEMONDROP])
+
+    def test_tools_find_the_same_presets(self):
+        device = models.TenTenDevice.LEMONDROP
+        for name in ["a/p.nnl", "a/b/P.NNL", ".hidden/p.nnl", "__MACOSX/a/p.nnl"]:
+            self.write(name, generate_preset(device))
+        for name in ["x/preset.xml", "x/y/preset.xml", ".trash/x/preset.xml"]:
+            self.write(name, generate_preset(models.TenTenDevice.BLACKBOX))
+        expected = [os.path.join(self.folder, p) for p in ["a/b/P.NNL", "a/p.nnl"]]
+        self.assertEqual(group_presets(self.folder, [device])[device], expected)
+        self.assertEqual(find_presets(self.folder, device), expected)
+        packed, _ = pack_library(self.folder, io.BytesIO(), device)
+        self.assertEqual(packed, ["a/b/P.NNL", "a/p.nnl"])
+        self.assertEqual(
+            find_projects(self.folder),
+            [os.path.join(self.folder, p) for p in ["x", "x/y"]],
+        )
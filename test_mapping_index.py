@@ -0,0 +1,69 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from lxml import etree
+
+from mapping_index import MappingIndex
+from preset_generator import generate_preset
+import models
+
+
+class TestMappingIndex(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.paths = []
+        for seed in range(4):
+            path = os.path.join(self.folder, f"project{seed}", "preset.xml")
+            os.makedirs(os.path.dirname(path))
+            with open(path, "wb") as f:
+                f.write(generate_preset(models.TenTenDevice.BLACKBOX, seed=seed))
+            self.paths.append(path)
+        self.index = MappingIndex(os.path.join(self.folder, "index.db"))
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.folder)
+
+    def index_folder(self):
+        return self.index.index_folder(self.folder, models.TenTenDevice.BLACKBOX)
+
+    def test_incremental(self):
+        self.assertEqual(self.index_folder()["indexed"], 4)
+        self.assertEqual(self.index_folder()["unchanged"], 4)
+        with open(self.paths[1], "wb") as f:
+            f.write(generate_preset(models.TenTenDevice.BLACKBOX, seed=10))
+        os.remove(self.paths[2])
+        stats = self.index_folder()
+        self.assertEqual(stats["indexed"], 1)
+        self.assertEqual(stats["removed"], 1)
+        self.assertEqual(self.index.count_files(), 3)
+
+    def test_queries(self):
+        self.index_folder()
+        modsource = next(
+            m
+            for m in etree.parse(self.paths[0]).getroot().iter("modsource")
+            if m.get("src") == "midicc"
+        )
+        self.assertIn(
+            self.paths[0],
+            self.index.presets_with_cc(modsource.get("ccnum"), modsource.get("mchan")),
+        )
+        self.assertEqual(self.index.presets_with_cc(1000), [])
+        self.assertEqual(
+            self.index.presets_with_param("outputbus", 1000, kind="pad"), []
+        )
+
+    def test_missing_template(self):
+        self.index_folder()
+        shutil.copy(self.paths[0], self.paths[3])
+        self.index_folder()
+        missing = dict(
+            self.index.presets_missing_template(
+                self.paths[0], models.TenTenDevice.BLACKBOX
+            )
+        )
+        self.assertNotIn(self.paths[3], missing)
+        self.assertIn(self.paths[1], missing)
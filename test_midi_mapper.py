@@ -1,6 +1,22 @@
+import os
+import random
+import shutil
+import tempfile
+import threading
+import tracemalloc
 import unittest
+from copy import copy
 
+from lxml import etree
+
+from mapping_job import MappingJob
+from mapping_template import MappingTemplate, TemplateCache
 from midi_mapper import MidiMapper
+from mod_source_list import ModSourceList
+from preset_generator import generate_preset, random_modsource
+from run_manifest import RunManifest
+from run_report import CHANGE_COUNTERS, RunProfiler
+from xml_parser import parse_xml
 import models
 
 
@@ -106,3 +122,797 @@ class TestRazzmatazz(unittest.TestCase):
         )
         mm.run()
         # TODO add some actual tests
+
+
+class TestCellIndex(unittest.TestCase):
+    def test_index_matches_xpath(self):
+        mm = MidiMapper(tenten_device=models.TenTenDevice.LEMONDROP)
+        root = mm.read_xml_file("./test_files/lemondrop/NuDefault.nnl")
+        cell_index = mm.build_cell_index(root)
+        for cell in root.xpath(".//cell"):
+            expected = root.xpath(
+                f'.//cell[@row="{cell.attrib["row"]}"][@column="{cell.attrib["column"]}"]'
+            )[0]
+            self.assertIs(mm.get_cell_from_outfile(cell_index, cell.attrib), expected)
+
+    def test_missing_cell(self):
+        mm = MidiMapper(tenten_device=models.TenTenDevice.LEMONDROP)
+        root = mm.read_xml_file("./test_files/lemondrop/NuDefault.nnl")
+        cell_index = mm.build_cell_index(root)
+        self.assertIsNone(cell_index.get_cell({"row": "99", "column": "0"}))
+
+
+class TestParallelRun(unittest.TestCase):
+    def setUp(self):
+        self.tmp_folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_folder)
+
+    def run_mapper(self, jobs):
+        folder = os.path.join(self.tmp_folder, f"jobs{jobs}")
+        shutil.copytree("./test_files/lemondrop", folder)
+        outfiles = []
+        for i in range(3):
+            outfile = os.path.join(folder, f"target{i}.nnl")
+            shutil.copy(os.path.join(folder, "NuDefault.nnl"), outfile)
+            outfiles.append(outfile)
+        mm = MidiMapper(
+            infile=os.path.join(folder, "TEST MAPPING.nnl"),
+            outfiles=outfiles,
+            tenten_device=models.TenTenDevice.LEMONDROP,
+            general_midi_settings=models.GeneralMidiSettings(
+                mod_sources=[m for m in models.ModSources]
+            ),
+            overwrite_files=True,
+        )
+        result_files = mm.run(jobs=jobs)
+        contents = []
+        for result_file in result_files:
+            with open(result_file, "rb") as f:
+                contents.append(f.read())
+        return [os.path.basename(f) for f in result_files], contents
+
+    def test_parallel_matches_serial(self):
+        serial_names, serial_contents = self.run_mapper(jobs=1)
+        parallel_names, parallel_contents = self.run_mapper(jobs=2)
+        self.assertEqual(serial_names, ["target0.nnl", "target1.nnl", "target2.nnl"])
+        self.assertEqual(serial_names, parallel_names)
+        self.assertEqual(serial_contents, parallel_contents)
+
+
+class LemondropTargetsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_folder = tempfile.mkdtemp()
+        shutil.copytree("./test_files/lemondrop", self.tmp_folder, dirs_exist_ok=True)
+        self.outfiles = []
+        for i in range(3):
+            outfile = os.path.join(self.tmp_folder, f"target{i}.nnl")
+            shutil.copy(os.path.join(self.tmp_folder, "NuDefault.nnl"), outfile)
+            self.outfiles.append(outfile)
+        self.mm = MidiMapper(
+            infile=os.path.join(self.tmp_folder, "TEST MAPPING.nnl"),
+            outfiles=list(self.outfiles),
+            tenten_device=models.TenTenDevice.LEMONDROP,
+            general_midi_settings=models.GeneralMidiSettings(
+                mod_sources=[m for m in models.ModSources]
+            ),
+            overwrite_files=False,
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_folder)
+
+
+class TestIterRun(LemondropTargetsTestCase):
+    def test_results_while_running(self):
+        targets = self.mm.iter_run()
+        first = next(targets)
+        self.assertEqual(first.outfile, self.outfiles[0])
+        self.assertEqual(first.status, "ok")
+        self.assertTrue(os.path.exists(first.result_file))
+        self.assertIn("parse", first.phases)
+        # the other targets haven't been mapped yet
+        self.assertEqual(self.mm.result_files, [first.result_file])
+        rest = list(targets)
+        self.assertEqual([t.outfile for t in rest], self.outfiles[1:])
+        self.assertEqual(len(self.mm.report.targets), 3)
+
+    def test_stop_early(self):
+        for jobs in [1, 2]:
+            self.mm.result_files = []
+            targets = self.mm.iter_run(jobs=jobs)
+            next(targets)
+            targets.close()
+            self.assertEqual(len(self.mm.result_files), 1)
+
+
+class TestProgressAndCancel(LemondropTargetsTestCase):
+    def test_progress(self):
+        progress = []
+        self.mm.progress_callback = lambda done, total: progress.append((done, total))
+        self.mm.run()
+        self.assertEqual(progress, [(1, 3), (2, 3), (3, 3)])
+        self.assertFalse(self.mm.report.cancelled)
+
+    def test_cancel(self):
+        cancel_event = threading.Event()
+        self.mm.cancel_event = cancel_event
+        self.mm.progress_callback = lambda done, total: cancel_event.set()
+        self.assertEqual(len(self.mm.run()), 1)
+        self.assertTrue(self.mm.report.cancelled)
+
+    def test_mapping_job(self):
+        job = MappingJob(self.mm, lambda mm: mm.run())
+        job.start()
+        job.wait()
+        self.assertIsNone(job.error)
+        self.assertEqual(len(job.result), 3)
+        self.assertEqual((job.done, job.total), (3, 3))
+        self.assertEqual(job.fraction(), 1.0)
+        self.assertGreater(job.files_per_second(), 0)
+
+
+class TestDedup(LemondropTargetsTestCase):
+    def setUp(self):
+        super().setUp()
+        # the same content with other quotes in the declaration
+        with open(os.path.join(self.tmp_folder, "NuDefault.nnl"), "rb") as f:
+            content = f.read()
+        outfile = os.path.join(self.tmp_folder, "quoted.nnl")
+        with open(outfile, "wb") as f:
+            f.write(content.replace(b'version="1.0"', b"version='1.0'", 1))
+        self.outfiles.append(outfile)
+        self.mm.outfiles = list(self.outfiles)
+
+    def contents(self, result_files):
+        contents = []
+        for result_file in result_files:
+            with open(result_file, "rb") as f:
+                contents.append(f.read())
+        return contents
+
+    def test_dedup(self):
+        expected = self.contents(self.mm.run())
+        for jobs in [1, 2]:
+            self.mm.dedup_targets = True
+            self.mm.result_files = []
+            report = self.mm.run(jobs=jobs, return_report=True)
+            self.assertEqual(self.contents(self.mm.result_files), expected)
+            self.assertEqual(
+                [t.duplicate_of for t in report.targets],
+                [None, self.outfiles[0], self.outfiles[0], None],
+            )
+            self.assertEqual(report.summary()["duplicates"], 2)
+
+    def test_canonical_dedup(self):
+        self.mm.dedup_targets = True
+        self.mm.canonical_dedup = True
+        report = self.mm.run(return_report=True)
+        self.assertEqual(report.targets[3].duplicate_of, self.outfiles[0])
+        self.assertEqual(report.summary()["duplicates"], 3)
+
+
+class TestMappingTemplate(LemondropTargetsTestCase):
+    def get_template(self, cache):
+        with open(self.mm.infile, "rb") as f:
+            xml = f.read()
+        return cache.get(
+            xml,
+            tenten_device=models.TenTenDevice.LEMONDROP,
+            general_midi_settings=models.GeneralMidiSettings(
+                mod_sources=[m for m in models.ModSources]
+            ),
+        )
+
+    def test_cache(self):
+        cache = TemplateCache(maxsize=1)
+        template = self.get_template(cache)
+        self.assertIs(self.get_template(cache), template)
+        cache.get(
+            generate_preset(models.TenTenDevice.LEMONDROP),
+            tenten_device=models.TenTenDevice.LEMONDROP,
+            general_midi_settings=models.GeneralMidiSettings(),
+        )
+        # the first template has been evicted
+        self.assertIsNot(self.get_template(cache), template)
+
+    def test_shared_between_threads(self):
+        self.mm.overwrite_files = True
+        self.mm.run()
+        expected = []
+        for outfile in self.outfiles:
+            with open(outfile, "rb") as f:
+                expected.append(f.read())
+            shutil.copy(os.path.join(self.tmp_folder, "NuDefault.nnl"), outfile)
+
+        template = self.get_template(TemplateCache())
+        jobs = []
+        for outfile in self.outfiles:
+            mm = MidiMapper(template=template, outfiles=[outfile], overwrite_files=True)
+            jobs.append(MappingJob(mm, lambda mm: mm.run()))
+        for job in jobs:
+            job.start()
+        for job, outfile, content in zip(jobs, self.outfiles, expected):
+            job.wait()
+            self.assertIsNone(job.error)
+            with open(outfile, "rb") as f:
+                self.assertEqual(f.read(), content)
+
+    def test_sessions_dont_share_outfiles(self):
+        # every session of the app creates its mapper without arguments
+        a, b = MidiMapper(), MidiMapper()
+        a.add_outfile(self.outfiles[0])
+        self.assertEqual(b.outfiles, [])
+        outfiles = [self.outfiles[0]]
+        MidiMapper(outfiles=outfiles).add_outfile(self.outfiles[1])
+        self.assertEqual(outfiles, [self.outfiles[0]])
+
+
+class TestMappingPlan(unittest.TestCase):
+    def setUp(self):
+        self.tmp_folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_folder)
+
+    def run_mapper(self, name, plan_cache_folder=None):
+        folder = os.path.join(self.tmp_folder, name)
+        shutil.copytree("./test_files/lemondrop", folder)
+        outfile = os.path.join(folder, "NuDefault.nnl")
+        mm = MidiMapper(
+            infile=os.path.join(folder, "TEST MAPPING.nnl"),
+            outfiles=[outfile],
+            tenten_device=models.TenTenDevice.LEMONDROP,
+            general_midi_settings=models.GeneralMidiSettings(
+                mod_sources=[m for m in models.ModSources]
+            ),
+            overwrite_files=True,
+            plan_cache_folder=plan_cache_folder,
+        )
+        mm.run()
+        with open(outfile, "rb") as f:
+            return mm, f.read()
+
+    def test_cached_plan_matches_template(self):
+        cache_folder = os.path.join(self.tmp_folder, "plans")
+        _, expected = self.run_mapper("plain")
+        _, compiled = self.run_mapper("compiled", cache_folder)
+        self.assertEqual(len(os.listdir(cache_folder)), 1)
+        mm, cached = self.run_mapper("cached", cache_folder)
+        # the cached plan is loaded without parsing the template
+        self.assertIsNone(mm.root_infile)
+        self.assertEqual(expected, compiled)
+        self.assertEqual(expected, cached)
+
+
+class TestStreaming(unittest.TestCase):
+    def setUp(self):
+        self.tmp_folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_folder)
+
+    def run_mapper(self, streaming):
+        folder = os.path.join(self.tmp_folder, f"streaming{streaming}")
+        shutil.copytree("./test_files/lemondrop", folder)
+        outfile = os.path.join(folder, "NuDefault.nnl")
+        mm = MidiMapper(
+            infile=os.path.join(folder, "TEST MAPPING.nnl"),
+            outfiles=[outfile],
+            tenten_device=models.TenTenDevice.LEMONDROP,
+            general_midi_settings=models.GeneralMidiSettings(
+                mod_sources=[m for m in models.ModSources]
+            ),
+            overwrite_files=True,
+            streaming=streaming,
+        )
+        mm.run()
+        self.assertEqual(mm.errors, [])
+        with open(outfile, "rb") as f:
+            return f.read()
+
+    def test_streaming_matches_tree(self):
+        self.assertEqual(self.run_mapper(False), self.run_mapper(True))
+
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_folder = tempfile.mkdtemp()
+        self.folder = os.path.join(self.tmp_folder, "lemondrop")
+        shutil.copytree("./test_files/lemondrop", self.folder)
+        self.manifest_file = os.path.join(self.tmp_folder, "manifest.json")
+        self.outfiles = []
+        for i in range(2):
+            outfile = os.path.join(self.folder, f"target{i}.nnl")
+            shutil.copy(os.path.join(self.folder, "NuDefault.nnl"), outfile)
+            self.outfiles.append(outfile)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_folder)
+
+    def run_mapper(self, mod_sources=None):
+        mm = MidiMapper(
+            infile=os.path.join(self.folder, "TEST MAPPING.nnl"),
+            outfiles=list(self.outfiles),
+            tenten_device=models.TenTenDevice.LEMONDROP,
+            general_midi_settings=models.GeneralMidiSettings(
+                mod_sources=mod_sources or [m for m in models.ModSources]
+            ),
+            overwrite_files=True,
+            manifest_file=self.manifest_file,
+        )
+        mm.run()
+        return mm
+
+    def test_failed_save(self):
+        manifest = RunManifest(self.manifest_file)
+        manifest.entries["target"] = object()
+        with self.assertRaises(TypeError):
+            manifest.save()
+        self.assertEqual(
+            [f for f in os.listdir(self.tmp_folder) if f.endswith(".tmp")], []
+        )
+
+    def test_skip_up_to_date(self):
+        mm = self.run_mapper()
+        self.assertEqual(len(mm.result_files), 2)
+        mm = self.run_mapper()
+        self.assertEqual(mm.result_files, [])
+        self.assertEqual(len(mm.skipped_files), 2)
+
+    def test_changed_target(self):
+        self.run_mapper()
+        shutil.copy(os.path.join(self.folder, "NuDefault.nnl"), self.outfiles[1])
+        mm = self.run_mapper()
+        self.assertEqual(mm.result_files, [self.outfiles[1]])
+
+    def test_changed_settings(self):
+        self.run_mapper()
+        mm = self.run_mapper(mod_sources=[models.ModSources.MIDICC])
+        self.assertEqual(len(mm.result_files), 2)
+
+    def test_missing_target(self):
+        missing = os.path.join(self.folder, "missing.nnl")
+        self.outfiles.insert(0, missing)
+        mm = self.run_mapper()
+        self.assertEqual([outfile for outfile, _ in mm.errors], [missing])
+        self.assertEqual(len(mm.result_files), 2)
+
+    def test_close_after_skipped_targets(self):
+        self.run_mapper()
+        mm = MidiMapper(
+            infile=os.path.join(self.folder, "TEST MAPPING.nnl"),
+            outfiles=list(self.outfiles),
+            tenten_device=models.TenTenDevice.LEMONDROP,
+            general_midi_settings=models.GeneralMidiSettings(
+                mod_sources=[m for m in models.ModSources]
+            ),
+            overwrite_files=True,
+            manifest_file=self.manifest_file,
+        )
+        reports = mm.iter_run()
+        # stopped before any target is mapped
+        self.assertEqual(next(reports).status, "skipped")
+        reports.close()
+
+
+class TestPresetGenerator(unittest.TestCase):
+    def test_all_devices(self):
+        tmp_folder = tempfile.mkdtemp()
+        try:
+            for device in models.TenTenDevice:
+                infile = os.path.join(tmp_folder, f"{device.value}_template.xml")
+                outfile = os.path.join(tmp_folder, f"{device.value}_target.xml")
+                for seed, path in enumerate([infile, outfile]):
+                    with open(path, "wb") as f:
+                        f.write(generate_preset(device, num_cells=8, seed=seed))
+                device_settings = None
+                if device == models.TenTenDevice.BLACKBOX:
+                    device_settings = models.BlackboxSettings()
+                mm = MidiMapper(
+                    infile=infile,
+                    outfiles=[outfile],
+                    tenten_device=device,
+                    device_settings=device_settings,
+                    general_midi_settings=models.GeneralMidiSettings(
+                        mod_sources=[m for m in models.ModSources]
+                    ),
+                    overwrite_files=True,
+                )
+                self.assertEqual(mm.run(), [outfile])
+                self.assertEqual(mm.errors, [])
+        finally:
+            shutil.rmtree(tmp_folder)
+
+
+class TestCellVisitor(unittest.TestCase):
+    def patch_separately(self, mm, root):
+        mm.wipe_modsources(root)
+        cell_index = mm.build_cell_index(root)
+        mm.insert_modsources(root, cell_index)
+        mm.insert_map_items(root)
+        mm.insert_pad_params(root, cell_index)
+        mm.insert_noteseq_params(root, cell_index)
+
+    def test_matches_separate_steps(self):
+        for device in models.TenTenDevice:
+            device_settings = None
+            if device == models.TenTenDevice.BLACKBOX:
+                device_settings = models.BlackboxSettings(
+                    pad_params=[p for p in models.BlackboxPadParam],
+                    noteseq_params=[p for p in models.BlackboxNoteseqParam],
+                )
+            mm = MidiMapper(
+                tenten_device=device,
+                device_settings=device_settings,
+                general_midi_settings=models.GeneralMidiSettings(
+                    mod_sources=[m for m in models.ModSources]
+                ),
+            )
+            mm.root_infile = etree.fromstring(generate_preset(device, seed=0))
+            mm.extract_template_data()
+            target = generate_preset(device, seed=1)
+            expected = etree.fromstring(target)
+            self.patch_separately(mm, expected)
+            patched = etree.fromstring(target)
+            mm.patch_root(patched)
+            self.assertEqual(
+                etree.tostring(patched), etree.tostring(expected), device.value
+            )
+
+
+class TestMidimapMerge(unittest.TestCase):
+    def setUp(self):
+        self.mm = MidiMapper(
+            tenten_device=models.TenTenDevice.RAZZMATAZZ,
+            general_midi_settings=models.GeneralMidiSettings(),
+        )
+        self.mm.root_infile = etree.fromstring(
+            b"<document><session><midimap>"
+            b'<mapitem mchan="0" ccnum="1" target="0" dest="level" min="1"/>'
+            b'<mapitem mchan="0" ccnum="2" target="1" dest="pan"/>'
+            b"</midimap></session></document>"
+        )
+        self.mm.extract_template_data()
+
+    def mapitems(self, root):
+        return [
+            (m.get("ccnum"), m.get("target"), m.get("dest"), m.get("min"))
+            for m in root.iter("mapitem")
+        ]
+
+    def test_merge(self):
+        root = etree.fromstring(
+            b"<document><session><midimap>"
+            b'<mapitem mchan="0" ccnum="9" target="5" dest="cutoff"/>'
+            b'<mapitem mchan="0" ccnum="1" target="0" dest="level" min="0"/>'
+            b'<mapitem mchan="0" ccnum="2" target="3" dest="res"/>'
+            b'<mapitem mchan="0" ccnum="7" target="1" dest="pan"/>'
+            b"</midimap></session></document>"
+        )
+        self.mm.patch_root(root)
+        self.assertEqual(
+            self.mapitems(root),
+            [
+                # unrelated to the template
+                ("9", "5", "cutoff", None),
+                # replaced in place
+                ("1", "0", "level", "1"),
+                # the controller and the parameter of the others are remapped
+                ("2", "1", "pan", None),
+            ],
+        )
+
+    def test_merge_without_wipe(self):
+        self.mm.wipe_existing_mappings = False
+        root = etree.fromstring(
+            b"<document><session><midimap>"
+            b'<mapitem mchan="0" ccnum="2" target="3" dest="res"/>'
+            b"</midimap></session></document>"
+        )
+        self.mm.patch_root(root)
+        self.assertEqual(
+            self.mapitems(root),
+            [
+                ("2", "3", "res", None),
+                ("1", "0", "level", "1"),
+                ("2", "1", "pan", None),
+            ],
+        )
+
+    def test_duplicates_in_template(self):
+        self.mm.root_infile = etree.fromstring(
+            b"<document><session><midimap>"
+            b'<mapitem mchan="0" ccnum="1" target="0" dest="level" min="1"/>'
+            b'<mapitem mchan="0" ccnum="2" target="1" dest="pan"/>'
+            b'<mapitem mchan="0" ccnum="1" target="0" dest="level" min="2"/>'
+            b"</midimap></session></document>"
+        )
+        self.mm.extract_template_data()
+        expected = [("1", "0", "level", "2"), ("2", "1", "pan", None)]
+        root = etree.fromstring(b"<document><session/></document>")
+        self.mm.patch_root(root)
+        self.assertEqual(self.mapitems(root), expected)
+        # the same result, if the target already has the mapitem
+        root = etree.fromstring(
+            b"<document><session><midimap>"
+            b'<mapitem mchan="0" ccnum="1" target="0" dest="level" min="0"/>'
+            b"</midimap></session></document>"
+        )
+        self.mm.patch_root(root)
+        self.assertEqual(self.mapitems(root), expected)
+
+    def test_insert_map_items_into_existing_midimap(self):
+        root = etree.fromstring(
+            b"<document><session><midimap>"
+            b'<mapitem mchan="0" ccnum="9" target="5" dest="cutoff"/>'
+            b"</midimap></session></document>"
+        )
+        self.mm.insert_map_items(root)
+        self.assertEqual(len(root.xpath(".//midimap")), 1)
+        self.assertEqual(len(self.mapitems(root)), 3)
+
+    def test_new_midimap(self):
+        root = etree.fromstring(b"<document><session/></document>")
+        self.mm.patch_root(root)
+        self.assertEqual(
+            self.mapitems(root),
+            [("1", "0", "level", "1"), ("2", "1", "pan", None)],
+        )
+
+
+class TestMultiTemplate(unittest.TestCase):
+    def templates(self, device):
+        device_settings = None
+        if device == models.TenTenDevice.BLACKBOX:
+            device_settings = models.BlackboxSettings(
+                pad_params=[models.BlackboxPadParam.MIDIMODE],
+                noteseq_params=[models.BlackboxNoteseqParam.MIDIOUTCHAN],
+            )
+        templates = []
+        # the templates share the midicc source, so they conflict
+        for seed, mod_sources in enumerate(
+            [
+                [models.ModSources.MIDICC, models.ModSources.VELOCITY],
+                [models.ModSources.MIDICC, models.ModSources.PITCHBEND],
+            ]
+        ):
+            templates.append(
+                MappingTemplate.from_bytes(
+                    generate_preset(device, modsources_per_cell=6, seed=10 + seed),
+                    device,
+                    models.GeneralMidiSettings(mod_sources=mod_sources),
+                    device_settings,
+                )
+            )
+        return templates
+
+    def canonical(self, xml):
+        parser = etree.XMLParser(remove_blank_text=True)
+        return etree.tostring(etree.fromstring(xml, parser), method="c14n2")
+
+    def test_matches_wipe_and_sequential_inserts(self):
+        # all selected sources are wiped once, then the templates only insert
+        for device in (models.TenTenDevice.BLACKBOX, models.TenTenDevice.LEMONDROP):
+            templates = self.templates(device)
+            target = generate_preset(device, seed=1)
+            root = etree.fromstring(target)
+            MidiMapper(
+                tenten_device=device,
+                general_midi_settings=models.GeneralMidiSettings(
+                    mod_sources=[
+                        models.ModSources.MIDICC,
+                        models.ModSources.VELOCITY,
+                        models.ModSources.PITCHBEND,
+                    ]
+                ),
+            ).wipe_modsources(root)
+            expected = etree.tostring(root)
+            for template in templates:
+                mm = MidiMapper(template=template)
+                mm.wipe_existing_mappings = False
+                expected = mm.patch_bytes(expected)
+            mm = MidiMapper(templates=templates)
+            self.assertEqual(
+                self.canonical(mm.patch_bytes(target)), self.canonical(expected)
+            )
+
+            folder = tempfile.mkdtemp()
+            try:
+                path = os.path.join(folder, "preset.xml")
+                with open(path, "wb") as f:
+                    f.write(target)
+                mm = MidiMapper(templates=templates, streaming=True)
+                mm.stream_outfile(path, path)
+                with open(path, "rb") as f:
+                    self.assertEqual(self.canonical(f.read()), self.canonical(expected))
+            finally:
+                shutil.rmtree(folder)
+
+    def test_templates_keep_each_others_modsources(self):
+        device = models.TenTenDevice.LEMONDROP
+        general_midi_settings = models.GeneralMidiSettings(
+            mod_sources=[m for m in models.ModSources]
+        )
+        templates = [
+            MappingTemplate.from_bytes(
+                b'<document><session><cell row="0" column="0">'
+                + modsource
+                + b"</cell></session></document>",
+                device,
+                general_midi_settings,
+            )
+            for modsource in (
+                b'<modsource dest="cutoff" src="midicc" ccnum="74" slot="0"/>',
+                b'<modsource dest="level" src="velocity" slot="0"/>',
+            )
+        ]
+        target = (
+            b'<document><session><cell row="0" column="0">'
+            b'<modsource dest="pan" src="midicc" ccnum="10" slot="0"/>'
+            b'<modsource dest="pitch" src="velocity" slot="0"/>'
+            b"</cell></session></document>"
+        )
+        root = etree.fromstring(MidiMapper(templates=templates).patch_bytes(target))
+        self.assertEqual(
+            [(m.get("src"), m.get("dest")) for m in root.iter("modsource")],
+            [("midicc", "cutoff"), ("velocity", "level")],
+        )
+
+    def test_device_mismatch(self):
+        mm = MidiMapper(template=self.templates(models.TenTenDevice.BLACKBOX)[0])
+        with self.assertRaises(ValueError):
+            mm.add_template(self.templates(models.TenTenDevice.BLUEBOX)[0])
+
+
+class TestSlotPlanner(unittest.TestCase):
+    def insert_one_by_one(self, cell, modsources):
+        # the placement of `ModSourceList`, one modsource at a time
+        for modsource in modsources:
+            same_dest = ModSourceList(
+                cell.xpath(f'./modsource[@dest="{modsource.attrib["dest"]}"]')
+            )
+            slot = same_dest.first_free_slot()
+            if slot is None:
+                replaced = same_dest.first_cc_modsource()
+                if replaced is None:
+                    slot = "1"
+                    replaced = same_dest.elem_at_slot(slot)
+                else:
+                    slot = replaced.attrib["slot"]
+                if replaced is not None:
+                    cell.remove(replaced)
+            new_elem = copy(modsource)
+            new_elem.attrib["slot"] = slot
+            cell.append(new_elem)
+
+    def test_matches_sequential_placement(self):
+        rng = random.Random(0)
+        mm = MidiMapper()
+        for _ in range(200):
+            cell = etree.Element("cell")
+            for _ in range(rng.randint(0, 8)):
+                etree.SubElement(cell, "modsource", random_modsource(rng, "level"))
+            modsources = [
+                etree.Element(
+                    "modsource", random_modsource(rng, rng.choice(["level", "pitch"]))
+                )
+                for _ in range(rng.randint(1, 6))
+            ]
+            expected = copy(cell)
+            self.insert_one_by_one(expected, modsources)
+            mm.insert_cell_modsources(modsources, cell)
+            self.assertEqual(etree.tostring(cell), etree.tostring(expected))
+
+
+class TestRecoverParse(unittest.TestCase):
+    def setUp(self):
+        self.tmp_folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_folder)
+
+    def run_mapper(self, streaming):
+        device = models.TenTenDevice.LEMONDROP
+        infile = os.path.join(self.tmp_folder, "template.nnl")
+        with open(infile, "wb") as f:
+            f.write(generate_preset(device, seed=0))
+        with open("test_files/lemondrop/NuDefault.nnl", "rb") as f:
+            real_preset = f.read()
+        outfiles = []
+        for name, xml in [
+            ("valid.nnl", generate_preset(device, seed=1)),
+            # the closing tag of the document is missing
+            ("broken.nnl", generate_preset(device, seed=2).rsplit(b"</", 1)[0]),
+            # a preset of the device, it ends with a NUL byte after the root
+            ("real.nnl", real_preset),
+        ]:
+            outfile = os.path.join(self.tmp_folder, name)
+            with open(outfile, "wb") as f:
+                f.write(xml)
+            outfiles.append(outfile)
+        mm = MidiMapper(
+            infile=infile,
+            outfiles=outfiles,
+            tenten_device=device,
+            general_midi_settings=models.GeneralMidiSettings(
+                mod_sources=[m for m in models.ModSources]
+            ),
+            overwrite_files=True,
+            streaming=streaming,
+        )
+        report = mm.run(return_report=True)
+        self.assertEqual(mm.errors, [])
+        self.assertEqual([t.recovered for t in report.targets], [False, True, False])
+        self.assertEqual(report.summary()["recovered"], 1)
+        self.assertEqual(mm.recovered_files, [outfiles[1]])
+        with open(outfiles[1], "rb") as f:
+            self.assertTrue(f.read().rstrip().endswith(b"</document>"))
+        return report
+
+    def test_tree(self):
+        self.run_mapper(streaming=False)
+
+    def test_streaming(self):
+        self.run_mapper(streaming=True)
+
+    def test_streaming_counters(self):
+        # the changes of the pass, which failed on the broken file, aren't
+        # counted twice when streaming starts over in recover mode
+        counters = [
+            [t.model_dump(include=set(CHANGE_COUNTERS)) for t in report.targets]
+            for report in [self.run_mapper(streaming) for streaming in (False, True)]
+        ]
+        self.assertGreater(counters[0][1]["nodes_inserted"], 0)
+        self.assertEqual(counters[0], counters[1])
+
+    def test_remove_blank_text(self):
+        xml = generate_preset(models.TenTenDevice.LEMONDROP)
+        root, recovered = parse_xml(xml, remove_blank_text=True)
+        self.assertFalse(recovered)
+        self.assertTrue(all(elem.tail is None for elem in root.iter()))
+
+
+class TestRunReport(unittest.TestCase):
+    def setUp(self):
+        self.tmp_folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_folder)
+
+    def test_report(self):
+        folder = os.path.join(self.tmp_folder, "lemondrop")
+        shutil.copytree("./test_files/lemondrop", folder)
+        broken_file = os.path.join(folder, "broken.nnl")
+        with open(broken_file, "wb") as f:
+            f.write(b"")
+        outfile = os.path.join(folder, "NuDefault.nnl")
+        mm = MidiMapper(
+            infile=os.path.join(folder, "TEST MAPPING.nnl"),
+            outfiles=[broken_file, outfile],
+            tenten_device=models.TenTenDevice.LEMONDROP,
+            general_midi_settings=models.GeneralMidiSettings(
+                mod_sources=[m for m in models.ModSources]
+            ),
+            overwrite_files=True,
+        )
+        report = mm.run(profile=True, trace_memory=True, return_report=True)
+        self.assertEqual([t.outfile for t in report.targets], [broken_file, outfile])
+        self.assertEqual(report.targets[0].status, "error")
+        self.assertIsNotNone(report.targets[0].error)
+        target = report.targets[1]
+        self.assertEqual(target.status, "ok")
+        self.assertEqual(set(target.phases), {"parse", "patch", "write"})
+        self.assertGreater(target.nodes_inserted, 0)
+        self.assertEqual(target.bytes_written, os.path.getsize(outfile))
+        self.assertEqual(report.summary()["error"], 1)
+        self.assertIsNotNone(report.profile)
+        self.assertIsNotNone(report.memory_peak_bytes)
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_profiler_stops_on_error(self):
+        with self.assertRaises(RuntimeError):
+            with RunProfiler(profile=True, trace_memory=True):
+                raise RuntimeError("run failed")
+        self.assertFalse(tracemalloc.is_tracing())
@@ -0,0 +1,58 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from sample_cleaner import clean_project, scan_library
+
+# like the presets of the device it ends with a NUL byte
+PRESET = (
+    b'<document><session><cell row="0" column="0" layer="0" type="sample" '
+    b'filename=".\\Kick.wav"/><cell row="0" column="1" layer="0" type="sample" '
+    b'filename=".\\snare.wav"/></session></document>\x00'
+)
+
+
+class TestSampleCleaner(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.project = os.path.join(self.folder, "project")
+        os.makedirs(self.project)
+        with open(os.path.join(self.project, "preset.xml"), "wb") as f:
+            f.write(PRESET)
+        for name in ("kick.wav", "snare.wav", "unused.wav", "notes.txt"):
+            with open(os.path.join(self.project, name), "wb") as f:
+                f.write(b"x" * 10)
+        # a broken preset must never lead to removed samples
+        self.broken = os.path.join(self.folder, "broken")
+        os.makedirs(self.broken)
+        with open(os.path.join(self.broken, "preset.xml"), "wb") as f:
+            f.write(b"<document><session>")
+        with open(os.path.join(self.broken, "kick.wav"), "wb") as f:
+            f.write(b"x")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_scan(self):
+        broken, project = scan_library(self.folder)
+        self.assertIsNotNone(broken.error)
+        self.assertEqual(broken.unused, [])
+        self.assertEqual(project.unused, [os.path.join(self.project, "unused.wav")])
+        self.assertEqual(project.unused_bytes, 10)
+
+    def test_modes(self):
+        project = scan_library(self.folder)[1]
+        self.assertEqual(clean_project(project, "dry-run"), 10)
+        self.assertTrue(os.path.exists(project.unused[0]))
+
+        trash = os.path.join(self.folder, ".trash")
+        self.assertEqual(clean_project(project, "trash", trash), 10)
+        self.assertTrue(os.path.exists(os.path.join(trash, "project", "unused.wav")))
+        self.assertEqual(scan_library(self.folder)[1].unused, [])
+
+        with open(project.unused[0], "wb") as f:
+            f.write(b"x" * 5)
+        self.assertEqual(clean_project(project, "delete"), 5)
+        self.assertFalse(os.path.exists(project.unused[0]))
+        self.assertEqual(len(os.listdir(self.project)), 4)
@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from sample_dedup import PARTIAL_HASH_SIZE, SampleDedup, project_samples
+
+PRESET = (
+    b'<document><session><cell row="0" column="0" layer="0" type="sample" '
+    b'filename=".\\kick.wav"/><cell row="0" column="1" layer="0" type="sample" '
+    b'filename=".\\pad.wav"/></session></document>'
+)
+
+
+class TestSampleDedup(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        kick = os.urandom(3 * PARTIAL_HASH_SIZE)
+        # same size, head and tail as the kick, so only the full hash differs
+        pad = kick[:PARTIAL_HASH_SIZE] + os.urandom(PARTIAL_HASH_SIZE)
+        pad += kick[-PARTIAL_HASH_SIZE:]
+        self.projects = []
+        for index, samples in enumerate(
+            [{"kick.wav": kick, "pad.wav": pad}, {"kick.wav": kick}, {"kick.wav": kick}]
+        ):
+            project = os.path.join(self.folder, f"project{index}")
+            os.makedirs(project)
+            with open(os.path.join(project, "preset.xml"), "wb") as f:
+                f.write(PRESET)
+            for name, content in samples.items():
+                with open(os.path.join(project, name), "wb") as f:
+                    f.write(content)
+            self.projects.append(project)
+        self.cache = os.path.join(self.folder, "hashes.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def samples(self):
+        return [s for p in self.projects for s in project_samples(p)]
+
+    def test_hardlink(self):
+        dedup = SampleDedup(self.cache)
+        duplicates = dedup.find_duplicates(self.samples())
+        kicks = [os.path.join(p, "kick.wav") for p in self.projects]
+        self.assertEqual(duplicates, [kicks])
+        self.assertEqual(dedup.link_duplicates(duplicates), 6 * PARTIAL_HASH_SIZE)
+        self.assertEqual(
+            dedup.link_duplicates(duplicates, "hardlink"), 6 * PARTIAL_HASH_SIZE
+        )
+        dedup.save()
+        self.assertTrue(all(os.path.samefile(kicks[0], k) for k in kicks))
+
+        # the links count as one file and nothing has to be hashed again
+        dedup = SampleDedup(self.cache)
+        self.assertEqual(dedup.find_duplicates(self.samples()), [])
+        self.assertEqual(dedup.hashed_bytes, 0)
+
+    def test_cache(self):
+        dedup = SampleDedup(self.cache)
+        dedup.find_duplicates(self.samples())
+        self.assertGreater(dedup.hashed_bytes, 0)
+        dedup.save()
+        dedup = SampleDedup(self.cache)
+        self.assertEqual(len(dedup.find_duplicates(self.samples())), 1)
+        self.assertEqual(dedup.hashed_bytes, 0)
@@ -0,0 +1,52 @@
+import io
+import os
+import tempfile
+import time
+import unittest
+
+from upload_utils import UploadQuota, save_upload
+
+
+class TestUploadQuota(unittest.TestCase):
+    def test_session_quota(self):
+        quota = UploadQuota(session_quota=100, global_quota=1000)
+        quota.reserve("a", 60)
+        with self.assertRaises(ValueError):
+            quota.reserve("a", 50)
+        # other sessions have their own quota
+        quota.reserve("b", 100)
+        quota.free("a", 60)
+        quota.reserve("a", 100)
+        self.assertEqual(quota.used("a"), 100)
+
+    def test_global_quota(self):
+        quota = UploadQuota(session_quota=100, global_quota=150)
+        quota.reserve("a", 100)
+        with self.assertRaises(ValueError):
+            quota.reserve("b", 100)
+        quota.release("a")
+        quota.reserve("b", 100)
+        self.assertEqual(quota.total, 100)
+
+    def test_expire(self):
+        quota = UploadQuota(session_quota=100, global_quota=150, session_ttl=60)
+        folder = tempfile.mkdtemp()
+        quota.reserve("a", 100)
+        quota.touch("a", [folder])
+        quota.touch("b")
+        # a session, which is still seen, is kept
+        self.assertEqual(quota.expire(time.monotonic() + 30), [])
+        self.assertEqual(sorted(quota.expire(time.monotonic() + 61)), ["a", "b"])
+        self.assertEqual(quota.total, 0)
+        self.assertFalse(os.path.exists(folder))
+        quota.reserve("c", 100)
+
+
+class TestSaveUpload(unittest.TestCase):
+    def test_chunks(self):
+        data = bytes(range(256)) * 100
+        upload = io.BytesIO(data)
+        upload.read(10)
+        out = io.BytesIO()
+        self.assertEqual(save_upload(upload, out, chunk_size=1000), len(data))
+        self.assertEqual(out.getvalue(), data)
@@ -1,7 +1,26 @@
+import io
 import os
+import shutil
+import tempfile
 import unittest
 import filecmp
-from tenten_zip_utils import zip_folder_to_memory, unzip_files
+import zipfile
+from unittest import mock
+from tenten_zip_utils import (
+    zip_files_to_memory,
+    zip_files_to_spooled_file,
+    zip_folder_to_memory,
+    unzip_files,
+    map_zip_to_memory,
+    map_zip_to_spooled_file,
+    list_project_members,
+    pack_library,
+    read_pack_manifest,
+    supports_raw_write,
+    PACK_MANIFEST_NAME,
+)
+from midi_mapper import MidiMapper
+import models
 
 
 class TestZipUtils(unittest.TestCase):
@@ -45,3 +64,190 @@ class TestZipUtils(unittest.TestCase):
                 for file in files:
                     os.remove(os.path.join(root, file))
                 os.rmdir(root)
+
+
+class TestZipToZip(unittest.TestCase):
+    def setUp(self):
+        self.tmp_folder = tempfile.mkdtemp()
+        self.template = "./test_files/lemondrop/TEST MAPPING.nnl"
+        self.target = "./test_files/lemondrop/NuDefault.nnl"
+        self.sample = os.urandom(4096)
+        self.zip_buffer = io.BytesIO()
+        with zipfile.ZipFile(self.zip_buffer, "w") as zipf:
+            zipf.write(self.target, "project/NuDefault.nnl", zipfile.ZIP_DEFLATED)
+            zipf.writestr("project/sample.wav", self.sample, zipfile.ZIP_STORED)
+            zipf.writestr("__MACOSX/project/NuDefault.nnl", b"resource fork")
+        self.zip_buffer.seek(0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_folder)
+
+    def get_mapper(self, outfiles=[]):
+        return MidiMapper(
+            infile=self.template,
+            outfiles=outfiles,
+            tenten_device=models.TenTenDevice.LEMONDROP,
+            general_midi_settings=models.GeneralMidiSettings(
+                mod_sources=[m for m in models.ModSources]
+            ),
+            overwrite_files=True,
+        )
+
+    def test_list_project_members(self):
+        members = list_project_members(self.zip_buffer, "NuDefault.nnl")
+        self.assertEqual(members, ["project/NuDefault.nnl"])
+        with self.assertRaises(ValueError):
+            list_project_members(self.zip_buffer, "NuDefault.nnl", max_file_size=10)
+
+    def test_raw_write_internals(self):
+        # the zipfile internals `write_raw_member` relies on
+        with zipfile.ZipFile(io.BytesIO(), "w") as zipf:
+            self.assertTrue(supports_raw_write(zipf))
+
+    def test_map_zip_without_raw_write(self):
+        expected = map_zip_to_memory(
+            self.zip_buffer, self.get_mapper(), "NuDefault.nnl"
+        )
+        with mock.patch("tenten_zip_utils.supports_raw_write", return_value=False):
+            zip_output = map_zip_to_memory(
+                self.zip_buffer, self.get_mapper(), "NuDefault.nnl"
+            )
+        with zipfile.ZipFile(zip_output) as zipf, zipfile.ZipFile(expected) as zipf_e:
+            self.assertIsNone(zipf.testzip())
+            self.assertEqual(zipf.namelist(), zipf_e.namelist())
+            for name in zipf.namelist():
+                self.assertEqual(zipf.read(name), zipf_e.read(name))
+
+    def test_map_zip_to_spooled_file(self):
+        zip_output = map_zip_to_spooled_file(
+            self.zip_buffer, self.get_mapper(), "NuDefault.nnl", spool_threshold=1024
+        )
+        # the archive is larger than the threshold, so it was moved to disk
+        self.assertTrue(zip_output._rolled)
+        with zipfile.ZipFile(zip_output) as zipf:
+            self.assertIsNone(zipf.testzip())
+            self.assertEqual(zipf.read("project/sample.wav"), self.sample)
+
+    def test_map_zip_to_memory(self):
+        zip_output = map_zip_to_memory(
+            self.zip_buffer, self.get_mapper(), "NuDefault.nnl"
+        )
+
+        # map the same file on disk for comparison
+        outfile = os.path.join(self.tmp_folder, "NuDefault.nnl")
+        shutil.copy(self.target, outfile)
+        self.get_mapper(outfiles=[outfile]).run()
+        with open(outfile, "rb") as f:
+            expected = f.read()
+
+        with zipfile.ZipFile(zip_output) as zipf:
+            self.assertIsNone(zipf.testzip())
+            self.assertEqual(zipf.read("project/NuDefault.nnl"), expected)
+            self.assertEqual(zipf.read("project/sample.wav"), self.sample)
+            self.assertEqual(
+                zipf.read("__MACOSX/project/NuDefault.nnl"), b"resource fork"
+            )
+
+
+class TestParallelZip(unittest.TestCase):
+    def setUp(self):
+        self.tmp_folder = tempfile.mkdtemp()
+        self.files = {}
+        for i in range(10):
+            name = f"preset{i}.xml" if i % 3 else f"sample{i}.mp3"
+            path = os.path.join(self.tmp_folder, name)
+            data = b"<cell/>" * (i * 1000) + os.urandom(100)
+            with open(path, "wb") as f:
+                f.write(data)
+            self.files[name] = data
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_folder)
+
+    def check_zip(self, zip_file):
+        with zipfile.ZipFile(zip_file) as zipf:
+            self.assertIsNone(zipf.testzip())
+            self.assertEqual(zipf.namelist(), sorted(self.files, key=self.order))
+            for zinfo in zipf.infolist():
+                self.assertEqual(zipf.read(zinfo), self.files[zinfo.filename])
+                if zinfo.filename.endswith(".mp3"):
+                    self.assertEqual(zinfo.compress_type, zipfile.ZIP_STORED)
+
+    def order(self, name):
+        return list(self.files).index(name)
+
+    def paths(self):
+        return [os.path.join(self.tmp_folder, name) for name in self.files]
+
+    def test_compression_settings(self):
+        for compression, compresslevel in [
+            (zipfile.ZIP_DEFLATED, None),
+            (zipfile.ZIP_DEFLATED, 1),
+            (zipfile.ZIP_STORED, None),
+        ]:
+            self.check_zip(
+                zip_files_to_memory(
+                    self.paths(),
+                    compression=compression,
+                    compresslevel=compresslevel,
+                    max_workers=3,
+                )
+            )
+
+    def test_without_raw_write(self):
+        with mock.patch("tenten_zip_utils.supports_raw_write", return_value=False):
+            self.check_zip(zip_files_to_memory(self.paths(), max_workers=3))
+
+    def test_spooled_file(self):
+        zip_file = zip_files_to_spooled_file(self.paths(), spool_threshold=1024)
+        # the archive is larger than the threshold, so it was moved to disk
+        self.assertTrue(zip_file._rolled)
+        self.check_zip(zip_file)
+
+
+class TestPackLibrary(unittest.TestCase):
+    def setUp(self):
+        self.tmp_folder = tempfile.mkdtemp()
+        self.library = os.path.join(self.tmp_folder, "library")
+        for project in ("a", "b", os.path.join("c", "d"), "__MACOSX"):
+            os.makedirs(os.path.join(self.library, project))
+            self.write(os.path.join(project, "preset.xml"), b"<document/>")
+            self.write(os.path.join(project, "kick.wav"), b"RIFF")
+        self.zip_path = os.path.join(self.tmp_folder, "preset_files.zip")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_folder)
+
+    def write(self, name, data):
+        with open(os.path.join(self.library, name), "wb") as f:
+            f.write(data)
+
+    def test_pack_library(self):
+        members = ["a/preset.xml", "b/preset.xml", "c/d/preset.xml"]
+        packed, files = pack_library(
+            self.library, self.zip_path, models.TenTenDevice.BLACKBOX
+        )
+        self.assertEqual(packed, members)
+        with zipfile.ZipFile(self.zip_path) as zipf:
+            self.assertEqual(zipf.namelist(), members + [PACK_MANIFEST_NAME])
+            self.assertEqual(zipf.read("c/d/preset.xml"), b"<document/>")
+        self.assertEqual(read_pack_manifest(self.zip_path), files)
+
+        # only the changed project is packed again, a touched one is not
+        self.write(os.path.join("b", "preset.xml"), b"<document><session/></document>")
+        os.utime(os.path.join(self.library, "a", "preset.xml"), ns=(0, 0))
+        packed, files = pack_library(
+            self.library,
+            self.zip_path,
+            models.TenTenDevice.BLACKBOX,
+            previous_files=read_pack_manifest(self.zip_path),
+        )
+        self.assertEqual(packed, ["b/preset.xml"])
+        self.assertEqual(sorted(files), members)
+        self.assertEqual(files["a/preset.xml"]["mtime_ns"], 0)
+
+    def test_project_filename(self):
+        packed, _ = pack_library(
+            self.library, self.zip_path, project_filename="kick.wav"
+        )
+        self.assertEqual(packed, ["a/kick.wav", "b/kick.wav", "c/d/kick.wav"])
@@ -0,0 +1,148 @@
+import shutil
+import threading
+import time
+
+from format_utils import format_size
+
+# uploads are copied to disk in chunks of this size
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# bytes a single session may have on disk at a time
+SESSION_UPLOAD_QUOTA = 1024 * 1024 * 1024
+# bytes all sessions of the server may have on disk at a time
+GLOBAL_UPLOAD_QUOTA = 8 * 1024 * 1024 * 1024
+# the reservations of a session, which hasn't been seen for this many seconds
+# (e.g. because its tab was closed), are released and its folders deleted
+SESSION_TTL = 6 * 60 * 60
+# project files are mapped in memory, so they are limited separately
+MAX_PROJECT_FILE_SIZE = 64 * 1024 * 1024
+
+
+class UploadQuota:
+    """
+    Thread-safe byte quotas for the uploads of every session and of the whole
+    process, the bytes are reserved before an upload is written to disk.
+
+    Streamlit doesn't tell when a session ends, so every session has to
+    `touch` the quota on each rerun. Sessions, which haven't been seen for
+    `session_ttl` seconds, are expired: their bytes are released and their
+    folders deleted.
+    """
+
+    def __init__(
+        self,
+        session_quota: int = SESSION_UPLOAD_QUOTA,
+        global_quota: int = GLOBAL_UPLOAD_QUOTA,
+        session_ttl: float = SESSION_TTL,
+    ):
+        self.session_quota = session_quota
+        self.global_quota = global_quota
+        self.session_ttl = session_ttl
+        self.sessions = {}
+        self.last_seen = {}
+        self.folders = {}
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def touch(self, session_id: str, folders=()):
+        """
+        Marks the session as alive and remembers the folders with its uploads,
+        which are deleted when it expires.
+        """
+        self.expire()
+        with self.lock:
+            self.last_seen[session_id] = time.monotonic()
+            self.folders[session_id] = list(folders)
+
+    def expire(self, now: float = None) -> list:
+        """
+        Releases the sessions, which haven't been seen for `session_ttl`
+        seconds, and deletes their folders.
+
+        Returns:
+            list: The ids of the expired sessions.
+        """
+        now = time.monotonic() if now is None else now
+        expired = []
+        folders = []
+        with self.lock:
+            for session_id, last_seen in list(self.last_seen.items()):
+                if now - last_seen < self.session_ttl:
+                    continue
+                del self.last_seen[session_id]
+                self.total -= self.sessions.pop(session_id, 0)
+                folders += self.folders.pop(session_id, [])
+                expired.append(session_id)
+        # the folders are deleted without holding the lock
+        for folder in folders:
+            shutil.rmtree(folder, ignore_errors=True)
+        return expired
+
+    def reserve(self, session_id: str, nbytes: int):
+        """
+        Reserves nbytes for the session.
+
+        Raises:
+            ValueError: If the session or the server has no room left.
+        """
+        # abandoned sessions must not block the others
+        self.expire()
+        with self.lock:
+            self.last_seen[session_id] = time.monotonic()
+            used = self.sessions.get(session_id, 0)
+            if used + nbytes > self.session_quota:
+                raise ValueError(
+                    f"Upload of {format_size(nbytes)} exceeds the limit of "
+                    + f"{format_size(self.session_quota)} per session "
+                    + f"({format_size(used)} used)."
+                )
+            if self.total + nbytes > self.global_quota:
+                raise ValueError(
+                    "The server is busy with other uploads, please try again later."
+                )
+            self.sessions[session_id] = used + nbytes
+            self.total += nbytes
+
+    def free(self, session_id: str, nbytes: int):
+        """
+        Frees nbytes of the session, e.g. when a rejected upload is deleted.
+        """
+        with self.lock:
+            freed = min(nbytes, self.sessions.get(session_id, 0))
+            self.sessions[session_id] = self.sessions.get(session_id, 0) - freed
+            self.total -= freed
+
+    def release(self, session_id: str):
+        """
+        Frees everything reserved by the session, e.g. when its files are deleted.
+        """
+        with self.lock:
+            self.total -= self.sessions.pop(session_id, 0)
+            self.last_seen.pop(session_id, None)
+            self.folders.pop(session_id, None)
+
+    def used(self, session_id: str) -> int:
+        with self.lock:
+            return self.sessions.get(session_id, 0)
+
+
+# shared by all sessions of the streamlit server
+upload_quota = UploadQuota()
+
+
+def save_upload(uploaded_file, fileobj, chunk_size: int = UPLOAD_CHUNK_SIZE) -> int:
+    """
+    Copies an uploaded file to fileobj in chunks, so no second copy of the
+    whole upload is made in memory.
+
+    Args:
+        uploaded_file: The file object of the upload.
+        fileobj: The file object to write to.
+        chunk_size (int): Bytes copied at a time.
+
+    Returns:
+        int: The number of bytes written.
+    """
+    uploaded_file.seek(0)
+    start = fileobj.tell()
+    shutil.copyfileobj(uploaded_file, fileobj, chunk_size)
+    return fileobj.tell() - start
@@ -0,0 +1,89 @@
+import threading
+
+from lxml import etree
+
+# the presets of the devices end with a NUL byte after the root element, which
+# the strict parser rejects as extra content
+TRAILING_BYTES = b"\x00 \t\r\n"
+
+# lxml parsers must not be used by several threads at the same time, so every
+# thread keeps its own parsers, one per configuration
+_local = threading.local()
+
+
+def get_parser(recover: bool = False, remove_blank_text: bool = False):
+    """
+    Returns the parser of the current thread for the given configuration.
+
+    Args:
+        recover (bool): Whether to try to read broken XML.
+        remove_blank_text (bool): Whether to drop the whitespace between elements.
+
+    Returns:
+        etree.XMLParser: The parser.
+    """
+    parsers = getattr(_local, "parsers", None)
+    if parsers is None:
+        parsers = _local.parsers = {}
+    key = (recover, remove_blank_text)
+    if key not in parsers:
+        parsers[key] = etree.XMLParser(
+            recover=recover,
+            remove_blank_text=remove_blank_text,
+            # presets with many cells and samples easily exceed the default limits
+            huge_tree=True,
+            # the presets don't use ids, so there is no need to index them
+            collect_ids=False,
+            resolve_entities=False,
+        )
+    return parsers[key]
+
+
+def parse_xml(xml: bytes, remove_blank_text: bool = False):
+    """
+    Parses XML strictly and only falls back to the slower recover mode, if the
+    XML is broken.
+
+    Args:
+        xml (bytes): The XML content.
+        remove_blank_text (bool): Whether to drop the whitespace between elements.
+
+    Returns:
+        tuple: The root element and whether the recover mode was needed.
+    """
+    xml = strip_trailing_bytes(xml)
+    try:
+        return etree.fromstring(xml, parser=get_parser(False, remove_blank_text)), False
+    except etree.XMLSyntaxError:
+        pass
+    return etree.fromstring(xml, parser=get_parser(True, remove_blank_text)), True
+
+
+def strip_trailing_bytes(xml: bytes) -> bytes:
+    # only copies the content, if there is something to strip
+    if xml[-1:] in (b"\x00", b" ", b"\t", b"\r", b"\n"):
+        return xml.rstrip(TRAILING_BYTES)
+    return xml
+
+
+def iterparse_document(source, events=("start", "end"), recover=False):
+    """
+    Same as `etree.iterparse` with `huge_tree`, but an error after the root
+    element has been closed (like the trailing NUL byte of the presets) is
+    ignored, all elements have been read already.
+    """
+    depth = 0
+    root_closed = False
+    try:
+        for event, elem in etree.iterparse(
+            source, events=events, recover=recover, huge_tree=True
+        ):
+            if event == "start":
+                depth += 1
+            elif event == "end":
+                depth -= 1
+                root_closed = depth == 0
+            yield event, elem
+    except etree.XMLSyntaxError:
+        if not root_closed:
+            raise